@@ -11,15 +11,41 @@ from yadacoin.miningpool import MiningPool
 from yadacoin.transaction import TransactionFactory
 from yadacoin.mongo import Mongo
 from yadacoin.graphutils import GraphUtils
+from yadacoin.chainindex import ChainIndex
+from yadacoin.chainstate import ChainState
+from yadacoin.headercache import HeaderCache
+from yadacoin.retarget import RetargetEngine
+from yadacoin.cacheinvalidator import CacheInvalidator
 
 with open(sys.argv[1]) as f:
     config = Config(json.loads(f.read()))
 print(config)
 yadacoin.config.CONFIG = config
-mongo = Mongo()
-config.mongo = mongo
 
-config.BU = yadacoin.blockchainutils.BlockChainUtils()
-config.TU = yadacoin.transactionutils.TU
-yadacoin.blockchainutils.set_BU(config.BU)  # To be removed
-config.GU = GraphUtils()
+
+def init_singletons():
+    config.mongo = Mongo()
+    config.BU = yadacoin.blockchainutils.BlockChainUtils()
+    config.TU = yadacoin.transactionutils.TU
+    yadacoin.blockchainutils.set_BU(config.BU)  # To be removed
+    config.GU = GraphUtils()
+    config.chain_state = ChainState()
+    config.chain_index = ChainIndex()
+    config.header_cache = HeaderCache()
+    config.retarget_engine = RetargetEngine()
+    config.cache_invalidator = CacheInvalidator()
+    return config.mongo
+
+
+def use_scratch_database(name):
+    """For tests that write: points config at an emptied database_name database instead of the node's.
+    Called again with the same name, empties it again."""
+    suffix = '_{}'.format(name)
+    if not config.database.endswith(suffix):
+        config.database += suffix
+        config.site_database += suffix
+    config.mongo.client.drop_database(config.database)
+    return init_singletons()
+
+
+mongo = init_singletons()
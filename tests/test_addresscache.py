@@ -0,0 +1,53 @@
+"""
+AddressCache LRU bound and hit/miss counters, on freshly generated keys. No database access.
+
+Usage: python test_addresscache.py config.json
+"""
+from bitcoin.wallet import P2PKHBitcoinAddress
+from coincurve import PrivateKey
+
+from setup import config
+from yadacoin.addresscache import AddressCache
+
+
+def public_key():
+    return PrivateKey().public_key.format().hex()
+
+
+def main():
+    keys = [public_key() for i in range(4)]
+    cache = AddressCache(size=2)
+    assert cache.get_status() == {'size': 0, 'hits': 0, 'misses': 0, 'hit_rate': 0.0}
+
+    # Same derivation as from_pubkey, counted as a miss then a hit
+    assert cache.from_public_key(keys[0]) == str(P2PKHBitcoinAddress.from_pubkey(bytes.fromhex(keys[0])))
+    cache.from_public_key(keys[0])
+    assert cache.get_status() == {'size': 1, 'hits': 1, 'misses': 1, 'hit_rate': 0.5}
+
+    # Bounded to size, least recently used out first: the hit on keys[0] keeps it over keys[1]
+    cache.from_public_key(keys[1])
+    cache.from_public_key(keys[0])
+    cache.from_public_key(keys[2])
+    assert list(cache.addresses) == [keys[0], keys[2]]
+    cache.from_public_key(keys[3])
+    assert list(cache.addresses) == [keys[2], keys[3]]
+    assert cache.get_status() == {'size': 2, 'hits': 2, 'misses': 4, 'hit_rate': round(2 / 6, 4)}
+
+    # An evicted key is derived again
+    cache.from_public_key(keys[0])
+    assert cache.misses == 5 and keys[0] in cache.addresses
+
+    cache.clear()
+    assert cache.get_status()['size'] == 0
+
+    # The node wide cache is created once, sized from the config
+    config.address_cache = None
+    config.address_cache_size = 3
+    assert AddressCache.get() is AddressCache.get() is config.address_cache
+    assert config.address_cache.size == 3
+    assert AddressCache.address(keys[1]) == AddressCache.address(keys[1])
+    assert config.address_cache.get_status() == {'size': 1, 'hits': 1, 'misses': 1, 'hit_rate': 0.5}
+    print('address cache ok')
+
+
+main()
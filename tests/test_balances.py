@@ -0,0 +1,91 @@
+"""
+Balances kept by ChainIndex through a block replacing ours.
+
+A transaction to another address is mined at height 4, then block 4 is replaced by one without it:
+the rollback has to give the spent outputs back and take the new ones away, and rebuild_balances,
+from the utxos, has to agree. Runs in a scratch database, nothing of the node's is touched.
+
+Usage: python test_balances.py config.json
+"""
+import asyncio
+
+from coincurve import PrivateKey
+
+from setup import config, use_scratch_database
+from yadacoin.addresscache import AddressCache
+from yadacoin.block import BlockFactory
+from yadacoin.chainindex import ChainIndex
+from yadacoin.consensus import Consensus
+from yadacoin.peers import Peers
+from yadacoin.transaction import TransactionFactory
+
+
+async def mine(index, block_time, previous, transactions=None):
+    """A block on top of the previous block dict"""
+    config.BU.set_latest_block(previous)
+    factory = await BlockFactory.generate(config, transactions or [], config.public_key, config.private_key, index=index, force_time=block_time)
+    config.BU.set_latest_block(None)
+    block = factory.block
+    header = BlockFactory.generate_header(block)
+    nonce, block_hash = BlockFactory.mine(index, header, block.target, [0, 1000000])
+    block.hash = block_hash
+    block.nonce = str(nonce)
+    block.header = header
+    block.signature = config.BU.generate_signature(block_hash, config.private_key)
+    return block
+
+
+async def balances(addresses):
+    return {x['address']: x['amount'] async for x in config.mongo.async_db.balances.find({'address': {'$in': addresses}}) if x['amount']}
+
+
+async def main():
+    use_scratch_database('test_balances')
+    config.peers = Peers()
+    config.consensus = Consensus(False, config.peers)
+    await config.consensus.async_init()
+    consensus = config.consensus
+    other = AddressCache.address(PrivateKey().public_key.format().hex())
+    addresses = [config.address, other]
+
+    # apply_balance_deltas adds to what is there and skips the zero deltas
+    await config.chain_index.apply_balance_deltas({'a': 5, 'b': 0})
+    await config.chain_index.apply_balance_deltas({'a': -2})
+    assert await balances(['a', 'b']) == {'a': 3}
+    await config.mongo.async_db.balances.delete_many({})
+
+    previous = await config.BU.get_latest_block_async()
+    start = int(previous['time'])
+    for index in range(1, 4):
+        block = await mine(index, start + index * 600, previous)
+        assert await consensus.integrate_block_with_existing_chain(block)
+        previous = block.to_dict()
+    block_3 = previous
+
+    factory = await TransactionFactory.construct(
+        block_height=4,
+        fee=0.0,
+        public_key=config.public_key,
+        private_key=config.private_key,
+        outputs=[{'to': other, 'value': 60}]
+    )
+    block = await mine(4, start + 4 * 600, block_3, [factory.transaction.to_dict()])
+    assert await consensus.integrate_block_with_existing_chain(block)
+    mined = await balances(addresses)
+    assert mined[other] == ChainIndex.to_amount(60)
+
+    # Block 4 replaced by one without the transaction
+    replacement = await mine(4, start + 4 * 600 + 1, block_3)
+    assert await consensus.integrate_block_with_existing_chain(replacement)
+    assert (await config.BU.get_latest_block_async())['hash'] == replacement.hash
+    replaced = await balances(addresses)
+    assert replaced == {config.address: mined[config.address] + mined[other]}, 'rollback left {}'.format(replaced)
+    assert (await config.BU.get_wallet_balances([other]))[other] == 0.0
+
+    # rebuild_balances from the utxos gives the same
+    await config.chain_index.rebuild_balances()
+    assert await balances(addresses) == replaced
+    print('balances ok')
+
+
+asyncio.get_event_loop().run_until_complete(main())
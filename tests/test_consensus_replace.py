@@ -0,0 +1,101 @@
+"""
+Blocks replacing ours at a height we already have.
+
+integrate_block_with_existing_chain checks such a block against the chain below it and only removes
+our blocks in commit_block, once every stage passed. A competing block with a made up hash or a bad
+signature has to leave the chain as it was, a valid one replaces our blocks from its height.
+A retrace to a heavier branch that fails halfway has to put our blocks back.
+Runs in a scratch database, nothing of the node's is touched.
+
+Usage: python test_consensus_replace.py config.json
+"""
+import asyncio
+import copy
+
+from coincurve import PrivateKey
+
+from setup import config, use_scratch_database
+from yadacoin.block import Block, BlockFactory
+from yadacoin.chain import CHAIN
+from yadacoin.consensus import Consensus
+from yadacoin.peers import Peer, Peers
+from yadacoin.transactionutils import TU
+
+
+async def mine(index, block_time, private_key, target=None):
+    """A block on top of our tip, signed with private_key. A lower target than the block's gives it more work."""
+    factory = await BlockFactory.generate(config, [], config.public_key, config.private_key, index=index, force_time=block_time)
+    block = factory.block
+    header = BlockFactory.generate_header(block)
+    nonce, block_hash = BlockFactory.mine(index, header, target or block.target, [0, 1000000])
+    block.hash = block_hash
+    block.nonce = str(nonce)
+    block.header = header
+    block.signature = TU.generate_signature(block_hash, private_key)
+    return block
+
+
+async def snapshot():
+    return [block['hash'] async for block in config.mongo.async_db.blocks.find({}, {'hash': 1}).sort([('index', 1)])]
+
+
+async def main():
+    use_scratch_database('test_replace')
+    config.peers = Peers()
+    config.consensus = Consensus(False, config.peers)
+    await config.consensus.async_init()
+    consensus = config.consensus
+    start = int((await config.BU.get_latest_block_async())['time'])
+    for index in range(1, 6):
+        block = await mine(index, start + index * 600, config.private_key)
+        assert await consensus.integrate_block_with_existing_chain(block), 'block {} not integrated'.format(index)
+    chain = await snapshot()
+    assert len(chain) == 6 and config.chain_state.hashes == chain
+
+    # Same height as our block 3, proper work, signed by another key
+    consensus.latest_block = await Block.from_dict(await config.BU.get_latest_block_async(False))
+    block_2 = await config.mongo.async_db.blocks.find_one({'index': 2}, {'_id': 0})
+    config.BU.set_latest_block(block_2)
+    bad_signature = await mine(3, start + 3 * 600 + 1, PrivateKey().to_hex())
+    config.BU.set_latest_block(None)
+    assert not await consensus.integrate_block_with_existing_chain(bad_signature)
+    assert await snapshot() == chain and config.chain_state.hashes == chain, 'bad signature replacement changed the chain'
+
+    # Made up hash below any target, caught once the hash is recomputed
+    made_up = await Block.from_dict(copy.deepcopy(bad_signature.to_dict()))
+    made_up.hash = '00' * 31 + '01'
+    made_up.signature = TU.generate_signature(made_up.hash, config.private_key)
+    assert not await consensus.integrate_block_with_existing_chain(made_up)
+    assert await snapshot() == chain and config.chain_state.hashes == chain, 'made up hash replacement changed the chain'
+    assert config.header_cache.tip.hash == chain[-1] and config.chain_state.height == 5
+
+    # A valid one replaces 3 to 5
+    config.BU.set_latest_block(block_2)
+    replacement = await mine(3, start + 3 * 600 + 2, config.private_key)
+    config.BU.set_latest_block(None)
+    assert await consensus.integrate_block_with_existing_chain(replacement)
+    assert await snapshot() == chain[:3] + [replacement.hash] and config.chain_state.height == 3
+
+    # Retrace to a heavier branch whose third block has a bad signature, ours is put back
+    for index in range(4, 7):
+        block = await mine(index, start + index * 600 + 2, config.private_key)
+        assert await consensus.integrate_block_with_existing_chain(block)
+    chain = await snapshot()
+    me = Peer(None, None, is_me=True)
+    branch = []
+    previous = await config.mongo.async_db.blocks.find_one({'index': 3}, {'_id': 0})
+    for index in range(4, 8):
+        config.BU.set_latest_block(previous)
+        private_key = PrivateKey().to_hex() if index == 6 else config.private_key
+        block = await mine(index, start + index * 600 + 3, private_key, CHAIN.MAX_TARGET >> 8)
+        branch.append(block)
+        previous = block.to_dict()
+    config.BU.set_latest_block(None)
+    for block in branch:
+        await consensus.insert_consensus_block(block, me)
+    await consensus.retrace(branch[1], me)
+    assert await snapshot() == chain and config.chain_state.hashes == chain, 'failed retrace left a partial branch'
+    print('replacements ok')
+
+
+asyncio.get_event_loop().run_until_complete(main())
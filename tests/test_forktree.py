@@ -0,0 +1,117 @@
+"""
+ForkTree branch resolution, work, pruning and bound, on made up headers.
+
+Our chain is heights 0 to 30 in ChainState, candidates are BlockHeader objects fed to the tree.
+The peer is 'me', so no missing ancestor is ever fetched.
+Runs in a scratch database, load only reads an empty consensus collection.
+
+Usage: python test_forktree.py config.json
+"""
+import asyncio
+
+from setup import config, use_scratch_database
+from yadacoin.block import BlockHeader
+from yadacoin.chain import CHAIN
+from yadacoin.chainstate import ChainState
+from yadacoin.forktree import ForkTree
+from yadacoin.peers import Peer
+
+
+def make_hash(value):
+    return '{:064x}'.format(value)
+
+
+def header(index, block_hash, prev_hash):
+    return BlockHeader.from_dict({
+        'version': CHAIN.get_version_for_height(index),
+        'time': 1537127756 + index * 600,
+        'index': index,
+        'hash': block_hash,
+        'prevHash': prev_hash,
+        'target': make_hash(CHAIN.MAX_TARGET)
+    })
+
+
+def branch(tree, fork_index, values, prev_hash=None):
+    """Candidates on top of our block at fork_index, or of prev_hash, one hash value per height"""
+    prev_hash = prev_hash or config.chain_state.get_hash(fork_index)
+    blocks = []
+    for i, value in enumerate(values):
+        block = header(fork_index + 1 + i, make_hash(value), prev_hash)
+        tree.add(block)
+        blocks.append(block)
+        prev_hash = block.hash
+    return blocks
+
+
+async def main():
+    use_scratch_database('test_forktree')
+    config.chain_state = ChainState()
+    for index in range(31):
+        config.chain_state.append(make_hash(CHAIN.MAX_TARGET - 1000 - index))
+    me = Peer(None, None, is_me=True)
+
+    # get_work: chainwork at the fork point plus the work of the branch, None when it does not link
+    tree = ForkTree(None)
+    weak = branch(tree, 27, [CHAIN.MAX_TARGET - 10 - i for i in range(4)])
+    base = await config.chain_state.get_chainwork(27)
+    assert await tree.get_work(weak[-1].hash) == base + 10 + 11 + 12 + 13
+    assert tree.nodes[weak[0].hash].work == base + 10, 'work of the ancestors is cached'
+    orphan = header(29, make_hash(5), make_hash(6))
+    tree.add(orphan)
+    assert await tree.get_work(orphan.hash) is None
+    loop = header(29, make_hash(7), make_hash(7))
+    tree.add(loop)
+    assert await tree.get_work(loop.hash) is None, 'a parent at the wrong height ends the walk'
+
+    # get_branch: ascending blocks after the fork point, empty when an ancestor is missing
+    assert [block.index for block in await tree.get_branch(weak[-1], me)] == [28, 29, 30, 31]
+    assert await tree.get_branch(orphan, me) == []
+    assert await tree.get_branch(header(31, make_hash(8), make_hash(9)), me) == []
+
+    # A branch forking deeper than MAX_RETRACE_DEPTH is ignored
+    deep = branch(tree, 5, [CHAIN.MAX_TARGET - 200 - i for i in range(26)])
+    assert CHAIN.MAX_RETRACE_DEPTH < 26
+    assert await tree.get_branch(deep[-1], me) == []
+
+    # best_tip: the descendants with the most work, not the longest
+    tree = ForkTree(None)
+    fork = branch(tree, 27, [CHAIN.MAX_TARGET - 100])
+    long = branch(tree, 28, [CHAIN.MAX_TARGET - 1, CHAIN.MAX_TARGET - 2, CHAIN.MAX_TARGET - 3], fork[0].hash)
+    heavy = header(29, make_hash(CHAIN.MAX_TARGET - 500), fork[0].hash)
+    tree.add(heavy)
+    assert [block.hash for block in tree.best_tip(fork[0])] == [heavy.hash]
+    assert [block.index for block in tree.best_tip(long[0])] == [30, 31]
+    assert tree.best_tip(heavy) == []
+
+    # prune: candidates more than MAX_RETRACE_DEPTH below our tip go, with their children entries
+    tree = ForkTree(None)
+    old = branch(tree, 2, [CHAIN.MAX_TARGET - 30, CHAIN.MAX_TARGET - 31])
+    recent = branch(tree, 25, [CHAIN.MAX_TARGET - 40])
+    tree.prune()
+    assert set(tree.nodes) == {recent[0].hash}
+    assert old[0].prev_hash not in tree.children and old[0].hash not in tree.children
+    assert tree.children == {recent[0].prev_hash: {recent[0].hash}}
+
+    # add prunes once MAX_NODES is reached
+    tree = ForkTree(None)
+    tree.MAX_NODES = 2
+    branch(tree, 2, [CHAIN.MAX_TARGET - 50])
+    kept = branch(tree, 26, [CHAIN.MAX_TARGET - 60, CHAIN.MAX_TARGET - 61])
+    assert set(tree.nodes) == {block.hash for block in kept}
+
+    # Spam within retrace reach: a full tree refuses the weakest, a heavier one evicts the weakest leaf
+    tree = ForkTree(None)
+    tree.MAX_NODES = 3
+    base = branch(tree, 28, [CHAIN.MAX_TARGET - 300, CHAIN.MAX_TARGET - 301])
+    side = branch(tree, 29, [CHAIN.MAX_TARGET - 302])
+    for value in range(100):
+        assert tree.add(header(30, make_hash(CHAIN.MAX_TARGET - value), base[0].hash)) is None
+    assert len(tree.nodes) == 3
+    heavy = header(30, make_hash(CHAIN.MAX_TARGET - 400), base[0].hash)
+    assert tree.add(heavy) is not None
+    assert set(tree.nodes) == {base[0].hash, side[0].hash, heavy.hash}, 'the weakest leaf goes, not its parent'
+    print('fork tree ok')
+
+
+asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,96 @@
+"""
+Headers-first sync from a peer serving a chain mined locally.
+
+The peer's chain is mined in a scratch database, which is then emptied and synced from the peer
+through a made up http client. The peer fails the second body range: the first range stays
+inserted and is announced, as after any sync that inserted blocks.
+
+Usage: python test_headersync.py config.json
+"""
+import asyncio
+import json
+from types import SimpleNamespace
+from urllib.parse import urlparse, parse_qs
+
+from setup import config, use_scratch_database
+from yadacoin.block import BlockFactory
+from yadacoin.chain import CHAIN
+from yadacoin.consensus import Consensus
+from yadacoin.headersync import HeaderSync
+from yadacoin.peers import Peers
+
+
+class PeerClient(object):
+    """Answers /get-height, /get-headers and /get-blocks from chain, made up hashes for failed_range"""
+    def __init__(self, chain, failed_range):
+        self.chain = chain
+        self.failed_range = failed_range
+
+    async def fetch(self, request):
+        url = urlparse(request.url)
+        query = {key: int(value[0]) for key, value in parse_qs(url.query).items()}
+        if url.path == '/get-height':
+            body = {'height': self.chain[-1]['index'], 'hash': self.chain[-1]['hash']}
+        else:
+            blocks = [block for block in self.chain if query['start_index'] <= block['index'] <= query['end_index']]
+            if url.path == '/get-headers':
+                body = [{key: block[key] for key in HeaderSync.PROJECTION if key in block} for block in blocks]
+            else:
+                body = [dict(block) for block in blocks]
+                if query['start_index'] == self.failed_range:
+                    body[0]['hash'] = 'ff' * 32
+        return SimpleNamespace(code=200, body=json.dumps(body).encode())
+
+
+async def start_node(name):
+    use_scratch_database(name)
+    config.peers = Peers()
+    config.consensus = Consensus(False, config.peers)
+    await config.consensus.async_init()
+    return config.consensus
+
+
+async def mine(consensus, index, block_time):
+    factory = await BlockFactory.generate(config, [], config.public_key, config.private_key, index=index, force_time=block_time)
+    block = factory.block
+    header = BlockFactory.generate_header(block)
+    nonce, block_hash = BlockFactory.mine(index, header, block.target, [0, 1000000])
+    block.hash = block_hash
+    block.nonce = str(nonce)
+    block.header = header
+    block.signature = config.BU.generate_signature(block_hash, config.private_key)
+    assert await consensus.integrate_block_with_existing_chain(block)
+
+
+async def main():
+    CHAIN.MAX_BLOCKS_PER_MESSAGE = 5
+    consensus = await start_node('test_headersync')
+    start = int((await config.BU.get_latest_block_async())['time'])
+    for index in range(1, 13):
+        await mine(consensus, index, start + index * 600)
+    chain = [block async for block in config.mongo.async_db.blocks.find({}, {'_id': 0}).sort([('index', 1)])]
+
+    # Fresh node, bodies 6 to 10 fail
+    consensus = await start_node('test_headersync')
+    assert (await config.BU.get_latest_block_async())['index'] == 0
+    config.http_client = PeerClient(chain, failed_range=6)
+    events = []
+
+    async def trigger_update_event():
+        events.append((await config.BU.get_latest_block_async())['index'])
+    consensus.trigger_update_event = trigger_update_event
+
+    assert await HeaderSync().sync(['127.0.0.1:8000'])
+    latest = await config.BU.get_latest_block_async()
+    assert latest['index'] == 5 and latest['hash'] == chain[5]['hash']
+    assert events == [5], 'blocks inserted before the failed range were not announced'
+
+    # Nothing inserted, nothing announced
+    events.clear()
+    config.http_client = PeerClient(chain, failed_range=6)
+    assert not await HeaderSync().sync(['127.0.0.1:8000'])
+    assert events == []
+    print('header sync ok')
+
+
+asyncio.get_event_loop().run_until_complete(main())
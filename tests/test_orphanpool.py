@@ -0,0 +1,100 @@
+"""
+OrphanPool bounds and connecting buffered blocks.
+
+Eviction, pop_children and expiry run on made up block dicts. Connect imports blocks mined on top of
+each other in a scratch database, nothing of the node's is touched.
+
+Usage: python test_orphanpool.py config.json
+"""
+import asyncio
+import json
+
+from setup import config, use_scratch_database
+from yadacoin.block import BlockFactory
+from yadacoin.consensus import Consensus
+from yadacoin.orphanpool import OrphanPool
+from yadacoin.peers import Peer, Peers
+
+
+def orphan(index, parent=None):
+    return {'index': index, 'hash': 'hash{}'.format(index), 'prevHash': parent or 'hash{}'.format(index - 1)}
+
+
+async def mine(index, block_time, previous):
+    """A block on top of the previous block dict"""
+    config.BU.set_latest_block(previous)
+    factory = await BlockFactory.generate(config, [], config.public_key, config.private_key, index=index, force_time=block_time)
+    config.BU.set_latest_block(None)
+    block = factory.block
+    header = BlockFactory.generate_header(block)
+    nonce, block_hash = BlockFactory.mine(index, header, block.target, [0, 1000000])
+    block.hash = block_hash
+    block.nonce = str(nonce)
+    block.header = header
+    block.signature = config.BU.generate_signature(block_hash, config.private_key)
+    return block
+
+
+async def main():
+    use_scratch_database('test_orphanpool')
+
+    # Count bound, the oldest go first along with their children entries
+    pool = OrphanPool(max_count=3)
+    for index in range(1, 6):
+        assert pool.add(orphan(index), 'peer')
+    assert [block['index'] for block, peer, size, added in pool.blocks.values()] == [3, 4, 5]
+    assert set(pool.children) == {'hash2', 'hash3', 'hash4'}
+    assert not pool.add(orphan(5), 'peer'), 'already buffered'
+    assert not pool.add({'index': 6, 'hash': 'hash6'}, 'peer'), 'no prevHash'
+
+    # Byte bound
+    size = len(json.dumps(orphan(1)))
+    pool = OrphanPool(max_bytes=size * 2 + 1)
+    for index in range(1, 4):
+        pool.add(orphan(index), 'peer')
+    assert list(pool.blocks) == ['hash2', 'hash3'] and pool.size == size * 2
+    assert not pool.add(dict(orphan(9), padding='x' * size * 2), 'peer'), 'bigger than the pool'
+    assert list(pool.blocks) == ['hash2', 'hash3']
+
+    # pop_children hands the competing children of a hash and removes them
+    pool = OrphanPool()
+    pool.add(orphan(2), 'peer1')
+    pool.add(dict(orphan(2), hash='hash2b'), 'peer2')
+    pool.add(orphan(3), 'peer1')
+    children = pool.pop_children('hash1')
+    assert sorted((block['hash'], peer) for block, peer in children) == [('hash2', 'peer1'), ('hash2b', 'peer2')]
+    assert list(pool.blocks) == ['hash3'] and 'hash1' not in pool.children
+    assert pool.pop_children('hash1') == []
+    assert pool.get_status() == {'count': 1, 'bytes': len(json.dumps(orphan(3)))}
+
+    # Expiry
+    pool.EXPIRY = -1
+    assert pool.pop_children('hash2') == [] and pool.get_status() == {'count': 0, 'bytes': 0}
+    assert pool.children == {}
+
+    # connect imports the buffered descendants of our tip one height after the other
+    config.peers = Peers()
+    config.consensus = Consensus(False, config.peers)
+    await config.consensus.async_init()
+    config.orphan_pool = OrphanPool()
+    previous = await config.BU.get_latest_block_async()
+    start = int(previous['time'])
+    blocks = []
+    for index in range(1, 5):
+        block = await mine(index, start + index * 600, previous)
+        blocks.append(block)
+        previous = block.to_dict()
+    peer_string = Peer('127.0.0.1', 8000).to_string()
+    for block in blocks[1:]:
+        assert config.orphan_pool.add(block.to_dict(), peer_string)
+    assert await config.consensus.integrate_block_with_existing_chain(blocks[0])
+    await config.orphan_pool.connect()
+    await asyncio.sleep(0.1)
+    latest = await config.BU.get_latest_block_async()
+    assert latest['index'] == 4 and latest['hash'] == blocks[-1].hash
+    assert config.orphan_pool.get_status() == {'count': 0, 'bytes': 0}
+    assert not config.peers.syncing
+    print('orphan pool ok')
+
+
+asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,160 @@
+"""
+Differential test for the HeaderCache / RetargetEngine based retarget.
+
+Replays the local chain and, for every height, compares BlockFactory.get_target_10min and
+BlockFactory.get_target with a reference that reads full blocks from the db, the way they
+did before the caches. Rollbacks are exercised along the way.
+
+Usage: python test_retarget_engine.py config.json [start_index] [end_index]
+"""
+import asyncio
+import copy
+import sys
+
+from setup import config
+from yadacoin.block import Block, BlockFactory
+from yadacoin.chain import CHAIN
+from yadacoin.headercache import HeaderCache
+from yadacoin.retarget import RetargetEngine
+
+
+async def reference_get_target_10min(height, last_block, block):
+    max_target = 0x0000ffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff
+    retarget_period = 6 * 5
+    retarget_period2 = int(6 * 1.5)
+    target_time = 10 * 60
+    if int(block.time) - int(last_block.time) > 3600:
+        return int(max_target)
+    current_block_time = int(block.time) - int(last_block.time)
+    adjusted = False
+    if current_block_time > 2 * target_time:
+        latest_target = last_block.target
+        delta = max_target - latest_target
+        adjusted = int(latest_target + delta * current_block_time / 3600)
+    start_index = (await config.BU.get_latest_block_async())['index']
+    blocks = config.mongo.async_db.blocks
+
+    retarget_period_ago = await Block.from_dict(await blocks.find_one({'index': start_index - retarget_period}))
+    average_block_time = (int(block.time) - int(retarget_period_ago.time)) / retarget_period
+    retarget_period2_ago = await Block.from_dict(await blocks.find_one({'index': start_index - retarget_period2}))
+    average_block_time2 = (int(block.time) - int(retarget_period2_ago.time)) / retarget_period2
+
+    if average_block_time2 < target_time:
+        hash_sum2 = 0
+        for i in range(start_index, start_index - retarget_period2, -1):
+            hash_sum2 += (await Block.from_dict(await blocks.find_one({'index': i}))).target
+        target = int(hash_sum2 / retarget_period2 * average_block_time2 / target_time)
+    else:
+        hash_sum = 0
+        for i in range(start_index, start_index - retarget_period, -1):
+            hash_sum += (await Block.from_dict(await blocks.find_one({'index': i}))).target
+        target = int(hash_sum / retarget_period * average_block_time / target_time)
+    if adjusted and adjusted > target:
+        target = adjusted
+    if target < 1:
+        target = 1
+        block.special_min = False
+    if target > max_target:
+        target = max_target
+    return int(target)
+
+
+async def reference_get_target(height, last_block, block):
+    max_target = CHAIN.MAX_TARGET
+    if config.network in ['regnet', 'testnet']:
+        return int(max_target)
+    latest_block = await config.BU.get_latest_block_async()
+    blocks = config.mongo.async_db.blocks
+    retarget_period = CHAIN.RETARGET_PERIOD
+    max_seconds = CHAIN.TWO_WEEKS
+    min_seconds = CHAIN.HALF_WEEK
+    if height >= CHAIN.POW_FORK_V3:
+        retarget_period = CHAIN.RETARGET_PERIOD_V3
+        max_seconds = CHAIN.MAX_SECONDS_V3
+        min_seconds = CHAIN.MIN_SECONDS_V3
+    elif height >= CHAIN.POW_FORK_V2:
+        retarget_period = CHAIN.RETARGET_PERIOD_V2
+        max_seconds = CHAIN.MAX_SECONDS_V2
+        min_seconds = CHAIN.MIN_SECONDS_V2
+    if height > 0 and height % retarget_period == 0:
+        block_from_2016_ago = await Block.from_dict(await blocks.find_one({'index': height - retarget_period}))
+        elapsed_time_from_2016_ago = int(last_block.time) - int(block_from_2016_ago.time)
+        if elapsed_time_from_2016_ago > max_seconds:
+            time_for_target = max_seconds
+        elif elapsed_time_from_2016_ago < min_seconds:
+            time_for_target = min_seconds
+        else:
+            time_for_target = int(elapsed_time_from_2016_ago)
+        block_to_check = last_block
+        if block_to_check.special_min or block_to_check.target == max_target or not block_to_check.target:
+            block_to_check = await Block.from_dict(await blocks.find_one({
+                'index': {'$lte': latest_block['index']},
+                'special_min': False,
+                'target': {'$ne': hex(max_target)[2:]}
+            }, sort=[('index', -1)]))
+        new_target = int((time_for_target * block_to_check.target) / max_seconds)
+        target = max_target if new_target > max_target else new_target
+    elif height == 0:
+        target = max_target
+    else:
+        delta_t = int(block.time) - int(last_block.time)
+        if block.index >= 38600 and delta_t > CHAIN.target_block_time(config.network) and block.special_min:
+            return CHAIN.special_target(block.index, block.target, delta_t, config.network)
+        block_to_check = last_block
+        start_index = latest_block['index']
+        while 1:
+            if start_index == 0:
+                return block_to_check.target
+            if block_to_check.special_min or block_to_check.target == max_target or not block_to_check.target:
+                block_to_check = await Block.from_dict(await blocks.find_one({'index': start_index}))
+                start_index -= 1
+            else:
+                target = block_to_check.target
+                break
+    return int(target)
+
+
+async def main():
+    latest = config.mongo.db.blocks.find_one({}, sort=[('index', -1)])
+    start_index = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    end_index = int(sys.argv[3]) if len(sys.argv) > 3 else latest['index']
+    # Small sizes so the db fallbacks get exercised too
+    config.header_cache = HeaderCache(size=64)
+    config.retarget_engine = RetargetEngine(size=64)
+    for block in config.mongo.db.blocks.find({'index': {'$gte': max(start_index - 64, 0), '$lt': start_index}}).sort([('index', 1)]):
+        config.header_cache.append(HeaderCache.from_dict(block))
+        config.retarget_engine.append(HeaderCache.from_dict(block))
+
+    checked = 0
+    for height in range(start_index, end_index + 1):
+        block_dict = config.mongo.db.blocks.find_one({'index': height}, {'_id': 0})
+        last_block_dict = config.mongo.db.blocks.find_one({'index': height - 1}, {'_id': 0})
+        config.BU.set_latest_block(last_block_dict)
+        last_block = await Block.from_dict(copy.deepcopy(last_block_dict))
+        for name, reference in (('get_target_10min', reference_get_target_10min), ('get_target', reference_get_target)):
+            if name == 'get_target_10min' and height <= 30:
+                continue
+            block = await Block.from_dict(copy.deepcopy(block_dict))
+            block_ref = await Block.from_dict(copy.deepcopy(block_dict))
+            result = await getattr(BlockFactory, name)(height, last_block, block)
+            expected = await reference(height, last_block, block_ref)
+            if result != expected or block.special_min != block_ref.special_min:
+                raise Exception('{} mismatch at {}: {:064x} != {:064x}'.format(name, height, result, expected))
+            checked += 1
+
+        header = HeaderCache.from_dict(block_dict)
+        config.header_cache.append(header)
+        config.retarget_engine.append(header)
+        if height % 100 == 0:
+            # Rollback the last 10 headers, then apply them again
+            await config.header_cache.on_blocks_removed(height - 9)
+            await config.retarget_engine.on_blocks_removed(height - 9)
+            for block in config.mongo.db.blocks.find({'index': {'$gte': height - 9, '$lte': height}}).sort([('index', 1)]):
+                config.header_cache.append(HeaderCache.from_dict(block))
+                config.retarget_engine.append(HeaderCache.from_dict(block))
+        if height % 1000 == 0:
+            print('{} ok'.format(height))
+    print('{} targets checked from {} to {}, all identical'.format(checked, start_index, end_index))
+
+
+asyncio.get_event_loop().run_until_complete(main())
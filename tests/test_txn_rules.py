@@ -34,6 +34,9 @@ class TestTxnRuls(object):
         yadacoin.blockchainutils.set_BU(BU)
         self.configs[name].BU = BU
         self.configs[name].GU = GU()
+        self.configs[name].chain_state = ChainState()
+        self.configs[name].header_cache = HeaderCache()
+        self.configs[name].retarget_engine = RetargetEngine()
         self.configs[name].TU = TU
         consensus = Consensus(prevent_genesis=True)
         self.configs[name].consensus = consensus
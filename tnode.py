@@ -9,8 +9,6 @@ import os
 import ssl
 import ntpath
 import webbrowser
-import pyrx
-from traceback import format_exc
 from asyncio import sleep as async_sleep
 from hashlib import sha256
 from logging.handlers import RotatingFileHandler
@@ -32,6 +30,17 @@ import yadacoin.blockchainutils
 import yadacoin.transactionutils
 import yadacoin.config
 from yadacoin.crypt import Crypt
+from yadacoin.chainindex import ChainIndex
+from yadacoin.chainstate import ChainState
+from yadacoin.headercache import HeaderCache
+from yadacoin.retarget import RetargetEngine
+from yadacoin.rxhasher import RandomXHasher
+from yadacoin.addresscache import AddressCache
+from yadacoin.cacheinvalidator import CacheInvalidator
+from yadacoin.sigverifier import SignatureVerifier
+from yadacoin.verifyexecutor import VerifyExecutor
+from yadacoin.blockimporter import BlockImporter
+from yadacoin.orphanpool import OrphanPool
 from yadacoin.consensus import Consensus
 from yadacoin.chain import CHAIN
 from yadacoin.explorerhandlers import EXPLORER_HANDLERS
@@ -110,7 +119,7 @@ async def background_consensus():
         await config.consensus.async_init()
         if options.verify:
             app_log.info("Verifying existing blockchain")
-            await config.consensus.verify_existing_blockchain(reset=config.reset)
+            await config.consensus.verify_existing_blockchain(reset=config.reset, full=options.full_verify)
         else:
             app_log.info("Verification of existing blockchain skipped by config")
     if config.polling <= 0:
@@ -160,6 +169,17 @@ async def background_status():
         app_log.error("{} in Background_status".format(e))
 
 
+def background_loop_lag(expected=None):
+    """Measures how late the IOLoop runs a callback scheduled one second ahead.
+    Anything blocking the loop (sync db calls, cpu bound work) shows up here, reported by background_status."""
+    now = time()
+    if expected:
+        lag = max(0.0, now - expected)
+        config.loop_lag = lag
+        config.max_loop_lag = max(config.max_loop_lag, lag)
+    tornado.ioloop.IOLoop.current().call_later(1, background_loop_lag, now + 1)
+
+
 async def background_transaction_broadcast():
     """This background co-routine is responsible for disseminating transactions to the network"""
     if config.txn_broadcast_busy:
@@ -233,60 +253,6 @@ async def background_pool_payer():
     except Exception as e:
         app_log.error("{} in background_pool_payer".format(e))
 
-async def background_cache_validator():
-    """Responsible for validating the cache and clearing it when necessary"""
-    if config.cache_busy:
-        return
-    config.cache_busy = True
-    if not hasattr(config, 'cache_inited'):
-        config.cache_collections = [x for x in await config.mongo.async_db.list_collection_names({}) if x.endswith('_cache')]
-        config.cache_last_times = {}
-        try:
-            async for x in config.mongo.async_db.blocks.find({'updated_at': {'$exists': False}}):
-                config.mongo.async_db.blocks.update_one({'index': x['index']}, {'$set': {'updated_at': time()}})
-            for cache_collection in config.cache_collections:
-                config.cache_last_times[cache_collection] = 0
-                await config.mongo.async_db[cache_collection].delete_many({'cache_time': {'$exists': False}})
-            config.cache_inited = True
-        except Exception as e:
-            app_log.error("{} in background_cache_validator init".format(e))
-
-    """
-    We check for cache items that are not currently in the blockchain
-    If not, we delete the cached item.
-    """
-    try:
-        for cache_collection in config.cache_collections:
-            if not config.cache_last_times.get(cache_collection):
-                latest = await config.mongo.async_db[cache_collection].find_one({
-                    'cache_time': {'$gt': config.cache_last_times[cache_collection]}
-                }, sort=[('height', -1)])
-                if latest:
-                    config.cache_last_times[cache_collection] = latest['cache_time']
-                else:
-                    config.cache_last_times[cache_collection] = 0
-            async for txn in config.mongo.async_db[cache_collection].find({
-                'cache_time': {'$gt': config.cache_last_times[cache_collection]}
-            }).sort([('height', -1)]):
-                if not await config.mongo.async_db.blocks.find_one({
-                    'index': txn.get('height'),
-                    'hash': txn.get('block_hash')
-                }) and not await config.mongo.async_db.miner_transactions.find_one({
-                    'id': txn.get('id'),
-                }):
-                    await config.mongo.async_db[cache_collection].delete_many({
-                        'height': txn.get('height')
-                    })
-                    break
-                else:
-                    if txn['cache_time'] > config.cache_last_times[cache_collection]:
-                        config.cache_last_times[cache_collection] = txn['cache_time']
-
-        config.cache_busy = False
-    except Exception as e:
-        app_log.error("error in background_cache_validator")
-        app_log.error(format_exc())
-
 
 def configure_logging():
     global app_log, access_log
@@ -332,6 +298,7 @@ def main():
     define("config", default='config/config.json', help="Config file location, default is 'config/config.json'",
            type=str)
     define("verify", default=True, help="Verify chain, default True", type=bool)
+    define("full_verify", default=False, help="Verify the whole chain again, in parallel, instead of resuming from the last verified block", type=bool)
     define("webonly", default=False, help="Web only (ignores node processes for faster init when restarting server frequently), default False", type=bool)
     define("disable-web", default=False, help="Disable web server", type=bool)
 
@@ -375,7 +342,8 @@ def main():
 
     config.cipher = Crypt(config.wif)
 
-    config.pyrx = pyrx.PyRX()
+    config.rx_hasher = RandomXHasher()
+    config.address_cache = AddressCache()
     config.reset = options.reset
 
     config.disable_web = options.disable_web
@@ -423,6 +391,15 @@ def main():
         config.TU = yadacoin.transactionutils.TU
         yadacoin.blockchainutils.set_BU(config.BU)  # To be removed
         config.GU = GraphUtils()
+        config.chain_state = ChainState()
+        config.chain_index = ChainIndex()
+        config.header_cache = HeaderCache()
+        config.retarget_engine = RetargetEngine()
+        config.cache_invalidator = CacheInvalidator()
+        config.sig_verifier = SignatureVerifier()
+        config.verify_executor = VerifyExecutor()
+        config.block_importer = BlockImporter()
+        config.orphan_pool = OrphanPool()
 
         config.consensus = None
 
@@ -446,10 +423,9 @@ def main():
             config.ns_broadcast_busy = False
         tornado.ioloop.PeriodicCallback(background_status, 30000).start()
         config.status_busy = False
+        background_loop_lag()
         tornado.ioloop.PeriodicCallback(background_pool, 30000).start()
         config.pool_busy = False
-        tornado.ioloop.PeriodicCallback(background_cache_validator, 30000).start()
-        config.cache_busy = False
         if config.pool_payout:
             app_log.info("PoolPayout activated")
             pp = PoolPayer()
@@ -1,6 +1,8 @@
+from .addresscache import AddressCache
 from .block import (
     Block,
     BlockFactory,
+    BlockHeader,
     CoinbaseRule1,
     CoinbaseRule2,
     CoinbaseRule3,
@@ -12,7 +14,15 @@ from .block import (
 )
 from .blockchain import Blockchain, BlockChainException
 from .blockchainutils import BU
+from .blockimporter import BlockImporter
+from .cacheinvalidator import CacheInvalidator
+from .cachewriter import CacheWriter
 from .chain import CHAIN
+from .chainindex import ChainIndex
+from .chainstate import ChainState
+from .headercache import HeaderCache
+from .retarget import RetargetEngine
+from .rxhasher import RandomXHasher
 from .config import Config
 from .consensus import Consensus
 from .crypt import Crypt
@@ -22,8 +32,10 @@ from .graphutils import GraphUtils as GU
 from .miningpool import MiningPool, MissingInputTransactionException
 from .miningpoolpayout import PoolPayer, NonMatchingDifficultyException, NotEnoughMoneyException, PartialPayoutException
 from .mongo import Mongo
+from .orphanpool import OrphanPool
 from .peers import Peers, Peer
 from .send import Send
+from .sigverifier import SignatureVerifier
 from .transaction import (
     Transaction,
     TransactionFactory,
@@ -35,4 +47,5 @@ from .transaction import (
     InvalidTransactionSignatureException
 )
 from .transactionutils import TU
+from .verifyexecutor import VerifyExecutor
 from .wallet import Wallet
\ No newline at end of file
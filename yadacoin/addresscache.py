@@ -0,0 +1,74 @@
+"""
+Bounded cache of public key to address derivations.
+
+P2PKHBitcoinAddress.from_pubkey does a hex decode, sha256, ripemd160 and base58 encoding. It ran for
+every transaction of every block loaded, every output checked by Transaction.verify and every
+candidate of the wallet queries, while blocks and transactions keep coming from the same few hundred
+keys. AddressCache keeps the latest SIZE derivations, least recently used out first, and counts hits
+and misses for the status.
+Shared by the IOLoop and the verify executor threads, so it is lock protected.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+
+from bitcoin.wallet import P2PKHBitcoinAddress
+
+from yadacoin.config import get_config
+
+
+class AddressCache(object):
+    SIZE = 4096
+
+    def __init__(self, size=None):
+        self.config = get_config()
+        self.size = size or getattr(self.config, 'address_cache_size', 0) or self.SIZE
+        # public_key: address, least recently used first
+        self.addresses = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def get(cls):
+        """The node wide cache, created on first use where tnode did not set one (worker processes, tools)"""
+        config = get_config()
+        if not getattr(config, 'address_cache', None):
+            config.address_cache = cls()
+        return config.address_cache
+
+    @classmethod
+    def address(cls, public_key: str) -> str:
+        """Address of a hex public key, through the node wide cache"""
+        return cls.get().from_public_key(public_key)
+
+    def from_public_key(self, public_key: str) -> str:
+        with self.lock:
+            address = self.addresses.get(public_key)
+            if address is not None:
+                self.addresses.move_to_end(public_key)
+                self.hits += 1
+                return address
+        # Derived outside of the lock, a concurrent miss on the same key only costs a duplicate derivation
+        address = str(P2PKHBitcoinAddress.from_pubkey(bytes.fromhex(public_key)))
+        with self.lock:
+            self.misses += 1
+            self.addresses[public_key] = address
+            self.addresses.move_to_end(public_key)
+            while len(self.addresses) > self.size:
+                self.addresses.popitem(last=False)
+        return address
+
+    def clear(self):
+        with self.lock:
+            self.addresses.clear()
+
+    def get_status(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.addresses),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0
+            }
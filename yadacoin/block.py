@@ -3,19 +3,22 @@ import hashlib
 import base64
 import time
 import binascii
-import pyrx
 
 from sys import exc_info
 from os import path
 from decimal import Decimal, getcontext
 from bitcoin.signmessage import BitcoinMessage, VerifyMessage
-from bitcoin.wallet import P2PKHBitcoinAddress
 from coincurve.utils import verify_signature
 from logging import getLogger
 
+from yadacoin.addresscache import AddressCache
 from yadacoin.chain import CHAIN
+from yadacoin.chainstate import ChainState
 from yadacoin.config import get_config
 from yadacoin.fastgraph import FastGraph
+from yadacoin.headercache import HeaderCache
+from yadacoin.retarget import RetargetEngine
+from yadacoin.rxhasher import RandomXHasher
 from yadacoin.transaction import (
     TransactionFactory,
     Transaction,
@@ -60,8 +63,6 @@ class ExternalInputSpentException(Exception):
 
 
 class BlockFactory(object):
-    pyrx = None
-    cores = 10
     @classmethod
     async def generate(cls, config, transactions, public_key, private_key, force_version=None, index=None, force_time=None):
         try:
@@ -79,12 +80,22 @@ class BlockFactory(object):
             if index == 0:
                 prev_hash = ''
             else:
-                prev_hash = config.BU.get_latest_block()['hash']
+                prev_hash = (await config.BU.get_latest_block_async())['hash']
 
             transaction_objs = []
             fee_sum = 0.0
             used_sigs = []
             used_inputs = {}
+            spent_inputs = await config.BU.are_inputs_spent_async([
+                (x['id'] if isinstance(x, dict) else x.id, txn['public_key'] if isinstance(txn, dict) else txn.public_key)
+                for txn in transactions
+                for x in (txn.get('inputs', []) if isinstance(txn, dict) else txn.inputs)
+            ])
+            input_txns = await config.BU.get_transactions_by_ids_async([
+                x['id'] if isinstance(x, dict) else x.id
+                for txn in transactions
+                for x in (txn.get('inputs', []) if isinstance(txn, dict) else txn.inputs)
+            ])
             for txn in transactions:
                 try:
                     if isinstance(txn, FastGraph):
@@ -96,6 +107,7 @@ class BlockFactory(object):
                         print('duplicate transaction found and removed')
                         continue
 
+                    transaction_obj.input_txns = input_txns
                     if not transaction_obj.verify():
                         raise InvalidTransactionException("invalid transactions")
 
@@ -112,13 +124,14 @@ class BlockFactory(object):
                             print('duplicate transaction found and removed')
                             continue
 
+                        transaction_obj.input_txns = input_txns
                         transaction_obj.verify()
                         used_sigs.append(transaction_obj.transaction_signature)
                     except:
                         raise InvalidTransactionException("invalid transactions")
                 try:
                     if int(index) > CHAIN.CHECK_TIME_FROM and (int(transaction_obj.time) > int(xtime) + CHAIN.TIME_TOLERANCE):
-                        config.mongo.db.miner_transactions.remove({'id': transaction_obj.transaction_signature}, multi=True)
+                        await config.mongo.async_db.miner_transactions.delete_many({'id': transaction_obj.transaction_signature})
                         app_log.debug("Block embeds txn too far in the future")
                         continue
                     
@@ -126,7 +139,7 @@ class BlockFactory(object):
                         failed = False
                         used_ids_in_this_txn = []
                         for x in transaction_obj.inputs:
-                            if get_config().BU.is_input_spent(x.id, transaction_obj.public_key):
+                            if (x.id, transaction_obj.public_key) in spent_inputs:
                                 failed = True
                             if x.id in used_ids_in_this_txn:
                                 failed = True
@@ -154,7 +167,7 @@ class BlockFactory(object):
                 private_key=private_key,
                 outputs=[{
                     'value': block_reward + float(fee_sum),
-                    'to': str(P2PKHBitcoinAddress.from_pubkey(bytes.fromhex(public_key)))
+                    'to': AddressCache.address(public_key)
                 }],
                 coinbase=True
             )
@@ -211,12 +224,9 @@ class BlockFactory(object):
 
     @classmethod
     def generate_hash_from_header(cls, height, header, nonce):
-        if not cls.pyrx:
-            cls.pyrx = pyrx.PyRX()
         header = header.format(nonce=nonce)
         if height >= CHAIN.RANDOMX_FORK:
-            seed_hash = binascii.unhexlify('4181a493b397a733b083639334bc32b407915b9a82b7917ac361816f0a1f5d4d') #sha256(yadacoin65000)
-            bh = cls.pyrx.get_rx_hash(header, seed_hash, height, cls.cores)
+            bh = RandomXHasher.get().hash(header, height)
             hh = binascii.hexlify(bh).decode()
             return hh
         else:
@@ -243,8 +253,9 @@ class BlockFactory(object):
     async def get_target_10min(
         self,
         height,
-        last_block,  # This is the latest on chain block we have in db
-        block  # This is the block we are currently mining, not on chain yet, with current time in it.
+        last_block,  # The block before the one we check, usually our latest. Windows are read below it, by height.
+        block,  # This is the block we are currently mining, not on chain yet, with current time in it.
+        retarget_engine=None  # Where the windows are read, the node's unless given
     ):
         # Aim at 5 min average block time, with escape hatch
         max_target = 0x0000ffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff  # A single cpu does that under a minute.
@@ -266,32 +277,27 @@ class BlockFactory(object):
             # print("adjust", current_block_time, MinerSimulator.HEX(new_target), latest_target)
             adjusted = new_target
             # To be used later on, once the rest is calc'd
-        latest_block = await get_config().BU.get_latest_block_async()
-        start_index = latest_block['index']
+        start_index = last_block.index
+        retarget_engine = retarget_engine or get_config().retarget_engine
+        headers = retarget_engine.headers
 
-        block_from_retarget_period_ago = await Block.from_dict(await get_config().mongo.async_db.blocks.find_one({'index': start_index-retarget_period}))
+        block_from_retarget_period_ago = await headers.get_header(start_index-retarget_period)
         retarget_period_ago_time = block_from_retarget_period_ago.time
         elapsed_time_from_retarget_period_ago = int(block.time) - int(retarget_period_ago_time)
         average_block_time = elapsed_time_from_retarget_period_ago / retarget_period
 
-        block_from_retarget_period2_ago = await Block.from_dict(await get_config().mongo.async_db.blocks.find_one({'index': start_index-retarget_period2}))
+        block_from_retarget_period2_ago = await headers.get_header(start_index-retarget_period2)
         retarget_period2_ago_time = block_from_retarget_period2_ago.time
         elapsed_time_from_retarget_period2_ago = int(block.time) - int(retarget_period2_ago_time)
         average_block_time2 = elapsed_time_from_retarget_period2_ago / retarget_period2
 
         # React faster to a drop in block time than to a raise. short block times are more a threat than large ones.
         if average_block_time2 < target_time:
-            hash_sum2 = 0
-            for i in range(start_index, start_index - retarget_period2, -1):
-                block_tmp = await Block.from_dict(await get_config().mongo.async_db.blocks.find_one({'index': i}))
-                hash_sum2 += block_tmp.target
+            hash_sum2 = await retarget_engine.get_target_sum(start_index, retarget_period2)
             average_target = hash_sum2 / retarget_period2
             target = int(average_target * average_block_time2 / target_time)
         else:
-            hash_sum = 0
-            for i in range(start_index, start_index - retarget_period, -1):
-                block_tmp = await Block.from_dict(await get_config().mongo.async_db.blocks.find_one({'index': i}))
-                hash_sum += block_tmp.target
+            hash_sum = await retarget_engine.get_target_sum(start_index, retarget_period)
             average_target = hash_sum / retarget_period
             # This adjusts both ways
             target = int(average_target * average_block_time / target_time)
@@ -311,14 +317,14 @@ class BlockFactory(object):
         return int(target)
 
     @classmethod
-    async def get_target(cls, height, last_block, block) -> int:
+    async def get_target(cls, height, last_block, block, retarget_engine=None) -> int:
         try:
+            retarget_engine = retarget_engine or get_config().retarget_engine
             # change target
             max_target = CHAIN.MAX_TARGET
             if get_config().network in ['regnet', 'testnet']:
                 return int(max_target)
 
-            latest_block = await get_config().BU.get_latest_block_async()
             max_block_time = CHAIN.target_block_time(get_config().network)
             retarget_period = CHAIN.RETARGET_PERIOD  # blocks
             max_seconds = CHAIN.TWO_WEEKS  # seconds
@@ -334,7 +340,7 @@ class BlockFactory(object):
             if height > 0 and height % retarget_period == 0:
                 get_config().debug_log(
                     "RETARGET get_target height {} - last_block {} - block {}/time {}".format(height, last_block.index, block.index, block.time))
-                block_from_2016_ago = await Block.from_dict(get_config().BU.get_block_by_index(height - retarget_period))
+                block_from_2016_ago = await retarget_engine.headers.get_header(height - retarget_period)
                 get_config().debug_log(
                     "Block_from_2016_ago - block {}/time {}".format(block_from_2016_ago.index, block_from_2016_ago.time))
                 two_weeks_ago_time = block_from_2016_ago.time
@@ -352,23 +358,11 @@ class BlockFactory(object):
 
                 block_to_check = last_block
 
-                start_index = latest_block['index']
+                start_index = last_block.index
 
                 get_config().debug_log("start_index {}".format(start_index))
-                if block_to_check.special_min or block_to_check.target == max_target or not block_to_check.target:
-                    block_to_check = await Block.from_dict(await get_config().mongo.async_db.blocks.find_one({
-                        '$and': [
-                            {
-                                'index': {'$lte': start_index}
-                            },
-                            {
-                                'special_min': False
-                            },
-                            {
-                                'target': { '$ne': hex(max_target)[2:]}
-                            }
-                        ]
-                    }, sort=[('index', -1)]))
+                if not RetargetEngine.is_usable(block_to_check):
+                    block_to_check = await retarget_engine.get_last_regular(start_index)
                 target = block_to_check.target
                 get_config().debug_log("start_index2 {}, target {}".format(block_to_check.index, hex(int(target))[2:].rjust(64, '0')))
 
@@ -391,17 +385,12 @@ class BlockFactory(object):
 
                 block_to_check = last_block  # this would be accurate. right now, it checks if the current block is under its own target, not the previous block's target
 
-                start_index = latest_block['index']
+                start_index = last_block.index
 
-                while 1:
-                    if start_index == 0:
-                        return block_to_check.target
-                    if block_to_check.special_min or block_to_check.target == max_target or not block_to_check.target:
-                        block_to_check = await Block.from_dict(await get_config().mongo.async_db.blocks.find_one({'index': start_index}))
-                        start_index -= 1
-                    else:
-                        target = block_to_check.target
-                        break
+                if start_index == 0 or RetargetEngine.is_usable(block_to_check):
+                    return block_to_check.target
+                block_to_check = await retarget_engine.get_last_usable(start_index)
+                target = block_to_check.target
             return int(target)
         except Exception as e:
             import sys, os
@@ -466,9 +455,9 @@ class BlockFactory(object):
 class Block(object):
 
     # Memory optimization
-    __slots__ = ('app_log', 'config', 'mongo', 'version', 'time', 'index', 'prev_hash', 'nonce', 'transactions', 'txn_hashes',
-                 'merkle_root', 'verify_merkle_root','hash', 'public_key', 'signature', 'special_min', 'target',
-                 'special_target', 'header')
+    __slots__ = ('app_log', 'config', 'mongo', 'version', 'time', 'index', 'prev_hash', 'nonce', '_transactions',
+                 'transaction_dicts', 'txn_hashes', 'merkle_root', 'verify_merkle_root','hash', 'public_key', 'signature',
+                 'special_min', 'target', 'special_target', 'header', 'signature_verified', 'merkle_root_verified', 'verified')
     
     @classmethod
     async def init_async(
@@ -505,19 +494,25 @@ class Block(object):
         self.hash = block_hash
         self.public_key = public_key
         self.signature = signature
+        # Set by SignatureVerifier once the signature passed a batch check
+        self.signature_verified = False
+        # Set once the merkle root was recomputed from these transactions, by verify or the consensus structure stage
+        self.merkle_root_verified = False
+        # Set by BlockImporter once verify() passed on this very object
+        self.verified = False
         self.special_min = special_min
         self.target = target
         self.special_target = special_target
         if target==0:
             # Same call as in new block check - but there's a circular reference here.
-            latest_block = self.config.BU.get_latest_block()
+            latest_block = await self.config.BU.get_latest_block_async()
             if not latest_block:
                 self.target = CHAIN.MAX_TARGET
             else:
                 if self.index >= CHAIN.FORK_10_MIN_BLOCK:
-                    self.target = await BlockFactory.get_target_10min(self.index, await Block.from_dict(latest_block), self)
+                    self.target = await BlockFactory.get_target_10min(self.index, HeaderCache.from_dict(latest_block), self)
                 else:
-                    self.target = await BlockFactory.get_target(self.index, await Block.from_dict(latest_block), self)
+                    self.target = await BlockFactory.get_target(self.index, HeaderCache.from_dict(latest_block), self)
             self.special_target = self.target
             # TODO: do we need recalc special target here if special min?
         self.header = header
@@ -528,31 +523,44 @@ class Block(object):
                      self.hash, self.merkle_root, self.public_key, self.signature, self.special_min,
                      self.header, self.target, self.special_target)
 
-    @classmethod
-    async def from_dict(cls, block):
+    @property
+    def transactions(self):
+        if self.transaction_dicts is not None:
+            self.decode_transactions()
+        return self._transactions
+
+    @transactions.setter
+    def transactions(self, transactions):
+        self._transactions = transactions
+        self.transaction_dicts = None
+
+    def decode_transactions(self):
+        """Builds the transaction objects of a block loaded by from_dict, on first access of transactions"""
+        # TODO: do validity checking for coinbase transactions
+        address = AddressCache.address(self.public_key)
         transactions = []
-        for txn in block.get('transactions'):
-            # TODO: do validity checking for coinbase transactions
-            if str(P2PKHBitcoinAddress.from_pubkey(bytes.fromhex(block.get('public_key')))) in [x['to'] for x in txn.get('outputs', '')] and len(txn.get('outputs', '')) == 1 and not txn.get('inputs') and not txn.get('relationship'):
-                txn['coinbase'] = True  
-            else:
-                txn['coinbase'] = False
+        for txn in self.transaction_dicts:
+            txn['coinbase'] = address in [x['to'] for x in txn.get('outputs', '')] and len(txn.get('outputs', '')) == 1 and not txn.get('inputs') and not txn.get('relationship')
             if 'signatures' in txn:
-                transactions.append(FastGraph.from_dict(block.get('index'), txn))
+                transactions.append(FastGraph.from_dict(self.index, txn))
             else:
-                transactions.append(Transaction.from_dict(block.get('index'), txn))
+                transactions.append(Transaction.from_dict(self.index, txn))
+        self.transactions = transactions
 
+    @classmethod
+    async def from_dict(cls, block):
+        """Transactions are only decoded when first accessed, header only uses of a block do not pay for them.
+        See BlockHeader when not even a Block is needed."""
         if block.get('special_target', 0) == 0:
             block['special_target'] = block.get('target')
 
-        return await cls.init_async(
+        self = await cls.init_async(
             version=block.get('version'),
             block_time=block.get('time'),
             block_index=block.get('index'),
             public_key=block.get('public_key'),
             prev_hash=block.get('prevHash'),
             nonce=block.get('nonce'),
-            transactions=transactions,
             block_hash=block.get('hash'),
             merkle_root=block.get('merkleRoot'),
             signature=block.get('id'),
@@ -561,23 +569,17 @@ class Block(object):
             target=int(block.get('target'), 16),
             special_target=int(block.get('special_target', 0), 16)
         )
+        self.transaction_dicts = block.get('transactions')
+        return self
     
     def get_coinbase(self):
+        address = AddressCache.address(self.public_key)
         for txn in self.transactions:
-            if str(P2PKHBitcoinAddress.from_pubkey(bytes.fromhex(self.public_key))) in [x.to for x in txn.outputs] and len(txn.outputs) == 1 and not txn.relationship and len(txn.inputs) == 0:
+            if address in [x.to for x in txn.outputs] and len(txn.outputs) == 1 and not txn.relationship and len(txn.inputs) == 0:
                 return txn
 
     def generate_hash_from_header(self, height, header, nonce):
-        if not BlockFactory.pyrx:
-            BlockFactory.pyrx = pyrx.PyRX()
-        header = header.format(nonce=nonce)
-        if height >= CHAIN.RANDOMX_FORK:
-            seed_hash = binascii.unhexlify('4181a493b397a733b083639334bc32b407915b9a82b7917ac361816f0a1f5d4d') #sha256(yadacoin65000)
-            bh = BlockFactory.pyrx.get_rx_hash(header, seed_hash, height, BlockFactory.cores)
-            hh = binascii.hexlify(bh).decode()
-            return hh
-        else:
-            return hashlib.sha256(hashlib.sha256(header.encode('utf-8')).digest()).digest()[::-1].hex()
+        return BlockFactory.generate_hash_from_header(height, header, nonce)
 
     def verify(self):
         try:
@@ -585,10 +587,7 @@ class Block(object):
             if int(self.version) != int(CHAIN.get_version_for_height(self.index)):
                 raise Exception("Wrong version for block height", self.version, CHAIN.get_version_for_height(self.index))
 
-            txns = self.get_transaction_hashes()
-            self.set_merkle_root(txns)
-            if self.verify_merkle_root != self.merkle_root:
-                raise Exception("Invalid block merkle root")
+            self.check_merkle_root()
 
             header = BlockFactory.generate_header(self)
             hashtest = self.generate_hash_from_header(self.index, header, str(self.nonce))
@@ -597,19 +596,20 @@ class Block(object):
                 getLogger("tornado.application").warning("Verify error hashtest {} header {} nonce {}".format(hashtest, header, self.nonce))
                 raise Exception('Invalid block hash')
 
-            address = P2PKHBitcoinAddress.from_pubkey(bytes.fromhex(self.public_key))
-            try:
-                # print("address", address, "sig", self.signature, "pubkey", self.public_key)
-                result = verify_signature(base64.b64decode(self.signature), self.hash.encode('utf-8'), bytes.fromhex(self.public_key))
-                if not result:
-                    raise Exception("block signature1 is invalid")
-            except:
+            address = AddressCache.address(self.public_key)
+            if not self.signature_verified:
                 try:
-                    result = VerifyMessage(address, BitcoinMessage(self.hash.encode('utf-8'), magic=''), self.signature)
+                    # print("address", address, "sig", self.signature, "pubkey", self.public_key)
+                    result = verify_signature(base64.b64decode(self.signature), self.hash.encode('utf-8'), bytes.fromhex(self.public_key))
                     if not result:
-                        raise
+                        raise Exception("block signature1 is invalid")
                 except:
-                    raise Exception("block signature2 is invalid")
+                    try:
+                        result = VerifyMessage(address, BitcoinMessage(self.hash.encode('utf-8'), magic=''), self.signature)
+                        if not result:
+                            raise
+                    except:
+                        raise Exception("block signature2 is invalid")
 
             # verify reward
             coinbase_sum = 0
@@ -643,6 +643,21 @@ class Block(object):
             getLogger("tornado.application").warning("verify {} {} {}".format(exc_type, fname, exc_tb.tb_lineno))
             raise
 
+    async def verify_async(self):
+        """Runs verify in the VerifyExecutor when there is one, so the IOLoop is not held"""
+        if self.config.verify_executor:
+            return await self.config.verify_executor.run(self.verify)
+        return self.verify()
+
+    def check_merkle_root(self):
+        """Recomputes the merkle root from the transactions, once per block object"""
+        if self.merkle_root_verified:
+            return
+        self.set_merkle_root(self.get_transaction_hashes())
+        if self.verify_merkle_root != self.merkle_root:
+            raise Exception("Invalid block merkle root")
+        self.merkle_root_verified = True
+
     def get_transaction_hashes(self):
         """Returns a sorted list of tx hash, so the merkle root is constant across nodes"""
         return sorted([str(x.hash) for x in self.transactions], key=str.lower)
@@ -663,21 +678,25 @@ class Block(object):
 
     async def save(self):
         self.verify()
+        spent_inputs = await self.config.BU.prefetch_inputs_async(self.transactions)
         for txn in self.transactions:
             if txn.inputs:
                 failed = False
                 used_ids_in_this_txn = []
                 for x in txn.inputs:
-                    if self.config.BU.is_input_spent(x.id, txn.public_key):
+                    if (x.id, txn.public_key) in spent_inputs:
                         failed = True
                     if x.id in used_ids_in_this_txn:
                         failed = True
                     used_ids_in_this_txn.append(x.id)
                 if failed:
                     raise Exception('double spend', [x.id for x in txn.inputs])
-        res = self.mongo.db.blocks.find({"index": (int(self.index) - 1)})
-        if res.count() and res[0]['hash'] == self.prev_hash or self.index == 0:
-            self.mongo.db.blocks.insert(self.to_dict())
+        if self.index == 0 or await self.config.BU.get_block_hash(int(self.index) - 1) == self.prev_hash:
+            db_block = self.to_dict()
+            if self.config.chain_state:
+                chainwork = await self.config.chain_state.get_chainwork(int(self.index) - 1) + ChainState.get_work(self.hash)
+                db_block['chainwork'] = ChainState.to_hex(chainwork)
+            await self.mongo.async_db.blocks.insert_one(db_block)
         else:
             print("CRITICAL: block rejected...")
 
@@ -712,3 +731,32 @@ class Block(object):
     def in_the_future(self):
         """Tells wether the block is too far away in the future"""
         return int(self.time) > time.time() + CHAIN.TIME_TOLERANCE
+
+
+class BlockHeader(object):
+    """Header fields of a block dict, what generate_header, get_target and Blockchain.check_link read.
+    No transactions and no config, for the paths that never look past the header."""
+
+    __slots__ = ('version', 'time', 'index', 'public_key', 'prev_hash', 'nonce', 'merkle_root', 'hash', 'signature',
+                 'special_min', 'target', 'special_target')
+
+    @classmethod
+    def from_dict(cls, block):
+        self = cls()
+        self.version = block.get('version')
+        self.time = int(block.get('time'))
+        self.index = block.get('index')
+        self.public_key = block.get('public_key')
+        self.prev_hash = block.get('prevHash')
+        self.nonce = block.get('nonce')
+        self.merkle_root = block.get('merkleRoot')
+        self.hash = block.get('hash')
+        self.signature = block.get('id')
+        self.special_min = block.get('special_min')
+        self.target = int(block.get('target'), 16)
+        self.special_target = int(block.get('special_target') or block.get('target'), 16)
+        return self
+
+    def in_the_future(self):
+        """Tells wether the block is too far away in the future"""
+        return self.time > time.time() + CHAIN.TIME_TOLERANCE
@@ -9,6 +9,9 @@ class BlockChainException(Exception):
 
 
 class Blockchain(object):
+    # Blocks whose signatures are batch checked together by verify
+    SIGNATURE_WINDOW = 100
+
     @classmethod
     async def init_async(cls, blocks=None, partial=False):
         self = cls()
@@ -34,26 +37,31 @@ class Blockchain(object):
             raise Exception('Blocks do not start with zero index. Either incomplete blockchain or unordered.')
         return self
 
-    async def verify(self, progress=None):
+    async def verify(self, progress=None, last_block=None):
+        """last_block is the block before self.blocks, for partial chains verified one batch at a time"""
         async def get_blocks():
             for block in self.blocks:
                 yield block
         async def get_transactions(txns):
             for txn in txns:
                 yield txn
-        last_block = None
+        position = 0
         async for block in get_blocks():
+            if self.config.sig_verifier and position % self.SIGNATURE_WINDOW == 0:
+                await self.config.sig_verifier.verify_blocks(self.blocks[position:position + self.SIGNATURE_WINDOW])
+            position += 1
             try:
-                block.verify()
+                await block.verify_async()
             except Exception as e:
                 print("verify1", e)
                 if last_block:
                     return {'verified': False, 'last_good_block': last_block, 'message': e}
                 else:
                     return {'verified': False, 'message': e}
+            await self.config.BU.prefetch_inputs_async(block.transactions, spent=False)
             async for txn in get_transactions(block.transactions):
                 try:
-                    txn.verify()
+                    await txn.verify_async()
                 except InvalidTransactionException as e:
                     print("verify2", e)
                     if last_block:
@@ -73,23 +81,33 @@ class Blockchain(object):
                     else:
                         return {'verified': False, 'message': e}
             if last_block:
-                if block.index >= CHAIN.FORK_10_MIN_BLOCK:
-                    target = await BlockFactory.get_target_10min(block.index, last_block, block)
-                else:
-                    target = await BlockFactory.get_target(block.index, last_block, block)
-                if int(block.hash, 16) > target and not block.special_min:
-                    return {'verified': False, 'last_good_block': last_block, 'message': "invalid block chain: block target is not below the previous target and not special minimum"}
-                if block.index >= 35200 and (int(block.time) - int(last_block.time)) < 600 and block.special_min:
-                    return {'verified': False, 'last_good_block': last_block, 'message': "invalid block chain: block index is greater than or equal to 35200 and less than 10 minutes has passed since the last block"}
-                if block.prev_hash != last_block.hash:
-                    return {'verified': False, 'last_good_block': last_block, 'message': "invalid block chain: hashes are not consecutive: %s %s %s %s" % (last_block.hash, block.prev_hash, last_block.index, block.index)}
-                if block.index - last_block.index != 1:
-                    return {'verified': False, 'last_good_block': last_block, 'message': "invalid block chain: indexes are not consecutive: %s %s" % (last_block.index, block.index)}
+                message = await self.check_link(block, last_block)
+                if message:
+                    return {'verified': False, 'last_good_block': last_block, 'message': message}
             last_block = block
             if progress:
                 progress("%s%s %s" % (str(int(float(block.index + 1) / float(len(self.blocks)) * 100)), '%', block.index))
         return {'verified': True}
 
+    @staticmethod
+    async def check_link(block, last_block, retarget_engine=None):
+        """Retarget and linkage checks of block against the one before it, returns the error message or None.
+        Only header fields are used, so header records work as well as blocks.
+        retarget_engine holds the headers below block, the node's unless given."""
+        if block.index >= CHAIN.FORK_10_MIN_BLOCK:
+            target = await BlockFactory.get_target_10min(block.index, last_block, block, retarget_engine)
+        else:
+            target = await BlockFactory.get_target(block.index, last_block, block, retarget_engine)
+        if int(block.hash, 16) > target and not block.special_min:
+            return "invalid block chain: block target is not below the previous target and not special minimum"
+        if block.index >= 35200 and (int(block.time) - int(last_block.time)) < 600 and block.special_min:
+            return "invalid block chain: block index is greater than or equal to 35200 and less than 10 minutes has passed since the last block"
+        if block.prev_hash != last_block.hash:
+            return "invalid block chain: hashes are not consecutive: %s %s %s %s" % (last_block.hash, block.prev_hash, last_block.index, block.index)
+        if block.index - last_block.index != 1:
+            return "invalid block chain: indexes are not consecutive: %s %s" % (last_block.index, block.index)
+        return None
+
     def find_error_block(self):
         last_block = None
         for block in self.blocks:
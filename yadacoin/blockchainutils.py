@@ -3,11 +3,11 @@ import base64
 import re
 
 # from yadacoin.transactionutils import TU
-from bitcoin.wallet import P2PKHBitcoinAddress
-from bson.son import SON
 from coincurve import PrivateKey
 from logging import getLogger
 
+from yadacoin.addresscache import AddressCache
+from yadacoin.cachewriter import CacheWriter
 from yadacoin.chain import CHAIN
 from yadacoin.config import get_config
 # Circular reference
@@ -60,6 +60,9 @@ class BlockChainUtils(object):
         # cached - WARNING : this is a json doc, NOT a block
         if not self.latest_block is None:
             return self.latest_block
+        if self.config.chain_state and self.config.chain_state.tip:
+            self.latest_block = self.config.chain_state.tip
+            return self.latest_block
         self.latest_block = self.mongo.db.blocks.find_one({}, {'_id': 0}, sort=[('index', -1)])
         self.app_log.debug("last block " + str(self.latest_block))
         return self.latest_block
@@ -71,6 +74,10 @@ class BlockChainUtils(object):
         # cached, async version
         if self.latest_block is not None and use_cache:
             return self.latest_block
+        if self.config.chain_state and self.config.chain_state.tip:
+            # Follows every insert and rollback, no need to query
+            self.latest_block = self.config.chain_state.tip
+            return self.latest_block
         self.latest_block = await self.mongo.async_db.blocks.find_one({}, {'_id': 0}, sort=[('index', -1)])
         return self.latest_block
 
@@ -79,209 +86,157 @@ class BlockChainUtils(object):
         if res.count():
             return res[0]
 
-    async def get_wallet_balance(self, address):
-        balance = 0
-        used_ids = []
-        async for txn in self.get_wallet_unspent_transactions(address):
-            for output in txn['outputs']:
-                if address == output['to']:
-                    used_ids.append(txn['id'])
-                    balance += float(output['value'])
-        yield balance
+    async def get_block_by_index_async(self, index):
+        return await self.mongo.async_db.blocks.find_one({'index': index}, {'_id': 0})
 
-    async def get_wallet_unspent_transactions(self, address, ids=None, needed_value=None):
-        unspent_cache = await self.mongo.async_db.unspent_cache.find_one({'address': address}, sort=[('height', -1)])
+    async def get_block_hash(self, index):
+        """Hash of our block at index, None if we have none"""
+        if self.config.chain_state and self.config.chain_state.tip:
+            return self.config.chain_state.get_hash(index)
+        block = await self.mongo.async_db.blocks.find_one({'index': index}, {'hash': 1})
+        if block:
+            return block['hash']
 
-        if unspent_cache and (ids or needed_value):
-            block_height = unspent_cache['height']
-        else:
-            block_height = 0
-        
-        #### fine above ####
-
-
-        ### find public key fast first ###
-
-
-        public_key_address_pairs = self.mongo.async_db.blocks.aggregate([
-            {
-                '$match': {
-                    "transactions.outputs.to": address
-                }
-            },
-            {
-                '$unwind': "$transactions"
-            },
-            {
-                '$match': {
-                    "transactions.outputs.to": address
-                }
-            },
-            {
-                '$project': {
-                        "transaction": "$transactions",
-                        "public_key": "$transactions.public_key"
-                }
-                
-            },
-            {
-                '$unwind': "$transaction.outputs"
-            },
-            {
-                '$match': {
-                    "transaction.outputs.to": address
-                }
-            },
-        ])
-
-        reverse_public_key = ''
-        async for public_key_address_pair in public_key_address_pairs:
-            xaddress = str(P2PKHBitcoinAddress.from_pubkey(bytes.fromhex(public_key_address_pair['public_key'])))
-
-            if xaddress == address:
-                reverse_public_key = public_key_address_pair['public_key']
-                break
+    def get_public_key_by_address(self, address):
+        # address_keys is maintained by ChainIndex from chain and mempool transactions
+        res = self.mongo.db.address_keys.find_one({'address': address}, {'_id': 0, 'public_key': 1})
+        if res:
+            return res['public_key']
 
-        spent_txns_query = [
-            {
-                "$match": {
-                    "index": {'$gte': block_height}
-                }
-            }
-        ]
+    async def get_public_key_by_address_async(self, address):
+        res = await self.mongo.async_db.address_keys.find_one({'address': address}, {'_id': 0, 'public_key': 1})
+        if res:
+            return res['public_key']
 
-        if ids:
-            spent_txns_query.append({
-                '$match': {
-                    "transactions.id": {'$in': ids}
-                }
-            })
-        ### end find public key fast first ###
-        spent_txns_query.extend([
-            {
-                "$match": {
-                    "$or": [
-                        {"transactions.public_key": reverse_public_key},
-                        {"transactions.inputs.public_key": reverse_public_key},
-                        {"transactions.inputs.address": address}
-                    ]
-                }
-            },
-            {"$unwind": "$transactions" },
-            {
-                "$project": {
-                    "_id": 0,
-                    "txn": "$transactions",
-                    "height": "$index"
-                }
-            },
-            {
-                "$match": {
-                    "$or": [
-                        {"txn.public_key": reverse_public_key},
-                        {"txn.inputs.public_key": reverse_public_key},
-                        {"txn.inputs.address": address}
-                    ]
-                }
-            },
-            {
-                "$project": {
-                    "_id": 0,
-                    "public_key": "$txn.public_key",
-                    "txn": "$txn",
-                    "height": "$height"
-                }
-            }
-        ])
-
-        spent = self.mongo.async_db.blocks.aggregate(spent_txns_query)
+    async def get_wallet_balance(self, address):
+        balances = await self.get_wallet_balances([address])
+        yield balances[address]
+
+    async def get_wallet_balances(self, addresses) -> dict:
+        """Confirmed balances, address -> float, from the balances collection maintained by ChainIndex"""
+        from yadacoin.chainindex import ChainIndex
+        balances = {address: 0.0 for address in addresses}
+        async for x in self.mongo.async_db.balances.find({'address': {'$in': list(balances.keys())}}, {'_id': 0}):
+            balances[x['address']] = x['amount'] / ChainIndex.COIN
+        return balances
+
+    async def get_pending_balances(self, addresses) -> dict:
+        """Mempool balance delta, address -> float: incoming outputs minus the confirmed outputs spent by pending transactions.
+        External inputs are not accounted for, their owner cannot be told from the pending transaction alone."""
+        from yadacoin.chainindex import ChainIndex
+        deltas = {address: 0 for address in addresses}
+        async for txn in self.mongo.async_db.miner_transactions.find({'outputs.to': {'$in': list(deltas.keys())}}, {'_id': 0, 'outputs': 1}):
+            for output in txn['outputs']:
+                if output['to'] in deltas:
+                    deltas[output['to']] += ChainIndex.to_amount(output['value'])
+
+        addresses_by_public_key = {}
+        async for x in self.mongo.async_db.address_keys.find({'address': {'$in': list(deltas.keys())}}, {'_id': 0}):
+            addresses_by_public_key[x['public_key']] = x['address']
+        spent_filters = []
+        if addresses_by_public_key:
+            async for txn in self.mongo.async_db.miner_transactions.find({'public_key': {'$in': list(addresses_by_public_key.keys())}}, {'_id': 0, 'public_key': 1, 'inputs': 1}):
+                for txn_input in txn.get('inputs', []):
+                    if not ChainIndex.is_external_input(txn_input):
+                        spent_filters.append({'id': txn_input['id'], 'address': addresses_by_public_key[txn['public_key']]})
+        if spent_filters:
+            async for utxo in self.mongo.async_db.utxos.find({'$or': spent_filters, 'spent_height': None}, {'_id': 0, 'address': 1, 'amount': 1}):
+                deltas[utxo['address']] -= utxo['amount']
+        return {address: amount / ChainIndex.COIN for address, amount in deltas.items()}
 
-        # here we're assuming block/transaction validation ensures the inputs used are valid for this address
-        spent_ids = set()
-        async for x in spent:
-            spent_ids.update([i['id'] for i in x['txn']['inputs']])
+    async def get_wallet_unspent_transactions(self, address, ids=None, needed_value=None):
+        """Transactions with outputs to address not spent yet, oldest first.
+        With needed_value, stops once their unspent outputs to address add up to it."""
+        from yadacoin.chainindex import ChainIndex
+        # utxos is maintained by ChainIndex on every block insert and removal
+        query = {'address': address, 'spent_height': None}
         if ids:
-            for x in list(spent_ids ^ set(ids)):
+            query['id'] = {'$in': ids}
+        needed_amount = ChainIndex.to_amount(needed_value) if needed_value else None
+        # One entry per transaction, in height order
+        unspent_ids = {}
+        amount = 0
+        async for utxo in self.mongo.async_db.utxos.find(query, {'_id': 0, 'id': 1, 'amount': 1}).sort([('height', 1)]):
+            if needed_amount is not None and amount >= needed_amount and utxo['id'] not in unspent_ids:
+                break
+            unspent_ids[utxo['id']] = True
+            amount += utxo['amount']
+        if ids:
+            for x in unspent_ids:
                 yield {'id': x}
             return
+        if not unspent_ids:
+            return
 
-        unspent_txns_query = [
-            {
-                '$match': {
-                    "transactions.outputs.to": address
-                }
-            },
-            {
-                '$unwind': "$transactions"
-            },
-            {
-                '$match': {
-                    'transactions.id': {'$nin' : list(spent_ids)}
-                }
-            }
-        ]
-
-        async for unspent_txn in self.config.mongo.async_db.blocks.aggregate(unspent_txns_query):
-            unspent_txn['transactions']['height'] = unspent_txn['index']
-            yield unspent_txn['transactions']
+        res = self.mongo.async_db.transactions.find(
+            {'id': {'$in': list(unspent_ids)}},
+            {'_id': 0, 'block_hash': 0, 'position': 0}
+        ).sort(self.TRANSACTIONS_SORT)
+        async for x in res:
+            yield x
 
-    def get_wallet_unspent_fastgraph_transactions(self, address):
-        result = [x for x in self.mongo.db.fastgraph_transactions.find({'txn.outputs.to': address})]
-        reverse_public_key = None
-        for x in result:
-            xaddress = str(P2PKHBitcoinAddress.from_pubkey(bytes.fromhex(x['public_key'])))
-            if xaddress == address:
-                reverse_public_key = x['public_key']
-                break
+    async def get_wallet_unspent_fastgraph_transactions(self, address):
+        result = await self.mongo.async_db.fastgraph_transactions.find({'txn.outputs.to': address}).to_list(None)
+        reverse_public_key = await self.get_public_key_by_address_async(address)
+        if not reverse_public_key:
+            for x in result:
+                xaddress = AddressCache.address(x['public_key'])
+                if xaddress == address:
+                    reverse_public_key = x['public_key']
+                    break
         if not reverse_public_key:
             for x in result:
                 yield x['txn']
             return
         for x in result:
-            spent_on_fastgraph = self.mongo.db.fastgraph_transactions.find({'public_key': reverse_public_key, 'txn.inputs.id': x['id']})
-            spent_on_blockchain = self.mongo.db.blocks.find({'public_key': reverse_public_key, 'transactions.inputs.id': x['id']})
-            if not spent_on_fastgraph.count() and not spent_on_blockchain.count():
+            spent_on_fastgraph = await self.mongo.async_db.fastgraph_transactions.count_documents({'public_key': reverse_public_key, 'txn.inputs.id': x['id']})
+            spent_on_blockchain = await self.mongo.async_db.blocks.count_documents({'public_key': reverse_public_key, 'transactions.inputs.id': x['id']})
+            if not spent_on_fastgraph and not spent_on_blockchain:
                 # x['txn']['height'] = x['height'] # TODO: make height work for frastgraph transactions so we can order messages etc.
                 yield x['txn']
 
-    def get_wallet_spent_fastgraph_transactions(self, address):
-        result = self.mongo.db.fastgraph_transactions.find({'txn.outputs.to': address})
-        for x in result:
-            xaddress = str(P2PKHBitcoinAddress.from_pubkey(bytes.fromhex(x['public_key'])))
-            if xaddress == address:
+    async def get_wallet_spent_fastgraph_transactions(self, address):
+        known_public_key = await self.get_public_key_by_address_async(address)
+        async for x in self.mongo.async_db.fastgraph_transactions.find({'txn.outputs.to': address}):
+            if known_public_key:
+                is_mine = x['public_key'] == known_public_key
+            else:
+                is_mine = AddressCache.address(x['public_key']) == address
+            if is_mine:
                 reverse_public_key = x['public_key']
-                spent_on_fastgraph = self.mongo.db.fastgraph_transactions.find({'public_key': reverse_public_key, 'txn.inputs.id': x['id']})
-                spent_on_blockchain = self.mongo.db.blocks.find({'public_key': reverse_public_key, 'transactions.inputs.id': x['id']})
-                if spent_on_fastgraph.count() or spent_on_blockchain.count():
+                spent_on_fastgraph = await self.mongo.async_db.fastgraph_transactions.count_documents({'public_key': reverse_public_key, 'txn.inputs.id': x['id']})
+                spent_on_blockchain = await self.mongo.async_db.blocks.count_documents({'public_key': reverse_public_key, 'transactions.inputs.id': x['id']})
+                if spent_on_fastgraph or spent_on_blockchain:
                     # x['txn']['height'] = x['height'] # TODO: make height work for frastgraph transactions so we can order messages etc.
                     yield x['txn']
 
-    def get_transactions(self, wif, query, queryType, raw=False, both=True, skip=None):
+    async def get_transactions(self, wif, query, queryType, raw=False, both=True, skip=None):
         if not skip:
             skip = []
         #from block import Block
         #from transaction import Transaction
         from yadacoin.crypt import Crypt
 
-        get_transactions_cache = self.mongo.db.get_transactions_cache.find(
+        get_transactions_cache = await self.mongo.async_db.get_transactions_cache.find_one(
                 {
                     'public_key': self.config.public_key,
                     'raw': raw,
                     'both': both,
                     'skip': skip,
                     'queryType': queryType
-                }
-        ).sort([('height', -1)])
-        latest_block = self.get_latest_block()
-        if get_transactions_cache.count():
-            get_transactions_cache = get_transactions_cache[0]
+                },
+                sort=[('height', -1)]
+        )
+        latest_block = await self.get_latest_block_async()
+        if get_transactions_cache:
             block_height = get_transactions_cache['height']
         else:
             block_height = 0
 
         cipher = None
         transactions = []
-        for block in self.mongo.db.blocks.find({"transactions": {"$elemMatch": {"relationship": {"$ne": ""}}}, 'index': {'$gt': block_height}}):
+        cache_writer = CacheWriter()
+        async for block in self.mongo.async_db.blocks.find({"transactions": {"$elemMatch": {"relationship": {"$ne": ""}}}, 'index': {'$gt': block_height}}):
             for transaction in block.get('transactions'):
                 try:
                     if transaction.get('id') in skip:
@@ -297,16 +252,40 @@ class BlockChainUtils(object):
                         relationship = json.loads(decrypted.decode('latin1'))
                         transaction['relationship'] = relationship
                     transaction['height'] = block['index']
-                    self.mongo.db.get_transactions_cache.update(
-                        {
+                    cache_writer.replace('get_transactions_cache', {
+                        'public_key': self.config.public_key,
+                        'raw': raw,
+                        'both': both,
+                        'skip': skip,
+                        'height': latest_block['index'],
+                        'block_hash': latest_block['hash'],
+                        'queryType': queryType,
+                        'id': transaction['id']
+                    },
+                    {
+                        'public_key': self.config.public_key,
+                        'raw': raw,
+                        'both': both,
+                        'skip': skip,
+                        'height': latest_block['index'],
+                        'block_hash': latest_block['hash'],
+                        'txn': transaction,
+                        'queryType': queryType,
+                        'id': transaction['id'],
+                        'cache_time': time()
+                    })
+                except:
+                    self.app_log.debug('failed decrypt. block: {}'.format(block['index']))
+                    if both:
+                        transaction['height'] = block['index']
+                        cache_writer.replace('get_transactions_cache', {
                             'public_key': self.config.public_key,
                             'raw': raw,
                             'both': both,
                             'skip': skip,
                             'height': latest_block['index'],
                             'block_hash': latest_block['hash'],
-                            'queryType': queryType,
-                            'id': transaction['id']
+                            'queryType': queryType
                         },
                         {
                             'public_key': self.config.public_key,
@@ -317,40 +296,13 @@ class BlockChainUtils(object):
                             'block_hash': latest_block['hash'],
                             'txn': transaction,
                             'queryType': queryType,
-                            'id': transaction['id'],
                             'cache_time': time()
-                        }
-                    , upsert=True)
-                except:
-                    self.app_log.debug('failed decrypt. block: {}'.format(block['index']))
-                    if both:
-                        transaction['height'] = block['index']
-                        self.mongo.db.get_transactions_cache.update(
-                            {
-                                'public_key': self.config.public_key,
-                                'raw': raw,
-                                'both': both,
-                                'skip': skip,
-                                'height': latest_block['index'],
-                                'block_hash': latest_block['hash'],
-                                'queryType': queryType
-                            },
-                            {
-                                'public_key': self.config.public_key,
-                                'raw': raw,
-                                'both': both,
-                                'skip': skip,
-                                'height': latest_block['index'],
-                                'block_hash': latest_block['hash'],
-                                'txn': transaction,
-                                'queryType': queryType,
-                                'cache_time': time()
-                            }
-                        , upsert=True)
+                        })
                     continue
+            await cache_writer.flush_if_due_async()
 
         if not transactions:
-            self.mongo.db.get_transactions_cache.insert({
+            cache_writer.insert('get_transactions_cache', {
                 'public_key': self.config.public_key,
                 'raw': raw,
                 'both': both,
@@ -360,10 +312,9 @@ class BlockChainUtils(object):
                 'block_hash': latest_block['hash'],
                 'cache_time': time()
             })
+        await cache_writer.flush_async()
 
-        fastgraph_transactions = self.get_fastgraph_transactions(wif, query, queryType, raw=False, both=True, skip=None)
-
-        for fastgraph_transaction in fastgraph_transactions:
+        async for fastgraph_transaction in self.get_fastgraph_transactions(wif, query, queryType, raw=False, both=True, skip=None):
             yield fastgraph_transaction
 
 
@@ -376,16 +327,16 @@ class BlockChainUtils(object):
                 'txn': {'$exists': True}
             }
         search_query.update(query)
-        transactions = self.mongo.db.get_transactions_cache.find(search_query).sort([('height', -1)])
+        transactions = self.mongo.async_db.get_transactions_cache.find(search_query).sort([('height', -1)])
 
-        for transaction in transactions:
+        async for transaction in transactions:
             yield transaction['txn']
         
 
-    def get_fastgraph_transactions(self, secret, query, queryType, raw=False, both=True, skip=None):
+    async def get_fastgraph_transactions(self, secret, query, queryType, raw=False, both=True, skip=None):
         from yadacoin.crypt import Crypt
         cipher = None
-        for transaction in self.mongo.db.fastgraph_transactions.find(query):
+        async for transaction in self.mongo.async_db.fastgraph_transactions.find(query):
             if 'txn' in transaction:
                 try:
                     if transaction.get('id') in skip:
@@ -394,7 +345,7 @@ class BlockChainUtils(object):
                         continue
                     if not transaction['relationship']:
                         continue
-                    res = self.mongo.db.fastgraph_transaction_cache.find_one({
+                    res = await self.mongo.async_db.fastgraph_transaction_cache.find_one({
                         'txn.id': transaction.get('id'),
                     })
                     if res:
@@ -405,7 +356,10 @@ class BlockChainUtils(object):
                         decrypted = cipher.decrypt(transaction['relationship'])
                         relationship = json.loads(decrypted.decode('latin1'))
                         transaction['relationship'] = relationship
-                    self.mongo.db.fastgraph_transaction_cache.update(
+                    await self.mongo.async_db.fastgraph_transaction_cache.replace_one(
+                        {
+                            'txn.id': transaction.get('id')
+                        },
                         {
                             'txn': transaction,
                             'cache_time': time()
@@ -414,84 +368,193 @@ class BlockChainUtils(object):
                 except:
                     continue
         
-        for x in self.mongo.db.fastgraph_transaction_cache.find({
+        async for x in self.mongo.async_db.fastgraph_transaction_cache.find({
             'txn': {'$exists': True}
         }):
-            yield x['tnx']
+            yield x['txn']
 
     def generate_signature(self, message, private_key):
         key = PrivateKey.from_hex(private_key)
         signature = key.sign(message.encode("utf-8"))
         return base64.b64encode(signature).decode("utf-8")
 
-    def get_transaction_by_id(self, id, instance=False, give_block=False, include_fastgraph=False, inc_mempool=False):
+    TRANSACTIONS_SORT = [('height', 1), ('position', 1)]
+
+    @staticmethod
+    def transaction_record(x):
+        """{'txn', 'height', 'block_hash'} of a flat transactions document"""
+        height = x.pop('height')
+        block_hash = x.pop('block_hash')
+        x.pop('position', None)
+        return {
+            'txn': x,
+            'height': height,
+            'block_hash': block_hash
+        }
+
+    def find_transactions(self, query, sort=None):
+        """Lookup in the flat transactions collection maintained by ChainIndex.
+        Yields {'txn', 'height', 'block_hash'} dicts, by ascending height unless sort is given."""
+        res = self.mongo.db.transactions.find(query, {'_id': 0}).sort(sort or self.TRANSACTIONS_SORT)
+        for x in res:
+            yield self.transaction_record(x)
+
+    async def find_transactions_async(self, query, sort=None):
+        """Async version of find_transactions"""
+        res = self.mongo.async_db.transactions.find(query, {'_id': 0}).sort(sort or self.TRANSACTIONS_SORT)
+        async for x in res:
+            yield self.transaction_record(x)
+
+    @staticmethod
+    def transaction_result(x, instance):
+        """get_transaction_by_id result for a find_transactions record"""
         from yadacoin.transaction import Transaction
-        # from yadacoin.crypt import Crypt
         from yadacoin.fastgraph import FastGraph
-        res = self.mongo.db.blocks.find({"transactions.id": id})
-        if res.count():
-            for block in res:
-                if give_block:
-                    return block
-                for txn in block['transactions']:
-                    if txn['id'] == id:
-                        if instance:
-                            try:
-                                return FastGraph.from_dict(block['index'], txn)
-                            except:
-                                return Transaction.from_dict(block['index'], txn)
-                        else:
-                            return txn
+        if not instance:
+            return x['txn']
+        try:
+            return FastGraph.from_dict(x['height'], x['txn'])
+        except:
+            return Transaction.from_dict(x['height'], x['txn'])
+
+    @staticmethod
+    def mempool_transaction_result(txn, instance, give_block):
+        """get_transaction_by_id result for a miner_transactions document"""
+        from yadacoin.transaction import Transaction
+        if give_block:
+            raise Exception('Cannot give block for mempool transaction')
+        if instance:
+            return Transaction.from_dict(0, txn)
+        return txn
+
+    def get_transaction_by_id(self, id, instance=False, give_block=False, include_fastgraph=False, inc_mempool=False):
+        for x in self.find_transactions({"id": id}):
+            if give_block:
+                return self.mongo.db.blocks.find_one({'index': x['height']})
+            return self.transaction_result(x, instance)
         if inc_mempool:
             res2 = self.mongo.db.miner_transactions.find_one({"id": id})
             if res2:
-                if give_block:
-                    raise Exception('Cannot give block for mempool transaction')
-                if instance:
-                    return Transaction.from_dict(0, res2)
-                else:
-                    return res2
-            return None
-        else:
-            # fix for bug when unspent cache returns an input 
-            # that has been removed from the chain
-            self.mongo.db.unspent_cache.remove({})
+                return self.mempool_transaction_result(res2, instance, give_block)
+        return None
+
+    async def get_transaction_by_id_async(self, id, instance=False, give_block=False, include_fastgraph=False, inc_mempool=False):
+        async for x in self.find_transactions_async({"id": id}):
+            if give_block:
+                return await self.mongo.async_db.blocks.find_one({'index': x['height']})
+            return self.transaction_result(x, instance)
+        if inc_mempool:
+            res2 = await self.mongo.async_db.miner_transactions.find_one({"id": id})
+            if res2:
+                return self.mempool_transaction_result(res2, instance, give_block)
+        return None
+
+    @staticmethod
+    def transactions_by_ids_query(ids, below_height=None):
+        query = {'id': {'$in': list(set(ids))}}
+        if below_height is not None:
+            query['height'] = {'$lt': below_height}
+        return query
+
+    def get_transactions_by_ids(self, ids, below_height=None) -> dict:
+        """Batched get_transaction_by_id, one $in query. Returns {id: txn dict} for the ids found,
+        below_height excludes the blocks from that height."""
+        txns = {}
+        for x in self.find_transactions(self.transactions_by_ids_query(ids, below_height)):
+            # Lowest height first, as get_transaction_by_id
+            txns.setdefault(x['txn']['id'], x['txn'])
+        return txns
+
+    async def get_transactions_by_ids_async(self, ids, below_height=None) -> dict:
+        """Async version of get_transactions_by_ids"""
+        txns = {}
+        async for x in self.find_transactions_async(self.transactions_by_ids_query(ids, below_height)):
+            txns.setdefault(x['txn']['id'], x['txn'])
+        return txns
+
+    async def prefetch_inputs_async(self, transactions, spent=True, inc_mempool=False, below_height=None):
+        """Input resolution stage for a block or a batch of transactions.
+        Fetches every input transaction with one query and hands the map to each transaction,
+        for verify and generate_hash. Returns the are_inputs_spent_async set for the double spend checks,
+        None if spent is False. below_height ignores the chain from that height, for a block replacing ours."""
+        input_txns = await self.get_transactions_by_ids_async([x.id for txn in transactions for x in txn.inputs], below_height)
+        for txn in transactions:
+            txn.input_txns = input_txns
+        if not spent:
             return None
+        return await self.are_inputs_spent_async(
+            [(x.id, txn.public_key) for txn in transactions for x in txn.inputs],
+            inc_mempool=inc_mempool,
+            below_height=below_height
+        )
 
     def is_input_spent(self, input_ids, public_key, instance=False, give_block=False, include_fastgraph=False, inc_mempool=False):
-        from yadacoin.transaction import Transaction
-        # from yadacoin.crypt import Crypt
-        from yadacoin.fastgraph import FastGraph
         if not isinstance(input_ids, list):
             input_ids = [input_ids]
-        res = self.mongo.db.blocks.aggregate([
-            {
-                '$match': {
-                    "transactions.inputs.id": {'$in': input_ids},
-                    "transactions.public_key": public_key
-                }
-            },
-            {
-                '$unwind': '$transactions'
-            },
-            {
-                '$match': {
-                    "transactions.inputs.id": {'$in': input_ids},
-                    "transactions.public_key": public_key
-                }
-            }
-        ])
-        if len(list(res)):
-            return True
-        
+        return len(self.are_inputs_spent([(x, public_key) for x in input_ids], inc_mempool=inc_mempool)) > 0
+
+    @staticmethod
+    def spent_queries(inputs, below_height=None):
+        """are_inputs_spent inputs grouped by public key, with the spent_outpoints and miner_transactions
+        queries for them. below_height ignores the spends from that height."""
+        by_public_key = {}
+        for input_id, public_key in inputs:
+            by_public_key.setdefault(public_key, set()).add(input_id)
+        spent_query = {
+            '$or': [
+                {'public_key': public_key, 'id': {'$in': list(input_ids)}}
+                for public_key, input_ids in by_public_key.items()
+            ]
+        }
+        if below_height is not None:
+            spent_query['height'] = {'$lt': below_height}
+        mempool_query = {
+            '$or': [
+                {'public_key': public_key, 'inputs.id': {'$in': list(input_ids)}}
+                for public_key, input_ids in by_public_key.items()
+            ]
+        }
+        return by_public_key, spent_query, mempool_query
+
+    @staticmethod
+    def add_mempool_spends(spent, txn, by_public_key):
+        for txn_input in txn['inputs']:
+            if txn_input['id'] in by_public_key[txn['public_key']]:
+                spent.add((txn_input['id'], txn['public_key']))
+
+    def are_inputs_spent(self, inputs, inc_mempool=False, below_height=None):
+        """Batched spent check. inputs is a list of (input id, spender public key) tuples,
+        returns the set of those already spent, using one spent_outpoints query."""
+        by_public_key, spent_query, mempool_query = self.spent_queries(inputs, below_height)
+        if not by_public_key:
+            return set()
+
+        spent = set()
+        for x in self.mongo.db.spent_outpoints.find(spent_query, {'_id': 0, 'id': 1, 'public_key': 1}):
+            spent.add((x['id'], x['public_key']))
         if inc_mempool:
-            res2 = self.mongo.db.miner_transactions.find_one({
-                "inputs.id": {'$in': input_ids},
-                "public_key": public_key
-            })
-            if res2:
-                return True
-        return False
+            for x in self.mongo.db.miner_transactions.find(mempool_query, {'_id': 0, 'inputs.id': 1, 'public_key': 1}):
+                self.add_mempool_spends(spent, x, by_public_key)
+        return spent
+
+    async def is_input_spent_async(self, input_ids, public_key, inc_mempool=False):
+        if not isinstance(input_ids, list):
+            input_ids = [input_ids]
+        return len(await self.are_inputs_spent_async([(x, public_key) for x in input_ids], inc_mempool=inc_mempool)) > 0
+
+    async def are_inputs_spent_async(self, inputs, inc_mempool=False, below_height=None):
+        """Async version of are_inputs_spent"""
+        by_public_key, spent_query, mempool_query = self.spent_queries(inputs, below_height)
+        if not by_public_key:
+            return set()
+
+        spent = set()
+        async for x in self.mongo.async_db.spent_outpoints.find(spent_query, {'_id': 0, 'id': 1, 'public_key': 1}):
+            spent.add((x['id'], x['public_key']))
+        if inc_mempool:
+            async for x in self.mongo.async_db.miner_transactions.find(mempool_query, {'_id': 0, 'inputs.id': 1, 'public_key': 1}):
+                self.add_mempool_spends(spent, x, by_public_key)
+        return spent
 
     def get_version_for_height_DEPRECATED(self, height:int):
         # TODO: move to CHAIN
@@ -560,36 +623,31 @@ class BlockChainUtils(object):
 
         return float(block_reward['reward'])
 
+    @staticmethod
+    def double_spend_query(transaction_obj):
+        return {'public_key': transaction_obj.public_key, 'inputs.id': {'$in': [x.id for x in transaction_obj.inputs]}}
+
+    @staticmethod
+    def add_double_spends(double_spends, x, transaction_obj):
+        input_ids = {txn_input.id for txn_input in transaction_obj.inputs}
+        for txn_input in x['txn']['inputs']:
+            if txn_input['id'] in input_ids:
+                double_spends.append({
+                    'input_id': txn_input['id'],
+                    'public_key': transaction_obj.public_key
+                })
+
     def check_double_spend(self, transaction_obj):
         double_spends = []
-        for txn_input in transaction_obj.inputs:
-            res = self.mongo.db.blocks.aggregate([
-                {"$unwind": "$transactions" },
-                {
-                    "$project": {
-                        "_id": 0,
-                        "txn": "$transactions"
-                    }
-                },
-                {"$unwind": "$txn.inputs" },
-                {
-                    "$project": {
-                        "_id": 0,
-                        "input_id": "$txn.inputs.id",
-                        "public_key": "$txn.public_key"
-                    }
-                },
-                {"$sort": SON([("count", -1), ("input_id", -1)])},
-                {"$match":
-                    {
-                        "public_key": transaction_obj.public_key,
-                        "input_id": txn_input.id
-                    }
-                }
-            ])
-            double_spends.extend([x for x in res])
+        for x in self.find_transactions(self.double_spend_query(transaction_obj)):
+            self.add_double_spends(double_spends, x, transaction_obj)
+        return double_spends
+
+    async def check_double_spend_async(self, transaction_obj):
+        double_spends = []
+        async for x in self.find_transactions_async(self.double_spend_query(transaction_obj)):
+            self.add_double_spends(double_spends, x, transaction_obj)
         return double_spends
-    
     def get_hash_rate(self, blocks):
         start_time = 0
         end_time = 0
@@ -0,0 +1,148 @@
+"""
+Pipelined import of the block batches peers send over websocket.
+
+A batch goes through four stages: decode (Block.from_dict, consecutive heights and prev hashes),
+stateless verification of all its blocks at once (signatures in one SignatureVerifier batch,
+Block.verify on the verify executor), then, block after block, the stateful input and double spend
+checks of integrate_block_with_existing_chain and the commit, through import_block.
+The next batch is asked for as soon as a batch passed verification. It arrives, is decoded and
+verified while the previous one commits, and waits in the queue, so the network, the cpu and the
+database work at the same time. At most MAX_QUEUED verified batches wait for the commit stage,
+the next one is only asked for once the commit stage took one of them.
+Durations of each stage are kept in last_batch for the latest batch.
+"""
+
+from asyncio import gather
+from collections import deque
+from logging import getLogger
+from time import time
+
+from yadacoin.block import Block
+from yadacoin.chain import CHAIN
+from yadacoin.config import get_config
+
+
+class BlockImporter(object):
+    # Verified batches waiting for the commit stage
+    MAX_QUEUED = 2
+
+    def __init__(self):
+        self.config = get_config()
+        self.mongo = self.config.mongo
+        self.app_log = getLogger('tornado.application')
+        self.queue = deque()
+        # Last block handed to the commit stage, the next batch has to chain to it
+        self.last = None
+        self.running = False
+        # request_next and start index of the batch to ask once the queue has room
+        self.next_request = None
+        # blocks, decode, verify and commit seconds of the latest batch
+        self.last_batch = {}
+
+    async def on_blocks(self, data, peer, request_next) -> bool:
+        """Takes a batch of block dicts from peer. request_next(start_index, end_index) is awaited to ask for
+        the following batch. Returns False if the batch does not follow our tip or the queued batches."""
+        if not data:
+            return False
+        if not self.running and not self.queue:
+            # Nothing in the pipeline, the chain may have moved since
+            self.last = await Block.from_dict(await self.config.BU.get_latest_block_async())
+        if data[0]['index'] > self.last.index + 1 and self.config.orphan_pool:
+            # Ahead of us, keep them until the blocks before them arrive
+            for block in data:
+                self.config.orphan_pool.add(block, peer.to_string())
+        if data[0]['index'] != self.last.index + 1 or len(self.queue) >= self.MAX_QUEUED:
+            return False
+        start = time()
+        blocks = await self.decode(data, self.last)
+        decoded = time()
+        blocks = await self.verify(blocks)
+        verified = time()
+        if not blocks or self.last is None or blocks[0].prev_hash != self.last.hash:
+            # Failed, or another peer's batch for the same heights got queued meanwhile
+            self.app_log.debug('Import aborted block: {}'.format(data[0]['index']))
+            return False
+        self.queue.append((blocks, peer, data, {'blocks': len(blocks), 'decode': decoded - start, 'verify': verified - decoded}))
+        self.last = blocks[-1]
+        if len(blocks) == len(data) and not (self.config.orphan_pool and self.last.hash in self.config.orphan_pool.children):
+            # Arrives while this one commits, unless the orphan pool already holds it
+            self.next_request = (request_next, self.last.index + 1)
+            await self.request_next_batch()
+        if self.running:
+            return True
+        self.running = True
+        self.config.peers.syncing = True
+        inserted = False
+        committed = False
+        try:
+            while self.queue:
+                blocks, peer, data, stats = self.queue.popleft()
+                await self.request_next_batch()
+                start = time()
+                committed = await self.commit(blocks, peer, data)
+                inserted = inserted or committed
+                stats['commit'] = time() - start
+                self.last_batch = stats
+                self.app_log.info('Imported {blocks} blocks, decode {decode:.3f}s, verify {verify:.3f}s, commit {commit:.3f}s'.format(**stats))
+                if not committed:
+                    # What was queued chains to a block that did not make it
+                    self.queue.clear()
+                    self.next_request = None
+        finally:
+            if not committed:
+                # Next batch chains to our tip again
+                self.last = None
+                self.next_request = None
+            self.running = False
+            self.config.peers.syncing = False
+        if inserted:
+            await self.config.consensus.trigger_update_event()
+        if self.config.orphan_pool:
+            # Orphans whose parent came with these batches
+            await self.config.orphan_pool.connect()
+        return inserted
+
+    async def request_next_batch(self):
+        """Asks for the batch after the last queued one, unless MAX_QUEUED batches already wait"""
+        if self.next_request and len(self.queue) < self.MAX_QUEUED:
+            request_next, start_index = self.next_request
+            self.next_request = None
+            await request_next(start_index, start_index + CHAIN.MAX_BLOCKS_PER_MESSAGE)
+
+    async def decode(self, data, last_block) -> list:
+        """Blocks of data that follow last_block and each other, up to the first that does not"""
+        blocks = []
+        for block_dict in data:
+            block = await Block.from_dict(block_dict)
+            if block.index != last_block.index + 1 or block.prev_hash != last_block.hash:
+                break
+            if block.in_the_future():
+                self.app_log.warning('Block in the future for height {}'.format(block.index))
+                break
+            blocks.append(block)
+            last_block = block
+        return blocks
+
+    async def verify(self, blocks) -> list:
+        """Runs Block.verify on all blocks at once, returns them up to the first that fails"""
+        if self.config.sig_verifier:
+            await self.config.sig_verifier.verify_blocks(blocks)
+        results = await gather(*[block.verify_async() for block in blocks], return_exceptions=True)
+        for i, (block, result) in enumerate(zip(blocks, results)):
+            if isinstance(result, Exception):
+                self.app_log.warning('Block {} did not verify: {}'.format(block.index, result))
+                return blocks[:i]
+            block.verified = True
+        return blocks
+
+    async def commit(self, blocks, peer, data) -> bool:
+        """Input and double spend checks then insert, block after block. False as soon as one is not inserted."""
+        consensus = self.config.consensus
+        for block in blocks:
+            await consensus.insert_consensus_block(block, peer)
+            if not await consensus.import_block({'peer': peer.to_string(), 'block': block, 'extra_blocks': data}, trigger_event=False):
+                # Bad block, or a retrace moved the tip
+                consensus.latest_block = await Block.from_dict(await self.config.BU.get_latest_block_async())
+                return False
+            consensus.latest_block = block
+        return True
@@ -0,0 +1,65 @@
+"""
+Invalidation of the *_cache collections when the chain changes.
+
+Chain derived cache entries are tagged with the height and block_hash they were built at.
+A rollback of every block >= index drops the entries at or above index, one indexed
+delete per collection, and the next lookup rebuilds them from the highest height left.
+Mempool based entries go once their transaction is mined.
+Driven by the config.on_new_block and config.on_blocks_removed events.
+"""
+
+from logging import getLogger
+
+from yadacoin.config import get_config
+
+
+class CacheInvalidator(object):
+    # Caches whose entries carry the height they were built at
+    COLLECTIONS = [
+        'get_transactions_cache',
+        'transactions_by_rid_cache',
+        'posts_cache',
+        'reacts_cache',
+        'comments_cache',
+        'friend_requests_cache',
+        'sent_friend_requests_cache',
+        'messages_cache'
+    ]
+
+    def __init__(self):
+        self.config = get_config()
+        self.mongo = self.config.mongo
+        self.app_log = getLogger('tornado.application')
+
+    async def on_new_block(self, block):
+        """Called by config.on_new_block once the block is stored in the blocks collection"""
+        ids = [txn.transaction_signature for txn in block.transactions]
+        if ids:
+            await self.mongo.async_db.miner_transactions_cache.delete_many({'id': {'$in': ids}})
+
+    async def on_blocks_removed(self, index):
+        """Called by config.on_blocks_removed once every block >= index was deleted from the blocks collection"""
+        for collection in self.COLLECTIONS:
+            await self.mongo.async_db[collection].delete_many({'height': {'$gte': index}})
+
+    async def catch_up(self):
+        """Drops what was cached from blocks that are no longer in the chain. Called once at startup."""
+        for collection in self.COLLECTIONS:
+            # Untagged entries from older versions can't be checked
+            await self.mongo.async_db[collection].delete_many({'cache_time': {'$exists': False}})
+            while True:
+                latest = await self.mongo.async_db[collection].find_one(
+                    {'block_hash': {'$ne': None}},
+                    {'height': 1, 'block_hash': 1},
+                    sort=[('height', -1)]
+                )
+                if not latest:
+                    break
+                block = await self.mongo.async_db.blocks.find_one(
+                    {'index': latest['height'], 'hash': latest['block_hash']},
+                    {'_id': 1}
+                )
+                if block:
+                    break
+                self.app_log.warning('{} out of sync at {}, dropping entries from there'.format(collection, latest['height']))
+                await self.mongo.async_db[collection].delete_many({'height': {'$gte': latest['height']}})
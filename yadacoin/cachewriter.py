@@ -0,0 +1,84 @@
+"""
+Write-behind batching for the *_cache collections.
+
+Cache warming used to issue one update or insert per transaction. A CacheWriter collects
+those writes and sends them as one bulk_write per collection, when asked to flush or once
+MAX_OPS writes or MAX_AGE seconds are pending. Ops keep their order within a collection,
+so the result is the same as the individual writes.
+Anything reading back a cache collection has to flush first.
+"""
+
+from logging import getLogger
+from time import time
+
+from pymongo import InsertOne, ReplaceOne, UpdateOne
+
+from yadacoin.config import get_config
+
+
+class CacheWriter(object):
+    MAX_OPS = 500
+    MAX_AGE = 5
+    # Called with (collection_name, ops) after every bulk_write, for tests and stats
+    flush_hooks = []
+
+    def __init__(self, max_ops=None, max_age=None):
+        self.config = get_config()
+        self.mongo = self.config.mongo
+        self.app_log = getLogger('tornado.application')
+        self.max_ops = max_ops or self.MAX_OPS
+        self.max_age = max_age or self.MAX_AGE
+        # collection name -> list of pending ops, dicts keep insertion order
+        self.pending = {}
+        self.count = 0
+        self.since = None
+
+    def add(self, collection, op):
+        if not self.count:
+            self.since = time()
+        self.pending.setdefault(collection, []).append(op)
+        self.count += 1
+
+    def replace(self, collection, query, document):
+        """Same as the former update(query, document, upsert=True)"""
+        self.add(collection, ReplaceOne(query, document, upsert=True))
+
+    def update(self, collection, query, update):
+        """Same as the former update(query, {'$set': ...}, upsert=True)"""
+        self.add(collection, UpdateOne(query, update, upsert=True))
+
+    def insert(self, collection, document):
+        self.add(collection, InsertOne(document))
+
+    @property
+    def due(self) -> bool:
+        return self.count >= self.max_ops or (self.count > 0 and time() - self.since >= self.max_age)
+
+    def take(self):
+        pending = self.pending
+        self.pending = {}
+        self.count = 0
+        self.since = None
+        return pending
+
+    def run_hooks(self, collection, ops):
+        for hook in self.flush_hooks:
+            hook(collection, ops)
+
+    def flush(self):
+        for collection, ops in self.take().items():
+            self.mongo.db[collection].bulk_write(ops, ordered=True)
+            self.run_hooks(collection, ops)
+
+    async def flush_async(self):
+        for collection, ops in self.take().items():
+            await self.mongo.async_db[collection].bulk_write(ops, ordered=True)
+            self.run_hooks(collection, ops)
+
+    def flush_if_due(self):
+        if self.due:
+            self.flush()
+
+    async def flush_if_due_async(self):
+        if self.due:
+            await self.flush_async()
@@ -26,6 +26,7 @@ class CHAIN(object):
     HALF_WEEK = 302400  # seconds
 
     MAX_BLOCKS_PER_MESSAGE = 200  # Not really a chain param, but better if coherent across peers
+    MAX_HEADERS_PER_MESSAGE = 2000  # Same, headers only, see HeaderSync
     MAX_RETRACE_DEPTH = 20  # Max allowed retrace. Deeper retrace would need manual chain truncating
 
     TIME_TOLERANCE = 10  # MAX # of seconds in the future we allow a bloc or TX to be. NTP Sync required for nodes.
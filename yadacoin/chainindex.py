@@ -0,0 +1,255 @@
+"""
+Incrementally maintained indexes derived from the blocks collection.
+
+The blocks collection stays the single source of truth. Everything here can be
+rebuilt from it, and is kept in sync through the config.on_new_block and
+config.on_blocks_removed events.
+"""
+
+from logging import getLogger
+
+from pymongo import ReplaceOne, UpdateOne, UpdateMany
+
+from yadacoin.addresscache import AddressCache
+from yadacoin.config import get_config
+
+
+class ChainIndex(object):
+    # Bump when the layout of the derived collections changes, forces a rebuild at next start
+    VERSION = 5
+    # balances and utxo amounts are stored as integers of 1e-8 coin, so incremental updates don't drift
+    COIN = 100000000
+
+    def __init__(self):
+        self.config = get_config()
+        self.mongo = self.config.mongo
+        self.app_log = getLogger('tornado.application')
+        # height and hash of the last block applied to the indexes
+        self.height = None
+        self.hash = None
+
+    @staticmethod
+    def is_external_input(txn_input: dict) -> bool:
+        # Same rule as Transaction.__init__
+        return 'signature' in txn_input and 'public_key' in txn_input and 'address' in txn_input
+
+    @classmethod
+    def to_amount(cls, value) -> int:
+        return int(round(float(value) * cls.COIN))
+
+    @staticmethod
+    def address_from_public_key(public_key: str) -> str:
+        return AddressCache.address(public_key)
+
+    async def get_meta(self):
+        return await self.mongo.async_db.chain_index.find_one({'name': 'meta'}, {'_id': 0})
+
+    async def set_meta(self, height, block_hash):
+        self.height = height
+        self.hash = block_hash
+        await self.mongo.async_db.chain_index.replace_one(
+            {'name': 'meta'},
+            {'name': 'meta', 'version': self.VERSION, 'height': height, 'hash': block_hash},
+            upsert=True
+        )
+
+    async def mark_dirty(self):
+        # Cleared by set_meta. If still there at startup, an update was interrupted and balances get rebuilt.
+        await self.mongo.async_db.chain_index.update_one({'name': 'meta'}, {'$set': {'dirty': True}})
+
+    async def on_new_block(self, block):
+        """Called by config.on_new_block once the block is stored in the blocks collection"""
+        await self.apply_block(block.to_dict())
+
+    async def on_blocks_removed(self, index):
+        """Called by config.on_blocks_removed once every block >= index was deleted from the blocks collection"""
+        if self.height is not None and self.height < index:
+            # Nothing of ours above that height, common case when appending a block
+            return
+        await self.rollback(index)
+        latest = await self.mongo.async_db.blocks.find_one({'index': {'$lt': index}}, {'_id': 0}, sort=[('index', -1)])
+        if latest:
+            await self.set_meta(latest['index'], latest['hash'])
+        else:
+            await self.set_meta(-1, '')
+
+    async def apply_block(self, block: dict):
+        """Applies a block dict to the derived collections. Writes are idempotent so a block can safely be replayed."""
+        height = block['index']
+        block_hash = block['hash']
+        transactions = []
+        address_keys = {}
+        outputs = []
+        spends = []
+        spent_outpoints = []
+        for position, txn in enumerate(block.get('transactions', [])):
+            flat_txn = dict(txn)
+            flat_txn.update({'height': height, 'block_hash': block_hash, 'position': position})
+            transactions.append(ReplaceOne({'id': txn['id'], 'height': height}, flat_txn, upsert=True))
+            if txn.get('public_key') and txn['public_key'] not in address_keys:
+                address_keys[txn['public_key']] = self.address_key_op(txn['public_key'], height)
+            for i, output in enumerate(txn.get('outputs', [])):
+                outputs.append(UpdateOne(
+                    {'id': txn['id'], 'index': i, 'address': output['to']},
+                    {'$set': {
+                        'id': txn['id'],
+                        'index': i,
+                        'address': output['to'],
+                        'value': float(output['value']),
+                        'amount': self.to_amount(output['value']),
+                        'public_key': txn['public_key'],
+                        'height': height,
+                        'block_hash': block_hash,
+                        'spent_by': None,
+                        'spent_height': None
+                    }},
+                    upsert=True
+                ))
+            for txn_input in txn.get('inputs', []):
+                spends.append((txn_input, txn))
+                spent_outpoints.append(UpdateOne(
+                    {'id': txn_input['id'], 'public_key': txn['public_key'], 'txn_id': txn['id']},
+                    {'$set': {
+                        'id': txn_input['id'],
+                        'public_key': txn['public_key'],
+                        'txn_id': txn['id'],
+                        'height': height,
+                        'block_hash': block_hash
+                    }},
+                    upsert=True
+                ))
+
+        balance_deltas = {}
+        for txn in block.get('transactions', []):
+            for output in txn.get('outputs', []):
+                balance_deltas[output['to']] = balance_deltas.get(output['to'], 0) + self.to_amount(output['value'])
+
+        # An external input spends the outputs that went to the creator of the input transaction
+        external_ids = list({txn_input['id'] for txn_input, txn in spends if self.is_external_input(txn_input)})
+        creators = {}
+        if external_ids:
+            async for utxo in self.mongo.async_db.utxos.find({'id': {'$in': external_ids}}, {'id': 1, 'public_key': 1}):
+                creators.setdefault(utxo['id'], utxo['public_key'])
+
+        spent_ops = []
+        spent_filters = []
+        for txn_input, txn in spends:
+            if self.is_external_input(txn_input):
+                if txn_input['id'] not in creators:
+                    continue
+                address = self.address_from_public_key(creators[txn_input['id']])
+            else:
+                address = self.address_from_public_key(txn['public_key'])
+            spent_filters.append({'id': txn_input['id'], 'address': address})
+            spent_ops.append(UpdateMany(
+                {'id': txn_input['id'], 'address': address, 'spent_height': None},
+                {'$set': {'spent_by': txn['id'], 'spent_height': height}}
+            ))
+
+        await self.mark_dirty()
+        if transactions:
+            await self.mongo.async_db.transactions.bulk_write(transactions, ordered=False)
+        if address_keys:
+            await self.mongo.async_db.address_keys.bulk_write(list(address_keys.values()), ordered=False)
+        # outputs first, so inputs spending a txn of the same block find it
+        if outputs:
+            await self.mongo.async_db.utxos.bulk_write(outputs, ordered=True)
+        if spent_ops:
+            # What is about to be spent, once, even if several inputs point to the same output
+            async for utxo in self.mongo.async_db.utxos.find({'$or': spent_filters, 'spent_height': None}, {'address': 1, 'amount': 1}):
+                balance_deltas[utxo['address']] = balance_deltas.get(utxo['address'], 0) - utxo['amount']
+            await self.mongo.async_db.utxos.bulk_write(spent_ops, ordered=True)
+        await self.apply_balance_deltas(balance_deltas)
+        if spent_outpoints:
+            await self.mongo.async_db.spent_outpoints.bulk_write(spent_outpoints, ordered=False)
+        await self.set_meta(height, block_hash)
+
+    def address_key_op(self, public_key, height):
+        address = self.address_from_public_key(public_key)
+        return UpdateOne(
+            {'address': address},
+            {'$setOnInsert': {'address': address, 'public_key': public_key, 'height': height}},
+            upsert=True
+        )
+
+    async def on_mempool_transaction(self, txn):
+        """Called by config.on_mempool_transaction once a transaction is admitted to miner_transactions"""
+        if txn.public_key:
+            await self.mongo.async_db.address_keys.bulk_write([self.address_key_op(txn.public_key, None)])
+
+    async def apply_balance_deltas(self, balance_deltas):
+        ops = [
+            UpdateOne({'address': address}, {'$inc': {'amount': amount}}, upsert=True)
+            for address, amount in balance_deltas.items() if amount
+        ]
+        if ops:
+            await self.mongo.async_db.balances.bulk_write(ops, ordered=False)
+
+    async def rebuild_balances(self):
+        await self.mongo.async_db.balances.delete_many({})
+        balance_deltas = {}
+        async for utxo in self.mongo.async_db.utxos.find({'spent_height': None}, {'address': 1, 'amount': 1}):
+            balance_deltas[utxo['address']] = balance_deltas.get(utxo['address'], 0) + utxo['amount']
+        await self.apply_balance_deltas(balance_deltas)
+
+    async def rollback(self, index):
+        """Removes the effects of every block >= index from the derived collections"""
+        await self.mark_dirty()
+        balance_deltas = {}
+        # created above index and still unspent: remove. Created and spent above index nets to 0.
+        async for utxo in self.mongo.async_db.utxos.find({'height': {'$gte': index}, 'spent_height': None}, {'address': 1, 'amount': 1}):
+            balance_deltas[utxo['address']] = balance_deltas.get(utxo['address'], 0) - utxo['amount']
+        # created below index, spent above: give back
+        async for utxo in self.mongo.async_db.utxos.find({'height': {'$lt': index}, 'spent_height': {'$gte': index}}, {'address': 1, 'amount': 1}):
+            balance_deltas[utxo['address']] = balance_deltas.get(utxo['address'], 0) + utxo['amount']
+        await self.apply_balance_deltas(balance_deltas)
+        await self.mongo.async_db.utxos.delete_many({'height': {'$gte': index}})
+        await self.mongo.async_db.utxos.update_many(
+            {'spent_height': {'$gte': index}},
+            {'$set': {'spent_by': None, 'spent_height': None}}
+        )
+        await self.mongo.async_db.spent_outpoints.delete_many({'height': {'$gte': index}})
+        await self.mongo.async_db.transactions.delete_many({'height': {'$gte': index}})
+        # address_keys is not rolled back: an address to public key pair stays true whatever the chain
+
+    async def reset(self):
+        await self.mongo.async_db.utxos.delete_many({})
+        await self.mongo.async_db.spent_outpoints.delete_many({})
+        await self.mongo.async_db.transactions.delete_many({})
+        await self.mongo.async_db.address_keys.delete_many({})
+        await self.mongo.async_db.balances.delete_many({})
+        await self.set_meta(-1, '')
+
+    async def find_common_height(self, height):
+        """Highest height <= height where our indexes and the blocks collection agree on the block hash"""
+        while height >= 0:
+            block = await self.mongo.async_db.blocks.find_one({'index': height}, {'hash': 1})
+            utxo = await self.mongo.async_db.utxos.find_one({'height': height}, {'block_hash': 1})
+            if block and utxo and utxo['block_hash'] == block['hash']:
+                return height
+            height -= 1
+        return -1
+
+    async def catch_up(self):
+        """Brings the indexes in line with the blocks collection. Called once at startup."""
+        meta = await self.get_meta()
+        dirty = meta and meta.get('dirty')
+        if not meta or meta.get('version') != self.VERSION:
+            self.app_log.warning('Chain index missing or outdated, rebuilding from blocks')
+            await self.reset()
+        else:
+            self.height = meta['height']
+            self.hash = meta['hash']
+            block = await self.mongo.async_db.blocks.find_one({'index': self.height}, {'hash': 1})
+            if self.height >= 0 and (not block or block['hash'] != self.hash):
+                common = await self.find_common_height(self.height)
+                self.app_log.warning('Chain index out of sync at {}, rolling back to {}'.format(self.height, common))
+                await self.on_blocks_removed(common + 1)
+
+        blocks = self.mongo.async_db.blocks.find({'index': {'$gt': self.height}}, {'_id': 0}).sort([('index', 1)])
+        async for block in blocks:
+            await self.apply_block(block)
+        if dirty and meta.get('version') == self.VERSION:
+            self.app_log.warning('Chain index update was interrupted, rebuilding balances')
+            await self.rebuild_balances()
+        self.app_log.info('Chain index up to date at height {}'.format(self.height))
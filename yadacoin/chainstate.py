@@ -0,0 +1,196 @@
+"""
+In-memory state of the active chain tip.
+
+Keeps the hash of every block of the active chain by height, the tip block and header,
+and the cumulative chainwork, so tip and "is this hash in our chain" questions need no db query.
+Every stored block also carries its own cumulative chainwork, as a hex string, so two forks
+compare by the chainwork of their tips.
+Kept in sync through the config.on_new_block and config.on_blocks_removed events.
+A compact snapshot is stored in the chain_state collection so startup only has to read
+the blocks above it.
+"""
+
+from logging import getLogger
+
+from pymongo import UpdateOne
+
+from yadacoin.chain import CHAIN
+from yadacoin.config import get_config
+from yadacoin.headercache import HeaderCache
+
+
+class ChainState(object):
+    # Bump when the snapshot layout changes, forces a rebuild at next start
+    VERSION = 1
+    # Hashes per snapshot document
+    CHUNK = 1000
+    # Blocks between two snapshots. Anything above the snapshot is read back from blocks at startup.
+    SNAPSHOT_INTERVAL = 100
+
+    def __init__(self):
+        self.config = get_config()
+        self.mongo = self.config.mongo
+        self.app_log = getLogger('tornado.application')
+        # hashes[height] is the hash of the active chain block at that height
+        self.hashes = []
+        self.chainwork = 0
+        # Latest block, as a dict. Same content as BU used to cache.
+        self.tip = None
+        self.tip_header = None
+        # Highest height the stored snapshot is known to match
+        self.saved_height = -1
+
+    @staticmethod
+    def get_work(block_hash: str) -> int:
+        # Same measure as Consensus.get_difficulty
+        return CHAIN.MAX_TARGET - int(block_hash, 16)
+
+    @property
+    def height(self) -> int:
+        return len(self.hashes) - 1
+
+    def get_hash(self, index):
+        """Hash of the active chain block at index, None if we have no such block"""
+        if 0 <= index < len(self.hashes):
+            return self.hashes[index]
+        return None
+
+    def contains(self, index, block_hash) -> bool:
+        return self.get_hash(index) == block_hash
+
+    @staticmethod
+    def to_hex(chainwork: int) -> str:
+        return hex(chainwork)[2:]
+
+    async def get_chainwork(self, index) -> int:
+        """Cumulative work of the active chain up to index included"""
+        if index < 0:
+            return 0
+        if index >= self.height:
+            return self.chainwork
+        block = await self.mongo.async_db.blocks.find_one({'index': index}, {'chainwork': 1})
+        if block and block.get('chainwork'):
+            return int(block['chainwork'], 16)
+        return self.chainwork - sum(self.get_work(block_hash) for block_hash in self.hashes[index + 1:])
+
+    async def index_chainwork(self):
+        """Sets the chainwork field of the blocks stored before it existed"""
+        ops = []
+        chainwork = 0
+        async for block in self.mongo.async_db.blocks.find({}, {'_id': 0, 'index': 1, 'hash': 1, 'chainwork': 1}).sort([('index', 1)]):
+            chainwork += self.get_work(block['hash'])
+            if not block.get('chainwork'):
+                ops.append(UpdateOne({'index': block['index'], 'hash': block['hash']}, {'$set': {'chainwork': self.to_hex(chainwork)}}))
+            if len(ops) >= 1000:
+                await self.mongo.async_db.blocks.bulk_write(ops, ordered=False)
+                ops = []
+        if ops:
+            await self.mongo.async_db.blocks.bulk_write(ops, ordered=False)
+
+    def append(self, block_hash):
+        self.hashes.append(block_hash)
+        self.chainwork += self.get_work(block_hash)
+
+    def truncate(self, index):
+        """Drops every hash >= index"""
+        index = max(index, 0)
+        for block_hash in self.hashes[index:]:
+            self.chainwork -= self.get_work(block_hash)
+        del self.hashes[index:]
+        self.saved_height = min(self.saved_height, self.height)
+
+    async def set_tip(self, block=None):
+        """Sets the tip from a block dict, or reads it from the blocks collection"""
+        if block is None and self.hashes:
+            block = await self.mongo.async_db.blocks.find_one({'index': self.height}, {'_id': 0})
+        self.tip = block
+        self.tip_header = HeaderCache.from_dict(block) if block else None
+
+    async def load(self):
+        """Restores the snapshot and reads the blocks above it. Called once at startup."""
+        self.hashes = []
+        self.chainwork = 0
+        self.saved_height = -1
+        meta = await self.mongo.async_db.chain_state.find_one({'name': 'meta'}, {'_id': 0})
+        if meta and meta.get('version') == self.VERSION:
+            chunks = self.mongo.async_db.chain_state.find({'name': 'hashes'}, {'_id': 0}).sort([('start', 1)])
+            async for chunk in chunks:
+                if chunk['start'] != len(self.hashes):
+                    break
+                self.hashes.extend(chunk['hashes'])
+            del self.hashes[meta['height'] + 1:]
+            intact = self.height == meta['height']
+            # The snapshot may be ahead of blocks or on another branch if we stopped mid rollback
+            height = self.height
+            while height >= 0:
+                block = await self.mongo.async_db.blocks.find_one({'index': height}, {'hash': 1})
+                if block and block['hash'] == self.hashes[height]:
+                    break
+                height -= 1
+            if intact and height == meta['height']:
+                self.chainwork = int(meta['chainwork'], 16)
+                self.saved_height = height
+            else:
+                self.app_log.warning('Chain state snapshot out of sync at {}, keeping up to {}'.format(meta['height'], height))
+                del self.hashes[height + 1:]
+                self.chainwork = sum(self.get_work(block_hash) for block_hash in self.hashes)
+        elif meta:
+            self.app_log.warning('Chain state snapshot outdated, rebuilding from blocks')
+        if not meta or not meta.get('blocks_chainwork'):
+            self.app_log.info('Computing the chainwork of stored blocks')
+            await self.index_chainwork()
+
+        blocks = self.mongo.async_db.blocks.find({'index': {'$gt': self.height}}, {'_id': 0, 'index': 1, 'hash': 1}).sort([('index', 1)])
+        async for block in blocks:
+            if block['index'] != self.height + 1:
+                break
+            self.append(block['hash'])
+        await self.set_tip()
+        await self.save()
+        self.app_log.info('Chain state loaded at height {}'.format(self.height))
+
+    async def save(self):
+        """Stores what changed since the last snapshot"""
+        start = (self.saved_height + 1) // self.CHUNK * self.CHUNK
+        for chunk_start in range(start, len(self.hashes), self.CHUNK):
+            await self.mongo.async_db.chain_state.replace_one(
+                {'name': 'hashes', 'start': chunk_start},
+                {'name': 'hashes', 'start': chunk_start, 'hashes': self.hashes[chunk_start:chunk_start + self.CHUNK]},
+                upsert=True
+            )
+        await self.mongo.async_db.chain_state.delete_many({'name': 'hashes', 'start': {'$gt': self.height}})
+        await self.mongo.async_db.chain_state.replace_one(
+            {'name': 'meta'},
+            {
+                'name': 'meta',
+                'version': self.VERSION,
+                'height': self.height,
+                'hash': self.get_hash(self.height),
+                'chainwork': self.to_hex(self.chainwork),
+                'blocks_chainwork': True
+            },
+            upsert=True
+        )
+        self.saved_height = self.height
+
+    async def on_new_block(self, block):
+        """Called by config.on_new_block once the block is stored in the blocks collection"""
+        if block.index <= self.height:
+            self.truncate(block.index)
+        if block.index != self.height + 1 or (block.index > 0 and block.prev_hash != self.get_hash(self.height)):
+            # Should not happen, the blocks below were replaced without notice. Start over from the db.
+            self.app_log.warning('Chain state out of step at {}, reloading'.format(block.index))
+            await self.load()
+            return
+        self.append(block.hash)
+        await self.set_tip(block.to_dict())
+        if self.height - self.saved_height >= self.SNAPSHOT_INTERVAL:
+            await self.save()
+
+    async def on_blocks_removed(self, index):
+        """Called by config.on_blocks_removed once every block >= index was deleted from the blocks collection"""
+        if index > self.height:
+            # Nothing of ours above that height, common case when appending a block
+            return
+        self.truncate(index)
+        await self.set_tip()
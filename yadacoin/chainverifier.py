@@ -0,0 +1,234 @@
+"""
+Streaming, resumable verification of the stored chain.
+
+Blocks are read with one cursor, by ascending index, and verified BATCH at a time through
+Blockchain.verify, each batch chained to the last block of the previous one, so memory stays
+flat with the chain length.
+After every verified batch a "verified through height H, hash X" checkpoint is stored in the
+chain_state collection. The next start resumes after it, as long as block H still has hash X,
+and only verifies the blocks added since.
+
+verify_parallel is the full re-verification mode, it ignores the checkpoint. The height range is
+split in CHUNK sized ranges verified by worker processes, each running Block.verify and
+Transaction.verify on its own blocks: hashes, RandomX PoW, signatures, merkle roots and inputs.
+The retarget and linkage checks, Blockchain.check_link, then run in one pass over header records,
+the retarget windows read from the records already streamed.
+Whatever any of them rejects is verified again sequentially from that height, so the result is
+the very same as Blockchain.verify.
+"""
+
+import asyncio
+import datetime
+import os
+from concurrent.futures import ProcessPoolExecutor
+from logging import getLogger
+from multiprocessing import get_context
+
+import yadacoin.config
+from yadacoin.block import Block, BlockHeader
+from yadacoin.blockchain import Blockchain
+from yadacoin.config import get_config, Config
+from yadacoin.headercache import HeaderCache
+from yadacoin.retarget import RetargetEngine
+
+
+def init_worker(config):
+    """Worker process setup, a node config with its own db clients"""
+    import yadacoin.blockchainutils
+    from yadacoin.graphutils import GraphUtils
+    from yadacoin.mongo import Mongo
+    yadacoin.config.CONFIG = Config(config)
+    worker_config = get_config()
+    worker_config.mongo = Mongo()
+    worker_config.BU = yadacoin.blockchainutils.BlockChainUtils()
+    yadacoin.blockchainutils.set_BU(worker_config.BU)
+    worker_config.GU = GraphUtils()
+
+
+def verify_range(start, end):
+    """Worker side. Returns the first height of start..end that fails, None if all pass."""
+    return asyncio.run(verify_range_async(start, end))
+
+
+async def verify_range_async(start, end):
+    config = get_config()
+    expected = start
+    for block_dict in config.mongo.db.blocks.find({'index': {'$gte': start, '$lte': end}}, {'_id': 0}).sort([('index', 1)]):
+        if block_dict['index'] != expected:
+            return expected
+        expected += 1
+        try:
+            block = await Block.from_dict(block_dict)
+            await config.BU.prefetch_inputs_async(block.transactions, spent=False)
+            block.verify()
+            for txn in block.transactions:
+                txn.verify()
+        except Exception:
+            return block_dict['index']
+    return None if expected > end else expected
+
+
+class ChainVerifier(object):
+    # Blocks per Blockchain.verify call, bounds memory
+    BATCH = 500
+    # Blocks per worker task in verify_parallel
+    CHUNK = 2000
+
+    def __init__(self):
+        self.config = get_config()
+        self.mongo = self.config.mongo
+        self.app_log = getLogger('tornado.application')
+
+    async def get_checkpoint(self):
+        """Stored checkpoint, None if there is none or if it is no longer part of the chain"""
+        checkpoint = await self.mongo.async_db.chain_state.find_one({'name': 'verified'}, {'_id': 0})
+        if not checkpoint:
+            return None
+        if await self.config.BU.get_block_hash(checkpoint['height']) != checkpoint['hash']:
+            self.app_log.warning('Verified checkpoint at {} is no longer in the chain, verifying from genesis'.format(checkpoint['height']))
+            return None
+        return checkpoint
+
+    async def set_checkpoint(self, block):
+        await self.mongo.async_db.chain_state.replace_one(
+            {'name': 'verified'},
+            {
+                'name': 'verified',
+                'height': block.index,
+                'hash': block.hash,
+                'time': int(datetime.datetime.now().timestamp())
+            },
+            upsert=True
+        )
+
+    async def verify_batch(self, batch, last_block):
+        """Verifies a list of block dicts chained to last_block, returns the result and the new last block"""
+        async def get_blocks():
+            for block in batch:
+                yield block
+        blockchain = await Blockchain.init_async(get_blocks(), partial=True)
+        return await blockchain.verify(last_block=last_block), blockchain.blocks[-1]
+
+    async def verify(self, progress=None):
+        """Verifies every block above the checkpoint, same result dict as Blockchain.verify"""
+        checkpoint = await self.get_checkpoint()
+        last_block = None
+        if checkpoint:
+            last_block = await self.get_block(checkpoint['height'])
+        return await self.verify_from(last_block, progress)
+
+    async def get_block(self, index):
+        return await Block.from_dict(await self.mongo.async_db.blocks.find_one({'index': index}, {'_id': 0}))
+
+    async def verify_from(self, last_block, progress=None):
+        """Verifies every block after last_block, from genesis if None"""
+        start = last_block.index + 1 if last_block else 0
+        latest = await self.config.BU.get_latest_block_async(False)
+        top = latest['index'] if latest else -1
+        if start > top:
+            self.app_log.info('Chain verified through {}, nothing new to verify'.format(top))
+            return {'verified': True}
+        self.app_log.info('Verifying blocks {} to {}'.format(start, top))
+
+        blocks = self.mongo.async_db.blocks.find({'index': {'$gte': start}}, {'_id': 0}).sort([('index', 1)]).batch_size(self.BATCH)
+        batch = []
+        async for block in blocks:
+            batch.append(block)
+            if len(batch) < self.BATCH:
+                continue
+            result, last_block = await self.verify_next(batch, last_block, start, top, progress)
+            if not result['verified']:
+                return result
+            batch = []
+        if batch:
+            result, last_block = await self.verify_next(batch, last_block, start, top, progress)
+            if not result['verified']:
+                return result
+        return {'verified': True}
+
+    async def verify_next(self, batch, last_block, start, top, progress):
+        """Verifies a batch of block dicts, moves the checkpoint and reports progress"""
+        result, batch_last_block = await self.verify_batch(batch, last_block)
+        if not result['verified']:
+            if result.get('last_good_block'):
+                await self.set_checkpoint(result['last_good_block'])
+            return result, last_block
+        last_block = batch_last_block
+        await self.set_checkpoint(last_block)
+        done = last_block.index - start + 1
+        percent = int(done * 100 / (top - start + 1)) if top >= start else 100
+        message = 'Verified through {} of {}, {}%'.format(last_block.index, top, min(percent, 100))
+        self.app_log.info(message)
+        if progress:
+            progress(message)
+        return result, last_block
+
+    async def verify_parallel(self, progress=None, workers=None):
+        """Verifies the whole chain again, ranges in parallel, same result dict as Blockchain.verify"""
+        latest = await self.config.BU.get_latest_block_async(False)
+        top = latest['index'] if latest else -1
+        if top < 0:
+            return {'verified': True}
+        workers = workers or os.cpu_count() or 1
+        ranges = [(start, min(start + self.CHUNK - 1, top)) for start in range(0, top + 1, self.CHUNK)]
+        self.app_log.info('Verifying blocks 0 to {} in {} ranges, {} workers'.format(top, len(ranges), workers))
+
+        failed = []
+        loop = asyncio.get_event_loop()
+        # spawn so workers do not inherit the mongo client threads
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=get_context('spawn'),
+            initializer=init_worker,
+            initargs=(self.config.to_dict(),)
+        ) as pool:
+            async def run(start, end):
+                try:
+                    return await loop.run_in_executor(pool, verify_range, start, end)
+                except Exception as e:
+                    # Broken worker, leave the range to the sequential pass
+                    self.app_log.warning('Verify worker error on {}-{}: {}'.format(start, end, e))
+                    return start
+
+            done = 0
+            for task in asyncio.as_completed([run(start, end) for start, end in ranges]):
+                bad = await task
+                if bad is not None:
+                    failed.append(bad)
+                done += 1
+                message = 'Verified {} of {} ranges, {}%'.format(done, len(ranges), int(done * 100 / len(ranges)))
+                self.app_log.info(message)
+                if progress:
+                    progress(message)
+
+        bad = await self.verify_links(top)
+        if bad is not None:
+            failed.append(bad)
+        if failed:
+            first = min(failed)
+            self.app_log.warning('Block {} did not verify, verifying sequentially from there'.format(first))
+            last_block = await self.get_block(first - 1) if first > 0 else None
+            return await self.verify_from(last_block, progress)
+        await self.set_checkpoint(await self.get_block(top))
+        return {'verified': True}
+
+    async def verify_links(self, top):
+        """Blockchain.check_link over the header records of the chain, returns the first failing height.
+        The retarget windows are read from a HeaderCache and RetargetEngine of the records streamed so far,
+        the node's only hold the latest blocks and would query every older one."""
+        headers = HeaderCache()
+        view = RetargetEngine(headers=headers)
+        last_header = None
+        async for block in self.mongo.async_db.blocks.find({'index': {'$lte': top}}, HeaderCache.PROJECTION).sort([('index', 1)]):
+            # get_target may set special_min, as it does on blocks, a record would not take it
+            header = BlockHeader.from_dict(block)
+            if last_header is None:
+                if header.index != 0:
+                    return 0
+            elif await Blockchain.check_link(header, last_header, view):
+                return header.index
+            record = HeaderCache.from_block(header)
+            headers.append(record)
+            view.append(record)
+            last_header = header
+        return None
@@ -62,6 +62,12 @@ class Config(object):
         self.fcm_key = config['fcm_key']
         self.post_peer = config.get('post_peer', True)
         self.extended_status = config.get('extended_status', False)
+        self.sig_workers = config.get('sig_workers', 0)  # signature verification processes, 0 for one per cpu
+        self.verify_workers = config.get('verify_workers', 1)  # block and transaction verification threads
+        self.randomx_vms = config.get('randomx_vms', 1)  # RandomX vms hashing concurrently
+        self.randomx_threads = config.get('randomx_threads', 0)  # threads handed to RandomX, 0 for one per cpu
+        self.randomx_mode = config.get('randomx_mode', 'light')  # light or fast, fast uses about 2GB more memory
+        self.address_cache_size = config.get('address_cache_size', 4096)  # public key to address derivations kept
         self.peers_seed = config.get('peers_seed', [])  # not used, superceeded by config/seed.json
         self.api_whitelist = config.get('api_whitelist', [])
         self.force_broadcast_to = config.get('force_broadcast_to', [])
@@ -77,10 +83,24 @@ class Config(object):
         self.peers = None
         self.BU = None
         self.GU = None
+        self.chain_state = None
+        self.chain_index = None
+        self.header_cache = None
+        self.retarget_engine = None
+        self.cache_invalidator = None
+        self.sig_verifier = None
+        self.verify_executor = None
+        self.rx_hasher = None
+        self.address_cache = None
+        self.block_importer = None
+        self.orphan_pool = None
         self.SIO = None
         self.debug = False
         self.mp = None
         self.pp = None
+        # Event loop lag, in seconds, see background_loop_lag in tnode.py
+        self.loop_lag = 0.0
+        self.max_loop_lag = 0.0
 
     async def on_new_block(self, block):
         """Dispatcher for the new bloc event
@@ -90,6 +110,39 @@ class Config(object):
         # self.BU.invalidate_last_block()
         block_dict = block.to_dict()
         self.BU.set_latest_block(block_dict)  # Warning, this is a dict, not a Block!
+        if self.chain_state:
+            await self.chain_state.on_new_block(block)
+        if self.header_cache:
+            await self.header_cache.on_new_block(block)
+        if self.retarget_engine:
+            await self.retarget_engine.on_new_block(block)
+        if self.chain_index:
+            await self.chain_index.on_new_block(block)
+        if self.cache_invalidator:
+            await self.cache_invalidator.on_new_block(block)
+        if self.orphan_pool:
+            await self.orphan_pool.on_new_block(block)
+
+    async def on_mempool_transaction(self, txn):
+        """Dispatcher for the new mempool transaction event
+        This is called with a transaction object once it was inserted in miner_transactions."""
+        if self.chain_index:
+            await self.chain_index.on_mempool_transaction(txn)
+
+    async def on_blocks_removed(self, index):
+        """Dispatcher for the removed blocks event
+        This is called with the lowest removed index after blocks >= index were deleted from the chain."""
+        self.BU.invalidate_latest_block()
+        if self.chain_state:
+            await self.chain_state.on_blocks_removed(index)
+        if self.header_cache:
+            await self.header_cache.on_blocks_removed(index)
+        if self.retarget_engine:
+            await self.retarget_engine.on_blocks_removed(index)
+        if self.chain_index:
+            await self.chain_index.on_blocks_removed(index)
+        if self.cache_invalidator:
+            await self.cache_invalidator.on_blocks_removed(index)
 
     def debug_log(self, string: str):
         # Helper to write temp string to a debug file
@@ -106,7 +159,18 @@ class Config(object):
                   # 'connections':{'outgoing': -1, 'ingoing': -1, 'max': -1},
                   'peers': self.peers.get_status(),
                   'pool': pool_status, 'height': self.BU.get_latest_block()['index'],
-                  'uptime': '{:d}:{:02d}:{:02d}'.format(h, m, s)}
+                  'uptime': '{:d}:{:02d}:{:02d}'.format(h, m, s),
+                  'loop_lag_ms': {'last': int(self.loop_lag * 1000), 'max': int(self.max_loop_lag * 1000)}}
+        if self.rx_hasher:
+            status['randomx'] = self.rx_hasher.get_status()
+        if self.address_cache:
+            status['address_cache'] = self.address_cache.get_status()
+        if self.orphan_pool:
+            status['orphans'] = self.orphan_pool.get_status()
+        if self.consensus:
+            status['validation'] = self.consensus.validation_stats
+        # max is since the previous status
+        self.max_loop_lag = 0.0
         # TODO: add uptime in human readable format
         return status
 
@@ -3,7 +3,6 @@ from sys import exc_info
 from os import path
 import json
 import logging
-import requests
 import datetime
 from bitcoin.wallet import P2PKHBitcoinAddress
 from time import time
@@ -17,6 +16,10 @@ from yadacoin.config import get_config
 from yadacoin.peers import Peers, Peer
 from yadacoin.blockchain import Blockchain
 from yadacoin.block import Block, BlockFactory
+from yadacoin.chainstate import ChainState
+from yadacoin.chainverifier import ChainVerifier
+from yadacoin.forktree import ForkTree
+from yadacoin.headersync import HeaderSync
 from yadacoin.transaction import InvalidTransactionException, InvalidTransactionSignatureException, \
     MissingInputTransactionException, NotEnoughMoneyException
 from urllib3.exceptions import *
@@ -37,6 +40,8 @@ class ForkException(Exception):
 class Consensus(object):
 
     lowest = CHAIN.MAX_TARGET
+    # integrate_block_with_existing_chain checks, in the order they run
+    VALIDATION_STAGES = ('structure', 'linkage', 'target', 'signatures', 'inputs', 'commit')
 
     def __init__(self, debug=False, peers=None, prevent_genesis=False):
         self.app_log = logging.getLogger("tornado.application")
@@ -48,9 +53,23 @@ class Consensus(object):
             self.peers = peers
         else:
             self.peers = Peers()
-    
+        # Candidate blocks near the tip, for retrace
+        self.fork_tree = ForkTree(self)
+        # passed, rejected and total seconds of each integrate stage
+        self.validation_stats = {stage: {'passed': 0, 'rejected': 0, 'seconds': 0.0} for stage in self.VALIDATION_STAGES}
+
     async def async_init(self):
-        latest_block = self.config.BU.get_latest_block()
+        if self.config.chain_state:
+            await self.config.chain_state.load()
+        if self.config.chain_index:
+            await self.config.chain_index.catch_up()
+        if self.config.header_cache:
+            await self.config.header_cache.load()
+        if self.config.retarget_engine:
+            await self.config.retarget_engine.load()
+        if self.config.cache_invalidator:
+            await self.config.cache_invalidator.catch_up()
+        latest_block = await self.config.BU.get_latest_block_async()
         if latest_block:
             self.latest_block = await Block.from_dict(latest_block)
         else:
@@ -84,9 +103,15 @@ class Consensus(object):
         },
         upsert=True)
         self.latest_block = genesis_block
+        await self.config.on_new_block(genesis_block)
 
-    async def verify_existing_blockchain(self, reset=False):
+    async def verify_existing_blockchain(self, reset=False, full=False):
+        """full verifies the whole chain again in parallel, else only what is above the verified checkpoint"""
         self.app_log.info('verifying existing blockchain')
+        if full:
+            result = await ChainVerifier().verify_parallel(self.output)
+        else:
+            result = await ChainVerifier().verify(self.output)
         if result['verified']:
             print('Block height: %s | time: %s' % (self.latest_block.index, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
             return True
@@ -95,13 +120,15 @@ class Consensus(object):
             if reset:
                 if 'last_good_block' in result:
                     self.mongo.db.blocks.remove({"index": {"$gt": result['last_good_block'].index}}, multi=True)
+                    await self.config.on_blocks_removed(result['last_good_block'].index + 1)
                 else:
                     self.mongo.db.blocks.remove({"index": {"$gt": 0}}, multi=True)
+                    await self.config.on_blocks_removed(1)
                 self.app_log.debug("{} {}".format(result['message'], '...truncating'))
             else:
                 self.app_log.critical("{} - reset False, not truncating - DID NOT VERIFY".format(result['message']))
             self.config.BU.latest_block = None
-            latest_block = self.config.BU.get_latest_block()
+            latest_block = await self.config.BU.get_latest_block_async()
             if latest_block:
                 self.latest_block = await Block.from_dict(latest_block)
             else:
@@ -121,67 +148,12 @@ class Consensus(object):
     def get_consensus_block_by_index(self, index):
         return self.get_consensus_blocks_by_index(index).limit(1)[0]
 
-    async def get_next_consensus_block_from_local(self, block):
-        #table cleanup
-        new_block = await self.mongo.async_db.consensus.find_one({
-            'block.prevHash': block.hash,
-            'block.index': (block.index + 1),
-            'block.version': CHAIN.get_version_for_height((block.index + 1))
-        })
-        if new_block:
-            new_block = await Block.from_dict( new_block['block'])
-            if int(new_block.version) == CHAIN.get_version_for_height(new_block.index):
-                return new_block
-            else:
-                return None
-        return None
-
-    async def get_previous_consensus_block_from_local(self, block, peer):
-        #table cleanup
-        new_block = await self.mongo.async_db.consensus.find_one({
-            'block.hash': block.prev_hash,
-            'block.index': (block.index - 1),
-            'block.version': CHAIN.get_version_for_height((block.index - 1)),
-            'ignore': {'$ne': True}
-        })
-        if new_block:
-            new_block = await Block.from_dict(new_block['block'])
-            if int(new_block.version) == CHAIN.get_version_for_height(new_block.index):
-                return new_block
-            else:
-                return None
-        return None
-
-    async def get_previous_consensus_block_from_remote(self, block, peer):
-        # TODO: async conversion
-        retry = 0
-        while True:
-            try:
-                url = 'http://' + peer.to_string() + '/get-block?hash=' + block.prev_hash
-                if self.debug:
-                    print('getting block', url)
-                res = requests.get(url, timeout=1, headers={'Connection':'close'})
-            except:
-                if retry == 1:
-                    raise BadPeerException()
-                else:
-                    retry += 1
-                    continue
-            try:
-                if self.debug:
-                    print('response code: ', res.status_code)
-                new_block = await Block.from_dict(json.loads(res.content.decode('utf-8')))
-                if int(new_block.version) == CHAIN.get_version_for_height(new_block.index):
-                    return new_block
-                else:
-                    return None
-            except:
-                return None
-
     async def insert_consensus_block(self, block, peer):
         if self.debug:
             self.app_log.info('inserting new consensus block for height and peer: %s %s' % (block.index, peer.to_string()))
 
+        self.fork_tree.add(block, peer.to_string())
+        chainwork = await self.get_chainwork(block)
         await self.mongo.async_db.consensus.replace_one({
             'id': block.to_dict().get('id'),
             'peer': peer.to_string()
@@ -190,9 +162,29 @@ class Consensus(object):
             'block': block.to_dict(),
             'index': block.to_dict().get('index'),
             'id': block.to_dict().get('id'),
-            'peer': peer.to_string()
+            'peer': peer.to_string(),
+            'chainwork': ChainState.to_hex(chainwork) if chainwork is not None else None
         }, upsert=True)
 
+    async def get_chainwork(self, block):
+        """Cumulative work of the chain ending with block, from our chain or the consensus candidates.
+        None if its previous block is known to neither."""
+        if block.index == 0:
+            return ChainState.get_work(block.hash)
+        if self.config.chain_state.get_hash(block.index - 1) == block.prev_hash:
+            previous = await self.config.chain_state.get_chainwork(block.index - 1)
+        else:
+            previous = await self.fork_tree.get_work(block.prev_hash)
+            if previous is None:
+                record = await self.mongo.async_db.consensus.find_one(
+                    {'block.hash': block.prev_hash, 'chainwork': {'$ne': None}},
+                    {'chainwork': 1}
+                )
+                if not record:
+                    return None
+                previous = int(record['chainwork'], 16)
+        return previous + ChainState.get_work(block.hash)
+
     async def sync_bottom_up(self):
         try:
             #bottom up syncing
@@ -265,6 +257,15 @@ class Consensus(object):
         # TODO: use an aio lock
         self.app_log.debug('requesting {} ...'.format(self.latest_block.index + 1))
 
+        # Far behind, headers first then bodies from all peers at once
+        self.peers.syncing = True
+        try:
+            if await HeaderSync().sync(polling_peers):
+                return
+        except Exception as e:
+            self.app_log.warning('Headers-first sync error: {}'.format(e))
+        finally:
+            self.peers.syncing = False
 
         # for peer in self.peers.peers:
         for peer_string in polling_peers:
@@ -353,13 +354,18 @@ class Consensus(object):
         await self.peers.on_block_insert(block)  # This will propagate to everyone
 
     async def import_block(self, block_data: dict, trigger_event=True) -> bool:
-        """Block_data contains peer and block keys. Tries to import that block, retrace if necessary
+        """Block_data contains peer and block keys, block is a dict or a Block. Tries to import that block, retrace if necessary
         sends True if that block was inserted, False if it fails or if a retrace was needed.
 
         This is the central entry point for inserting a block, that will modify the local chain and trigger the event,
         unless we asked not to, because we're in a batch insert context"""
         try:
-            block = await Block.from_dict(block_data['block'])
+            if isinstance(block_data['block'], Block):
+                # Already decoded and verified by the BlockImporter
+                block = block_data['block']
+                block_data = dict(block_data, block=block.to_dict())
+            else:
+                block = await Block.from_dict(block_data['block'])
             peer = Peer.from_string(block_data['peer'])
             if 'extra_blocks' in block_data:
                 extra_blocks = None
@@ -472,125 +478,194 @@ class Consensus(object):
         return True
 
     async def integrate_block_with_existing_chain(self, block: Block, extra_blocks=None):
-        """Even in case of retrace, this is the only place where we insert a new block into the block collection and update BU"""
+        """Even in case of retrace, this is the only place where we insert a new block into the block collection and update BU.
+        Checks run as VALIDATION_STAGES, cheapest first, and the first that fails ends it."""
         self.app_log.warning('integrate_block_with_existing_chain')
         try:
-            # TODO: reorg the checks, to have the faster ones first.
-            # Like, here we begin with checking every tx one by one, when <e did not even check index and provided hash matched previous one.
-            try:
-                block.verify()
-            except Exception as e:
-                self.app_log.warning("Integrate block error 1: {}".format(e))
+            if not await self.run_stage('structure', self.check_structure(block)):
+                return False
+            if block.index > 0:
+                await self.run_stage('linkage', self.check_linkage(block))
+                last_block = await self.run_stage('target', self.check_target(block))
+            if not await self.run_stage('signatures', self.check_signatures(block)):
                 return False
+            if block.index == 0:
+                # Nothing below it, no input can be spent yet
+                return True
+            if not await self.run_stage('inputs', self.check_inputs(block, extra_blocks)):
+                return False
+            return await self.run_stage('commit', self.commit_block(block, last_block))
+        except Exception as e:
+            from traceback import format_exc
+            self.app_log.warning("{}".format(format_exc()))
+            raise
 
-            await self.config.mongo.async_db.blocks.delete_many({'index': {'$gte': block.index}})
-            self.latest_block = await Block.from_dict(await self.config.BU.get_latest_block_async(False))
-
-            async def get_txns(txns):
-                for x in txns:
-                    yield x
-
-            async def get_inputs(inputs):
-                for x in inputs:
-                    yield x
-
-            used_inputs = {}
-            i = 0
-            async for transaction in get_txns(block.transactions):
-                self.app_log.warning('verifying txn: {} block: {}'.format(i, block.index))
-                i += 1
-                try:
-                    if extra_blocks:
-                        transaction.extra_blocks = extra_blocks
-                    transaction.verify()
-                except InvalidTransactionException as e:
-                    print(e)
-                    return False
-                except InvalidTransactionSignatureException as e:
-                    print(e)
-                    return False
-                except MissingInputTransactionException as e:
-                    print(e)
-                    return False
-                except NotEnoughMoneyException as e:
-                    print(e)
-                    return False
-                except Exception as e:
-                    print(e)
-                    return False
+    async def run_stage(self, name, check):
+        """Awaits one validation stage, adds its duration and outcome to validation_stats"""
+        stats = self.validation_stats[name]
+        start = time()
+        try:
+            result = await check
+        except Exception:
+            stats['rejected'] += 1
+            raise
+        finally:
+            stats['seconds'] += time() - start
+        if result is False:
+            stats['rejected'] += 1
+        else:
+            stats['passed'] += 1
+        return result
 
-                if transaction.inputs:
-                    failed = False
-                    used_ids_in_this_txn = []
-                    async for x in get_inputs(transaction.inputs):
-                        if self.config.BU.is_input_spent(x.id, transaction.public_key):
-                            failed = True
-                        if x.id in used_ids_in_this_txn:
-                            failed = True
-                        if (x.id, transaction.public_key) in used_inputs:
-                            failed = True
-                        used_inputs[(x.id, transaction.public_key)] = transaction
-                        used_ids_in_this_txn.append(x.id)
-                    if failed and block.index >= CHAIN.CHECK_DOUBLE_SPEND_FROM:
-                        raise MissingInputTransactionException()
-                    elif failed and block.index < CHAIN.CHECK_DOUBLE_SPEND_FROM:
-                        continue
-                        
+    async def check_structure(self, block: Block) -> bool:
+        """Version, time and merkle root, no db and no hashing beyond the transaction hashes"""
+        if int(block.version) != CHAIN.get_version_for_height(block.index):
+            self.app_log.warning("Integrate block error: wrong version {} for height {}".format(block.version, block.index))
+            return False
+        if block.in_the_future():
+            self.app_log.warning("Integrate block error: block {} in the future".format(block.index))
+            return False
+        # Block.verify does not hash the transactions again, nor does this stage after BlockImporter's verify
+        try:
+            block.check_merkle_root()
+        except Exception:
+            self.app_log.warning("Integrate block error: invalid merkle root for block {}".format(block.index))
+            return False
+        return True
 
-            if block.index == 0:
-                return True
-            height = block.index
-            last_block = await Block.from_dict(await self.config.mongo.async_db.blocks.find_one({'index': block.index - 1}))
-            if last_block.index != (block.index - 1) or last_block.hash != block.prev_hash:
-                self.app_log.warning("Integrate block error 2")
-                raise ForkException()
+    async def check_linkage(self, block: Block):
+        """Block has to build on our block at the previous height, from the in-memory chain state"""
+        if self.config.chain_state.get_hash(block.index - 1) != block.prev_hash:
+            self.app_log.warning("Integrate block error 2")
+            raise ForkException()
+
+    async def check_target(self, block: Block) -> Block:
+        """Retarget, then the block hash against the target. Returns the block before it.
+        Retarget windows are read by height below the block, so a block replacing ours is checked
+        against the chain below it without removing anything, commit_block does once it passed every stage."""
+        height = block.index
+        if self.latest_block and self.latest_block.index == block.index - 1 and self.latest_block.hash == block.prev_hash:
+            # Tip, no need to read it back
+            last_block = self.latest_block
+        else:
+            last_block = await self.config.mongo.async_db.blocks.find_one({'index': block.index - 1})
             if not last_block:
                 self.app_log.warning("Integrate block error 3")
                 raise ForkException()
+            last_block = await Block.from_dict(last_block)
+        if last_block.index != (block.index - 1) or last_block.hash != block.prev_hash:
+            self.app_log.warning("Integrate block error 4")
+            raise ForkException()
 
-            if height >= CHAIN.FORK_10_MIN_BLOCK:
-                target = await BlockFactory.get_target_10min(height, last_block, block)
-            else:
-                target = await BlockFactory.get_target(height, last_block, block)
-            delta_t = int(time()) - int(last_block.time)
-            special_target = CHAIN.special_target(block.index, block.target, delta_t, get_config().network)
-            target_block_time = CHAIN.target_block_time(self.config.network)
-
-            if block.index >= 35200 and delta_t < 600 and block.special_min:
-                raise Exception('Special min block too soon')
-
-            # TODO: use a CHAIN constant for pow blocks limits
-            if ((int(block.hash, 16) < target) or
-                (block.special_min and int(block.hash, 16) < special_target) or
-                (block.special_min and block.index < 35200) or
-                (block.index >= 35200 and block.index < 38600 and block.special_min and
-                (int(block.time) - int(last_block.time)) > target_block_time)):
-
-                if last_block.index == (block.index - 1) and last_block.hash == block.prev_hash:
-                    # self.mongo.db.blocks.update({'index': block.index}, block.to_dict(), upsert=True)
-                    # self.mongo.db.blocks.remove({'index': {"$gt": block.index}}, multi=True)
-                    # todo: is this useful? can we have more blocks above? No because if we had, we would have raised just above
-                    await self.mongo.async_db.block.delete_many({'index': {"$gte": block.index}})
-                    db_block = block.to_dict()
-                    db_block['updated_at'] = time()
-                    await self.mongo.async_db.blocks.replace_one({'index': block.index}, db_block, upsert=True)
-                    await self.mongo.async_db.miner_transactions.delete_many({'id': {'$in': [x.transaction_signature for x in block.transactions]}})
-                    self.latest_block = await Block.from_dict(await self.config.BU.get_latest_block_async(False))
-                    if self.debug:
-                        self.app_log.info("New block inserted for height: {}".format(block.index))
-                    await self.config.on_new_block(block)  # This will propagate to BU
-                    return True
-                else:
-                    self.app_log.warning("Integrate block error 4")
-                    raise ForkException()
-            else:
-                self.app_log.warning("Integrate block error 5")
-                raise AboveTargetException()
-            return False  # unreachable code
+        if height >= CHAIN.FORK_10_MIN_BLOCK:
+            target = await BlockFactory.get_target_10min(height, last_block, block)
+        else:
+            target = await BlockFactory.get_target(height, last_block, block)
+        delta_t = int(time()) - int(last_block.time)
+        special_target = CHAIN.special_target(block.index, block.target, delta_t, get_config().network)
+        target_block_time = CHAIN.target_block_time(self.config.network)
+
+        if block.index >= 35200 and delta_t < 600 and block.special_min:
+            raise Exception('Special min block too soon')
+
+        # TODO: use a CHAIN constant for pow blocks limits
+        if not ((int(block.hash, 16) < target) or
+            (block.special_min and int(block.hash, 16) < special_target) or
+            (block.special_min and block.index < 35200) or
+            (block.index >= 35200 and block.index < 38600 and block.special_min and
+            (int(block.time) - int(last_block.time)) > target_block_time)):
+            self.app_log.warning("Integrate block error 5")
+            raise AboveTargetException()
+        return last_block
+
+    async def check_signatures(self, block: Block) -> bool:
+        """Block.verify, the block hash is recomputed, RandomX included, and the signatures checked"""
+        try:
+            if not block.verified:
+                if self.config.sig_verifier:
+                    # Failed signatures are left to block.verify and transaction.verify, for the same errors
+                    await self.config.sig_verifier.verify_blocks([block])
+                await block.verify_async()
         except Exception as e:
-            from traceback import format_exc
-            self.app_log.warning("{}".format(format_exc()))
-            raise
+            self.app_log.warning("Integrate block error 1: {}".format(e))
+            return False
+        return True
+
+    async def check_inputs(self, block: Block, extra_blocks=None) -> bool:
+        """Transaction.verify with their input transactions, then double spends within the block and against the chain"""
+        async def get_txns(txns):
+            for x in txns:
+                yield x
+
+        async def get_inputs(inputs):
+            for x in inputs:
+                yield x
+
+        used_inputs = {}
+        # Input transactions and spends of the chain below the block, blocks it replaces are still stored
+        spent_inputs = await self.config.BU.prefetch_inputs_async(block.transactions, below_height=block.index)
+        i = 0
+        async for transaction in get_txns(block.transactions):
+            self.app_log.warning('verifying txn: {} block: {}'.format(i, block.index))
+            i += 1
+            try:
+                if extra_blocks:
+                    transaction.extra_blocks = extra_blocks
+                await transaction.verify_async()
+            except InvalidTransactionException as e:
+                print(e)
+                return False
+            except InvalidTransactionSignatureException as e:
+                print(e)
+                return False
+            except MissingInputTransactionException as e:
+                print(e)
+                return False
+            except NotEnoughMoneyException as e:
+                print(e)
+                return False
+            except Exception as e:
+                print(e)
+                return False
+
+            if transaction.inputs:
+                failed = False
+                used_ids_in_this_txn = []
+                async for x in get_inputs(transaction.inputs):
+                    if (x.id, transaction.public_key) in spent_inputs:
+                        failed = True
+                    if x.id in used_ids_in_this_txn:
+                        failed = True
+                    if (x.id, transaction.public_key) in used_inputs:
+                        failed = True
+                    used_inputs[(x.id, transaction.public_key)] = transaction
+                    used_ids_in_this_txn.append(x.id)
+                if failed and block.index >= CHAIN.CHECK_DOUBLE_SPEND_FROM:
+                    raise MissingInputTransactionException()
+                elif failed and block.index < CHAIN.CHECK_DOUBLE_SPEND_FROM:
+                    continue
+        return True
+
+    async def commit_block(self, block: Block, last_block: Block) -> bool:
+        """Stores the block on top of last_block and triggers on_new_block"""
+        if block.index <= self.config.chain_state.height:
+            # Replaces blocks of ours, only now that it passed every stage
+            await self.mongo.async_db.blocks.delete_many({'index': {'$gte': block.index}})
+            await self.config.on_blocks_removed(block.index)
+        # todo: is this useful? can we have more blocks above? No because if we had, we would have raised just above
+        await self.mongo.async_db.block.delete_many({'index': {"$gte": block.index}})
+        db_block = block.to_dict()
+        db_block['updated_at'] = time()
+        db_block['chainwork'] = ChainState.to_hex(
+            await self.config.chain_state.get_chainwork(block.index - 1) + ChainState.get_work(block.hash)
+        )
+        await self.mongo.async_db.blocks.replace_one({'index': block.index}, db_block, upsert=True)
+        await self.mongo.async_db.miner_transactions.delete_many({'id': {'$in': [x.transaction_signature for x in block.transactions]}})
+        self.latest_block = block
+        if self.debug:
+            self.app_log.info("New block inserted for height: {}".format(block.index))
+        await self.config.on_new_block(block)  # This will propagate to BU
+        return True
     
     def get_difficulty(self, blocks):
         """Computes a list of blocks difficulty. This is the sum of the distance to the highest possible target"""
@@ -600,163 +675,84 @@ class Consensus(object):
             difficulty += (CHAIN.MAX_TARGET - target)
         return difficulty
 
+    async def reject_branch(self, blocks, peer):
+        """Marks blocks ignored in the consensus collection and drops them from the fork tree"""
+        if peer.is_me:
+            return
+        for block in blocks:
+            await self.mongo.async_db.consensus.update_many({'block.hash': block.hash}, {'$set': {'ignore': True}})
+            self.fork_tree.remove(block.hash)
+
+    async def restore_blocks(self, blocks):
+        """Integrates back our blocks a retrace replaced before one of the incoming branch failed"""
+        for block in blocks:
+            try:
+                if not await self.integrate_block_with_existing_chain(block):
+                    raise Exception('not integrated')
+            except Exception as e:
+                # Left to sync from peers
+                self.app_log.warning('Could not restore block {} after a failed retrace: {}'.format(block.index, e))
+                return
+        self.app_log.info('Restored our blocks {} to {} after a failed retrace'.format(blocks[0].index, blocks[-1].index))
+
     async def retrace(self, block, peer):
-        """We got a non compatible block. Retrace other chains to find a common ancestor and evaluate chains."""
-        # TODO: more async conversion TBD here. Low priority since not called often atm.
-        # TODO: cleanup print and logging
-        # TODO: limit possible retrace blocks vs max(known chains) - store in chain config
+        """We got a non compatible block. Find its branch back to our chain in the fork tree and evaluate chains."""
         try:
             self.app_log.info("Retracing...")
-            blocks = [block]
-            while 1:
-                if self.debug:
-                    self.app_log.info("{} : {}".format(block.hash, block.index))
-                # get the previous block from either the consensus collection in mongo
-                # or attempt to get the block from the remote peer
-                previous_consensus_block = await self.get_previous_consensus_block_from_local(block, peer)
-                if previous_consensus_block:
-                        block = previous_consensus_block
-                        blocks.append(block)
-                else:
-                    if peer.is_me:
-                        self.mongo.db.consensus.update({'peer': peer.to_string(), 'index': {'$gte': block.index}}, {'$set': {'ignore': True}}, multi=True)
-                        return
+            # Fork point within MAX_RETRACE_DEPTH, missing ancestors are fetched by range
+            blocks = await self.fork_tree.get_branch(block, peer)
+            if not blocks:
+                if peer.is_me:
+                    await self.mongo.async_db.consensus.update_many({'peer': peer.to_string(), 'index': {'$gte': block.index}}, {'$set': {'ignore': True}})
+                self.app_log.info("Retrace result: doesn't follow any known chain")  # throwing out the block for now
+                return
+            if self.debug:
+                self.app_log.debug("Fork point {}: {}".format(blocks[0].prev_hash, blocks[0].index - 1))
+            blocks.extend(await self.fork_tree.extend(blocks[-1], peer))
+
+            # If the block height is equal, we throw out the inbound chain, it muse be greater
+            # If the block height is lower, we throw it out
+            # if the block height is heigher, we compare the chainwork of both tips.
+            # Both share the chainwork up to the fork point, so this is the difficulty of the branches.
+            existing_chainwork = self.config.chain_state.chainwork
+            existing_blockchain_index = self.config.chain_state.height
+            inbound_chainwork = await self.fork_tree.get_work(blocks[-1].hash)
+            if inbound_chainwork is None:
+                self.app_log.info("Retrace result: branch does not link to our chain")
+                return
+
+            if (blocks[-1].index >= existing_blockchain_index
+                and inbound_chainwork >= existing_chainwork):
+                # Ours from the fork point, put back if the branch does not integrate in full
+                replaced = [
+                    await Block.from_dict(x)
+                    async for x in self.mongo.async_db.blocks.find({'index': {'$gte': blocks[0].index}}, {'_id': 0}).sort([('index', 1)])
+                ]
+                for position, block in enumerate(blocks):
                     try:
-                        previous_consensus_block = await self.get_previous_consensus_block_from_remote(block, peer)
-                    except BadPeerException as e:
-                        self.mongo.db.consensus.update({'peer': peer.to_string(), 'index': {'$gte': block.index}}, {'$set': {'ignore': True}}, multi=True)
-                    except:
-                        pass
-                    if previous_consensus_block and previous_consensus_block.index + 1 == block.index:
-                        block = previous_consensus_block
-                        blocks.append(block)
-                        try:
-                            await self.insert_consensus_block(block, peer)
-                        except Exception as e:
-                            if self.debug:
-                                self.app_log.warning("Exception retrace insert_consensus_block: {}".format(e))  # we should do something here to keep it from looping on this failed block
-                    else:
-                        # identify missing and prune
-                        # if the pruned chain is still longer, we'll take it
-                        if previous_consensus_block:
-                            block = previous_consensus_block
-                            blocks = [block]
-                        else:
-                            return
-                latest_block = await self.config.mongo.async_db.blocks.find_one({'index': block.index - 1})
-                # if they do have it, query our consensus collection for prevHash of that block, repeat 1 and 2 until index 1
-                if latest_block['hash'] == block.prev_hash:
-                    prev_blocks_check = await Block.from_dict(latest_block)
-                    if self.debug:
-                        self.app_log.debug("Previous block {}: {}".format(prev_blocks_check.hash, prev_blocks_check.index))
-                    blocks = sorted(blocks, key=lambda x: x.index)
-                    block_for_next = blocks[-1]
-                    while 1:
-                        next_block = await self.get_next_consensus_block_from_local(block_for_next)
-                        if next_block:
-                            blocks.append(next_block)
-                            block_for_next = next_block
-                        else:
-                            break
-
-                    # self.peers.init(self.config.network)
-
-                    self.app_log.debug('requesting {} ...'.format(block_for_next.index + 1))
-                    for apeer in self.peers.peers:
-                        # TODO: there was a "while 1:" there, that got the retrace stuck with only 1 peer and no escape route.
-                        # recheck the logic.
-                        try:
-                            # if self.debug:
-                            #     self.app_log.debug('requesting {} from {}'.format(block_for_next.index + 1, apeer.to_string()))
-                            result = requests.get('http://{peer}/get-blocks?start_index={start_index}&end_index={end_index}'.format(
-                                peer=apeer.to_string(),
-                                start_index=block_for_next.index + 1,
-                                end_index=block_for_next.index + 100
-                            ), timeout=1)
-                            remote_blocks = [await Block.from_dict( x) for x in json.loads(result.content.decode())]
-                            break_out = False
-                            for remote_block in remote_blocks:
-                                if remote_block.prev_hash == block_for_next.hash:
-                                    blocks.append(remote_block)
-                                    block_for_next = remote_block
-                                else:
-                                    break_out = True
-                                    break
-                            if break_out:
-                                break
-                        except Exception as e:
-                            if self.debug:
-                                print(e)
-                            break
-
-                    # If the block height is equal, we throw out the inbound chain, it muse be greater
-                    # If the block height is lower, we throw it out
-                    # if the block height is heigher, we compare the difficulty of the entire chain
-                    existing_blockchain = await Blockchain.init_async(self.config.mongo.async_db.blocks.find({'index': {'$gte': blocks[0].index}}), partial=True)
-                    if existing_blockchain:
-                        existing_difficulty = self.get_difficulty(existing_blockchain.blocks)
-                        existing_blockchain_index = existing_blockchain.blocks[-1].index
-                    else:
-                        existing_difficulty = 0
-                        existing_blockchain_index = latest_block['index']
-
-                    inbound_difficulty = self.get_difficulty(blocks)
-
-                    if (blocks[-1].index >= existing_blockchain_index
-                        and inbound_difficulty >= existing_difficulty):
-                        for block in blocks:
-                            try:
-                                if block.index == 0:
-                                    continue
-                                await self.integrate_block_with_existing_chain(block)
-                                if self.debug:
-                                    self.app_log.debug('inserted {}'.format(block.index))
-                            except ForkException as e:
-                                back_one_block = block
-                                while 1:
-                                    back_one_block = await self.mongo.async_db.consensus.find_one({'block.hash': back_one_block.prev_hash})
-                                    if back_one_block:
-                                        back_one_block = await Block.from_dict( back_one_block['block'])
-                                        if back_one_block.index < self.latest_block.index: # If its index less than latest, it won't get integrated
-                                            break
-                                        try:
-                                            result = await self.integrate_block_with_existing_chain(back_one_block)
-                                            if result:
-                                                await self.integrate_block_with_existing_chain(block)
-                                                break
-                                        except ForkException as e:
-                                            pass
-                                    else:
-                                        return
-                            except AboveTargetException as e:
-                                return
-                            except IndexError as e:
-                                return
-                        self.app_log.info("Retrace result: replaced chain with incoming")
-                        return
-                    else:
-                        if not peer.is_me:
-                            if self.debug:
-                                self.app_log.info("Incoming chain lost {} {} {} {}"
-                                                  .format(inbound_difficulty, existing_difficulty, blocks[-1].index,
-                                                          await self.config.BU.get_latest_block_async().index)
-                                                  )
-                            for block in blocks:
-                                self.mongo.db.consensus.update({'block.hash': block.hash}, {'$set': {'ignore': True}}, multi=True)
+                        integrated = await self.integrate_block_with_existing_chain(block)
+                    except Exception as e:
+                        # ForkException, AboveTargetException or anything integrate raised
+                        self.app_log.info('Retrace block {} rejected: {} {}'.format(block.index, e.__class__.__name__, e))
+                        integrated = False
+                    if not integrated:
+                        await self.reject_branch(blocks[position:], peer)
+                        if position:
+                            await self.restore_blocks(replaced)
                         return
-                # lets go down the hash path to see where prevHash is in our blockchain, hopefully before the genesis block
-                # we need some way of making sure we have all previous blocks until we hit a block with prevHash in our main blockchain
-                #there is no else, we just loop again
-                # if we get to index 1 and prev hash doesn't match the genesis, throw out the chain and black list the peer
-                # if we get a fork point, prevHash is found in our consensus or genesis, then we compare the current
-                # blockchain against the proposed chain.
-
-                # TODO: Here, compare vs current known consensus height, and limit to consensus height - CHAIN.MAX_RETRACE_DEPTH
-                if block.index == 0:
-                    self.app_log.info("Retrace result: zero index reached")
-                    return
-            self.app_log.info("Retrace result: doesn't follow any known chain")  # throwing out the block for now
-            return
+                    if self.debug:
+                        self.app_log.debug('inserted {}'.format(block.index))
+                self.app_log.info("Retrace result: replaced chain with incoming")
+                return
+            else:
+                if not peer.is_me:
+                    if self.debug:
+                        self.app_log.info("Incoming chain lost {} {} {} {}"
+                                          .format(inbound_chainwork, existing_chainwork, blocks[-1].index,
+                                                  existing_blockchain_index)
+                                          )
+                    await self.reject_branch(blocks, peer)
+                return
         except Exception as e:
             exc_type, exc_obj, exc_tb = exc_info()
             fname = path.split(exc_tb.tb_frame.f_code.co_filename)[1]
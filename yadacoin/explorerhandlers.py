@@ -12,6 +12,16 @@ from yadacoin.common import changetime, abstract_block
 
 class ExplorerSearchHandler(BaseHandler):
 
+    def find_blocks_by_transaction(self, query, limit=0):
+        """Finds the blocks holding transactions matching query, through the indexed transactions collection"""
+        heights = []
+        for x in self.mongo.db.transactions.find(query, {'_id': 0, 'height': 1}).sort('height', -1):
+            if x['height'] not in heights:
+                heights.append(x['height'])
+            if limit and len(heights) >= limit:
+                break
+        return self.mongo.db.blocks.find({'index': {'$in': heights}}, {'_id': 0}).sort('index', -1)
+
     async def get(self):
         term = self.get_argument("term", False)
         if not term:
@@ -37,7 +47,7 @@ class ExplorerSearchHandler(BaseHandler):
         except:
             pass
         try:
-            res = self.mongo.db.blocks.find({'transactions.public_key': term}, {'_id': 0})
+            res = self.find_blocks_by_transaction({'public_key': term})
             if res.count():
                 return self.render_as_json({
                     'resultType': 'block_height',
@@ -69,7 +79,7 @@ class ExplorerSearchHandler(BaseHandler):
 
         try:
             re.search(r'[A-Fa-f0-9]{64}', term).group(0)
-            res = self.mongo.db.blocks.find({'transactions.hash': term}, {'_id': 0})
+            res = self.find_blocks_by_transaction({'hash': term})
             if res.count():
                 return self.render_as_json({
                     'resultType': 'txn_hash',
@@ -80,7 +90,7 @@ class ExplorerSearchHandler(BaseHandler):
 
         try:
             re.search(r'[A-Fa-f0-9]{64}', term).group(0)
-            res = self.mongo.db.blocks.find({'transactions.rid': term}, {'_id': 0})
+            res = self.find_blocks_by_transaction({'rid': term})
             if res.count():
                 return self.render_as_json({
                     'resultType': 'txn_rid',
@@ -91,7 +101,7 @@ class ExplorerSearchHandler(BaseHandler):
 
         try:
             base64.b64decode(term)
-            res = self.mongo.db.blocks.find({'transactions.id': term}, {'_id': 0})
+            res = self.find_blocks_by_transaction({'id': term})
             if res.count():
                 return self.render_as_json({
                     'resultType': 'txn_id',
@@ -102,13 +112,14 @@ class ExplorerSearchHandler(BaseHandler):
 
         try:
             re.search(r'[A-Fa-f0-9]+', term).group(0)
-            res = self.mongo.db.blocks.find({'transactions.outputs.to': term}, {'_id': 0}).sort('index', -1).limit(10)
+            res = self.find_blocks_by_transaction({'outputs.to': term}, limit=10)
             if res.count():
                 async for x in BU().get_wallet_balance(term):
                     balance = x
                     break
                 return self.render_as_json({
                     'balance': "{0:.8f}".format(balance),
+                    'public_key': await BU().get_public_key_by_address_async(term),
                     'resultType': 'txn_outputs_to',
                     'result': [changetime(x) for x in res]
                 })
@@ -125,7 +136,8 @@ class ExplorerGetBalance(BaseHandler):
         if not address:
             self.render_as_json({})
             return
-        balance = await BU().get_wallet_balance(address)
+        balances = await BU().get_wallet_balances([address])
+        balance = balances[address]
         return self.render_as_json({
             'balance': "{0:.8f}".format(balance)
         })
@@ -148,7 +160,7 @@ class ExplorerLast50(BaseHandler):
 
     async def get(self):
         """Returns abstract of the latest 50 blocks miners"""
-        latest = self.config.BU.get_latest_block()
+        latest = await self.config.BU.get_latest_block_async()
         pipeline = [
                     {
                        '$match' : { 'index' : {'$gte': latest['index'] - 50} }
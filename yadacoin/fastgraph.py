@@ -65,6 +65,8 @@ class FastGraph(Transaction):
         self.hash = txn_hash
         self.outputs = []
         self.extra_blocks = extra_blocks
+        self.signature_verified = False
+        self.input_txns = None
         self.raw = raw
         for x in outputs:
             self.outputs.append(Output.from_dict(x))
@@ -0,0 +1,206 @@
+"""
+In-memory tree of the candidate blocks competing with our chain near its tip.
+
+retrace used to walk a foreign branch back one block at a time, a consensus collection query then a
+blocking http request for each block it did not have, rebuilding chains to compare their work.
+ForkTree keeps the candidates by hash, linked through prev_hash, with the cumulative work of their
+branch once it is known. It is fed by Consensus.insert_consensus_block, peer announcements included,
+and by one consensus query per retrace for all the heights in reach.
+Missing ancestors are asked to the peer MAX_BLOCKS_PER_MESSAGE heights at a time, so a reorg as deep
+as MAX_RETRACE_DEPTH resolves in a round trip or two.
+best_tip follows the descendants of a block with the most cumulative work.
+Candidates more than MAX_RETRACE_DEPTH below our tip are pruned. The tree holds at most MAX_NODES,
+past that the candidate with the least work that no other builds on makes room for one with more.
+"""
+
+import json
+from logging import getLogger
+
+from tornado.httpclient import HTTPRequest
+from tornado.httputil import HTTPHeaders
+
+from yadacoin.block import Block
+from yadacoin.chain import CHAIN
+from yadacoin.chainstate import ChainState
+from yadacoin.config import get_config
+
+
+class ForkNode(object):
+    __slots__ = ('block', 'peer', 'work')
+
+    def __init__(self, block, peer=None):
+        self.block = block
+        self.peer = peer
+        # Cumulative work of the chain ending with block, once it links to ours
+        self.work = None
+
+
+class ForkTree(object):
+    # Candidates held at most
+    MAX_NODES = 1000
+
+    def __init__(self, consensus):
+        self.config = get_config()
+        self.mongo = self.config.mongo
+        self.app_log = getLogger('tornado.application')
+        self.consensus = consensus
+        # hash: ForkNode
+        self.nodes = {}
+        # prev_hash: set of hashes
+        self.children = {}
+
+    def add(self, block, peer=None) -> ForkNode:
+        """Adds a candidate block, peer is the string of the peer it came from.
+        None if the tree is full of candidates with more work."""
+        node = self.nodes.get(block.hash)
+        if node:
+            return node
+        if len(self.nodes) >= self.MAX_NODES:
+            self.prune()
+        if len(self.nodes) >= self.MAX_NODES:
+            # All within retrace reach, candidates are not checked yet: the least work goes
+            leaf = self.get_weakest_leaf()
+            if ChainState.get_work(block.hash) <= ChainState.get_work(leaf):
+                return None
+            self.remove(leaf)
+        node = ForkNode(block, peer)
+        self.nodes[block.hash] = node
+        self.children.setdefault(block.prev_hash, set()).add(block.hash)
+        return node
+
+    def remove(self, block_hash):
+        node = self.nodes.pop(block_hash, None)
+        if node is None:
+            return
+        siblings = self.children.get(node.block.prev_hash)
+        if siblings is not None:
+            siblings.discard(block_hash)
+            if not siblings:
+                del self.children[node.block.prev_hash]
+
+    def get_weakest_leaf(self):
+        """Hash of the candidate with the least work among those no other candidate builds on"""
+        leaves = [block_hash for block_hash in self.nodes if block_hash not in self.children]
+        # Made up hashes can link in a loop, without a leaf
+        return min(leaves or self.nodes, key=ChainState.get_work)
+
+    def prune(self):
+        """Drops the candidates out of retrace reach"""
+        floor = self.config.chain_state.height - CHAIN.MAX_RETRACE_DEPTH
+        for block_hash in [block_hash for block_hash, node in self.nodes.items() if node.block.index < floor]:
+            self.remove(block_hash)
+
+    async def get_work(self, block_hash):
+        """Cumulative work of the chain ending with block_hash, None if it does not link to our chain"""
+        path = []
+        node = self.nodes.get(block_hash)
+        work = None
+        while node is not None:
+            if node.work is not None:
+                work = node.work
+                break
+            path.append(node)
+            block = node.block
+            if block.index == 0:
+                work = 0
+                break
+            if self.config.chain_state.contains(block.index - 1, block.prev_hash):
+                work = await self.config.chain_state.get_chainwork(block.index - 1)
+                break
+            node = self.nodes.get(block.prev_hash)
+            if node is not None and node.block.index != block.index - 1:
+                node = None
+        if work is None:
+            return None
+        for node in reversed(path):
+            work += ChainState.get_work(node.block.hash)
+            node.work = work
+        return work
+
+    async def load(self, start_index, end_index):
+        """Adds the consensus records of heights start_index to end_index, in one query"""
+        async for record in self.mongo.async_db.consensus.find({
+            'index': {'$gte': start_index, '$lte': end_index},
+            'ignore': {'$ne': True}
+        }, {'_id': 0}):
+            if record['block'].get('hash') in self.nodes:
+                continue
+            try:
+                block = await Block.from_dict(record['block'])
+            except Exception:
+                continue
+            if int(block.version) == CHAIN.get_version_for_height(block.index):
+                self.add(block, record.get('peer'))
+
+    async def fetch(self, peer, start_index, end_index) -> list:
+        """Blocks start_index to end_index of peer's chain, added to the tree and the consensus collection"""
+        try:
+            request = HTTPRequest(
+                'http://{}/get-blocks?start_index={}&end_index={}'.format(peer.to_string(), start_index, end_index),
+                headers=HTTPHeaders({"Connection": "close"}),
+                connect_timeout=3,
+                request_timeout=10
+            )
+            response = await self.config.http_client.fetch(request)
+            block_dicts = json.loads(response.body.decode('utf-8'))
+            if not isinstance(block_dicts, list):
+                return []
+            blocks = [await Block.from_dict(block) for block in block_dicts]
+        except Exception as e:
+            self.app_log.warning('Error requesting blocks {}-{} from {}: {}'.format(start_index, end_index, peer.to_string(), e))
+            return []
+        blocks = [block for block in blocks if int(block.version) == CHAIN.get_version_for_height(block.index)]
+        for block in blocks:
+            self.add(block, peer.to_string())
+            try:
+                await self.consensus.insert_consensus_block(block, peer)
+            except Exception as e:
+                self.app_log.debug('Exception retrace insert_consensus_block: {}'.format(e))
+        return blocks
+
+    async def get_branch(self, block, peer) -> list:
+        """Blocks of block's branch after its fork point with our chain, ascending.
+        Empty if it does not link to our chain at most MAX_RETRACE_DEPTH below our tip."""
+        self.prune()
+        floor = max(self.config.chain_state.height - CHAIN.MAX_RETRACE_DEPTH, 1)
+        await self.load(floor, block.index)
+        self.add(block, peer.to_string())
+        branch = []
+        while True:
+            branch.append(block)
+            if self.config.chain_state.contains(block.index - 1, block.prev_hash):
+                return branch[::-1]
+            if block.index - 1 < floor:
+                self.app_log.info('Retrace deeper than {} blocks, ignoring'.format(CHAIN.MAX_RETRACE_DEPTH))
+                return []
+            parent = self.nodes.get(block.prev_hash)
+            if parent is None and not peer.is_me:
+                # The whole missing range at once
+                await self.fetch(peer, max(floor, block.index - CHAIN.MAX_BLOCKS_PER_MESSAGE), block.index - 1)
+                parent = self.nodes.get(block.prev_hash)
+            if parent is None or parent.block.index != block.index - 1:
+                return []
+            block = parent.block
+
+    def best_tip(self, block) -> list:
+        """Descendants of block leading to the one with the most cumulative work, ascending"""
+        best_path, best_work = [], 0
+        stack = [(block.hash, [], 0)]
+        while stack:
+            block_hash, path, work = stack.pop()
+            if work > best_work or (work == best_work and len(path) > len(best_path)):
+                best_path, best_work = path, work
+            for child_hash in self.children.get(block_hash, ()):
+                child = self.nodes[child_hash].block
+                if child.index == len(path) + block.index + 1:
+                    stack.append((child_hash, path + [child], work + ChainState.get_work(child_hash)))
+        return best_path
+
+    async def extend(self, block, peer) -> list:
+        """Best known descendants of block, then what peer has after them"""
+        blocks = self.best_tip(block)
+        last = blocks[-1] if blocks else block
+        if not peer.is_me:
+            await self.fetch(peer, last.index + 1, last.index + CHAIN.MAX_BLOCKS_PER_MESSAGE)
+            blocks.extend(self.best_tip(last))
+        return blocks
@@ -10,12 +10,12 @@ import time
 import requests
 import uuid
 
-from bitcoin.wallet import P2PKHBitcoinAddress
 from coincurve.utils import verify_signature
 from eccsnacks.curve25519 import scalarmult_base
 from logging import getLogger
 from threading import Thread
 
+from yadacoin.addresscache import AddressCache
 from yadacoin.basehandlers import BaseHandler
 from yadacoin.blockchainutils import BU
 from yadacoin.fastgraph import FastGraph
@@ -142,9 +142,9 @@ class GraphTransactionHandler(BaseGraphHandler):
             items = [item for item in items]
         transactions = []
         for txn in items:
-            transaction = Transaction.from_dict(BU().get_latest_block()['index'], txn)
+            transaction = Transaction.from_dict((await BU().get_latest_block_async())['index'], txn)
             try:
-                transaction.verify()
+                await transaction.verify_async()
             except InvalidTransactionException:
                 await self.config.mongo.async_db.failed_transactions.insert_one({
                     'exception': 'InvalidTransactionException',
@@ -182,6 +182,7 @@ class GraphTransactionHandler(BaseGraphHandler):
                 if not me_pending_exists and not me_blockchain_exists:
                     created_relationship = await self.create_relationship(self.bulletin_secret, self.username, self.to)
                     await self.config.mongo.async_db.miner_transactions.insert_one(created_relationship.transaction.to_dict())
+                    await self.config.on_mempool_transaction(created_relationship.transaction)
                     created_relationship.transaction.relationship = created_relationship.relationship
                     await self.config.mongo.async_db.name_server.insert_one({
                         'rid': created_relationship.transaction.rid,
@@ -245,6 +246,7 @@ class GraphTransactionHandler(BaseGraphHandler):
                 )
 
             await self.config.mongo.async_db.miner_transactions.insert_one(x.to_dict())
+            await self.config.on_mempool_transaction(x)
             txn_b = TxnBroadcaster(self.config)
             await txn_b.txn_broadcast_job(x)
             try:
@@ -294,7 +296,7 @@ class GraphTransactionHandler(BaseGraphHandler):
         dh_private_key = a.encode('latin1').hex()
 
         transaction = await TransactionFactory.construct(
-            block_height=BU().get_latest_block()['index'],
+            block_height=(await BU().get_latest_block_async())['index'],
             bulletin_secret=bulletin_secret,
             username=username,
             fee=0.00,
@@ -415,14 +417,14 @@ class SignRawTransactionHandler(BaseHandler):
                 body.get('hash').encode('utf-8'),
                 bytes.fromhex(their_entry_for_relationship['public_key'])
             )
-            address = str(P2PKHBitcoinAddress.from_pubkey(bytes.fromhex(their_entry_for_relationship['public_key'])))
+            address = AddressCache.address(their_entry_for_relationship['public_key'])
             found = False
             async for x in BU().get_wallet_unspent_transactions(address, [body.get('input')]):
                 if body.get('input') == x['id']:
                     found = True
             
             if not found:
-                for x in BU().get_wallet_unspent_fastgraph_transactions(address):
+                async for x in BU().get_wallet_unspent_fastgraph_transactions(address):
                     if body.get('input') == x['id']:
                         found = True
 
@@ -557,7 +559,7 @@ class NSHandler(BaseGraphHandler):
                 rids = sorted([str(my_bulletin_secret), str(bulletin_secret)], key=str.lower)
                 requested_rid = hashlib.sha256(rids[0].encode() + rids[1].encode()).hexdigest()
             
-                address = str(P2PKHBitcoinAddress.from_pubkey(bytes.fromhex(ns_record['public_key'])))
+                address = AddressCache.address(ns_record['public_key'])
                 filter_address = [x['to'] for x in ns_record['outputs'] if x['to'] != address]
                 to = address if not filter_address else filter_address[0]
             else:
@@ -595,7 +597,7 @@ class NSHandler(BaseGraphHandler):
                     ns_record['txn']['relationship']['requester_rid'] = requester_rid
                     return self.render_as_json(ns_record['txn']['relationship'])
         else:
-            friends = [x for x in GU().search_username(phrase)]
+            friends = [x async for x in GU().search_username(phrase)]
             ns_records = await self.config.mongo.async_db.name_server.find({
                 'txn.relationship.their_username': phrase,
             }).to_list(10)
@@ -607,7 +609,7 @@ class NSHandler(BaseGraphHandler):
         except:
             return self.render_as_json({'status': 'error', 'message': 'invalid request body'})
         try:
-            nstxn = Transaction.from_dict(self.config.BU.get_latest_block()['index'], ns['txn'])
+            nstxn = Transaction.from_dict((await self.config.BU.get_latest_block_async())['index'], ns['txn'])
         except:
             return self.render_as_json({'status': 'error', 'message': 'invalid transaction'})
         try:
@@ -11,6 +11,7 @@ from yadacoin.crypt import Crypt
 # from bson.son import SON
 # from coincurve import PrivateKey
 
+from yadacoin.cachewriter import CacheWriter
 from yadacoin.config import get_config
 from yadacoin.transaction import Transaction
 
@@ -102,6 +103,17 @@ class GraphUtils(object):
             queryType='searchRid'
         )
 
+    def get_cached_ids(self, collection, rids, transactions):
+        """ids of the transactions already cached for rids, one query per 1000 instead of one per transaction"""
+        ids = [x['txn']['id'] for x in transactions]
+        cached_ids = set()
+        for i in range(0, len(ids), 1000):
+            cached_ids.update(x['id'] for x in self.mongo.db[collection].find({
+                'rid': {'$in': rids},
+                'id': {'$in': ids[i:i + 1000]}
+            }, {'id': 1}))
+        return cached_ids
+
     def get_posts(self, rids):
         from yadacoin.crypt import Crypt
 
@@ -119,38 +131,12 @@ class GraphUtils(object):
             block_height = posts_cache['height']
         else:
             block_height = 0
-        transactions = self.mongo.db.blocks.aggregate([
-            {
-                "$match": {
-                    "index": {'$gt': block_height}
-                }
-            },
-            {
-                "$match": {
-                    "transactions": {"$elemMatch": {"relationship": {"$ne": ""}}},
-                    "transactions.dh_public_key": '',
-                    "transactions.rid": ''
-                }
-            },
-            {"$unwind": "$transactions"},
-            {
-                "$project": {
-                    "_id": 0,
-                    "txn": "$transactions",
-                    "height": "$index"
-                }
-            },
-            {
-                "$match": {
-                    "txn.relationship": {"$ne": ""},
-                    "txn.dh_public_key": '',
-                    "txn.rid": ''
-                }
-            },
-            {
-                "$sort": {"height": 1}
-            }
-        ])
+        transactions = self.config.BU.find_transactions({
+            "height": {'$gt': block_height},
+            "relationship": {"$ne": ""},
+            "dh_public_key": '',
+            "rid": ''
+        })
 
         fastgraph_transactions = self.mongo.db.fastgraph_transactions.find({
             "txn.relationship": {"$ne": ""},
@@ -168,16 +154,15 @@ class GraphUtils(object):
                 friends.append(friend['relationship']['their_bulletin_secret'])
         friends = list(set(friends))
         had_txns = False
+        cache_writer = CacheWriter()
 
         if friends:
             mutual_bulletin_secrets.extend(friends)
+            cached_ids = self.get_cached_ids('posts_cache', rids, transactions)
             for i, x in enumerate(transactions):
-                res = self.mongo.db.posts_cache.find_one({
-                    'rid': {'$in': rids},
-                    'id': x['txn']['id']
-                })
-                if res:
+                if x['txn']['id'] in cached_ids:
                     continue
+                cached_ids.add(x['txn']['id'])
                 for bs in mutual_bulletin_secrets:
                     try:
                         crypt = Crypt(bs)
@@ -192,7 +177,7 @@ class GraphUtils(object):
                             had_txns = True
                             self.app_log.debug('caching posts at height: {}'.format(x.get('height', 0)))
                             for rid in rids:
-                                self.mongo.db.posts_cache.update({
+                                cache_writer.replace('posts_cache', {
                                     'rid': rid,
                                     'height': x.get('height', 0),
                                     'id': x['txn']['id'],
@@ -201,16 +186,16 @@ class GraphUtils(object):
                                 {
                                     'rid': rid,
                                     'height': x.get('height', 0),
+                                    'block_hash': x.get('block_hash'),
                                     'id': x['txn']['id'],
                                     'txn': x['txn'],
                                     'bulletin_secret': bs,
                                     'success': True,
                                     'cache_time': time()
-                                },
-                                upsert=True)
+                                })
                     except Exception as e:
                         for rid in rids:
-                            self.mongo.db.posts_cache.update({
+                            cache_writer.replace('posts_cache', {
                                 'rid': rid,
                                 'height': x.get('height', 0),
                                 'id': x['txn']['id'],
@@ -219,22 +204,25 @@ class GraphUtils(object):
                             {
                                 'rid': rid,
                                 'height': x.get('height', 0),
+                                'block_hash': x.get('block_hash'),
                                 'id': x['txn']['id'],
                                 'txn': x['txn'],
                                 'bulletin_secret': bs,
                                 'success': False,
                                 'cache_time': time()
-                            },
-                            upsert=True)
+                            })
                         self.app_log.debug(e)
+                cache_writer.flush_if_due()
         if not had_txns:
             for rid in rids:
-                self.mongo.db.posts_cache.insert({
+                cache_writer.insert('posts_cache', {
                     'rid': rid,
                     'height': latest_block['index'],
+                    'block_hash': latest_block['hash'],
                     'success': False,
                     'cache_time': time()
                 })
+        cache_writer.flush()
 
         i = 1
         for x in self.mongo.db.fastgraph_transaction_cache.find({
@@ -270,38 +258,12 @@ class GraphUtils(object):
             block_height = reacts_cache['height']
         else:
             block_height = 0
-        transactions = self.mongo.db.blocks.aggregate([
-            {
-                "$match": {
-                    "index": {'$gt': block_height}
-                }
-            },
-            {
-                "$match": {
-                    "transactions": {"$elemMatch": {"relationship": {"$ne": ""}}},
-                    "transactions.dh_public_key": '',
-                    "transactions.rid": ''
-                }
-            },
-            {"$unwind": "$transactions"},
-            {
-                "$project": {
-                    "_id": 0,
-                    "txn": "$transactions",
-                    "height": "$index"
-                }
-            },
-            {
-                "$match": {
-                    "txn.relationship": {"$ne": ""},
-                    "txn.dh_public_key": '',
-                    "txn.rid": ''
-                }
-            },
-            {
-                "$sort": {"height": 1}
-            }
-        ])
+        transactions = self.config.BU.find_transactions({
+            "height": {'$gt': block_height},
+            "relationship": {"$ne": ""},
+            "dh_public_key": '',
+            "rid": ''
+        })
 
         fastgraph_transactions = self.mongo.db.fastgraph_transactions.find({
             "txn.relationship": {"$ne": ""},
@@ -319,16 +281,15 @@ class GraphUtils(object):
                 friends.append(friend['relationship']['their_bulletin_secret'])
         friends = list(set(friends))
         had_txns = False
+        cache_writer = CacheWriter()
 
         if friends:
             mutual_bulletin_secrets.extend(friends)
+            cached_ids = self.get_cached_ids('reacts_cache', rids, transactions)
             for i, x in enumerate(transactions):
-                res = self.mongo.db.reacts_cache.find_one({
-                    'rid': {'$in': rids},
-                    'id': x['txn']['id']
-                })
-                if res:
+                if x['txn']['id'] in cached_ids:
                     continue
+                cached_ids.add(x['txn']['id'])
                 for bs in mutual_bulletin_secrets:
                     try:
                         crypt = Crypt(bs)
@@ -343,7 +304,7 @@ class GraphUtils(object):
                             had_txns = True
                             self.app_log.debug('caching reacts at height: {}'.format(x.get('height', 0)))
                             for rid in rids:
-                                self.mongo.db.reacts_cache.update({
+                                cache_writer.replace('reacts_cache', {
                                     'rid': rid,
                                     'height': x.get('height', 0),
                                     'id': x['txn']['id'],
@@ -352,16 +313,16 @@ class GraphUtils(object):
                                 {
                                     'rid': rid,
                                     'height': x.get('height', 0),
+                                    'block_hash': x.get('block_hash'),
                                     'id': x['txn']['id'],
                                     'txn': x['txn'],
                                     'bulletin_secret': bs,
                                     'success': True,
                                     'cache_time': time()
-                                },
-                                upsert=True)
+                                })
                     except:
                         for rid in rids:
-                            self.mongo.db.reacts_cache.update({
+                            cache_writer.replace('reacts_cache', {
                                 'rid': rid,
                                 'height': x.get('height', 0),
                                 'id': x['txn']['id'],
@@ -370,21 +331,24 @@ class GraphUtils(object):
                             {
                                 'rid': rid,
                                 'height': x.get('height', 0),
+                                'block_hash': x.get('block_hash'),
                                 'id': x['txn']['id'],
                                 'txn': x['txn'],
                                 'bulletin_secret': bs,
                                 'success': False,
                                 'cache_time': time()
-                            },
-                            upsert=True)
+                            })
+                cache_writer.flush_if_due()
         if not had_txns:
             for rid in rids:
-                self.mongo.db.reacts_cache.insert({
+                cache_writer.insert('reacts_cache', {
                     'rid': rid,
                     'height': latest_block['index'],
+                    'block_hash': latest_block['hash'],
                     'success': False,
                     'cache_time': time()
                 })
+        cache_writer.flush()
 
         for x in self.mongo.db.reacts_cache.find({'txn.relationship.id': {'$in': ids}, 'success': True}):
             if 'txn' in x and 'id' in x['txn']['relationship']:
@@ -409,38 +373,12 @@ class GraphUtils(object):
             block_height = comments_cache['height']
         else:
             block_height = 0
-        transactions = self.mongo.db.blocks.aggregate([
-            {
-                "$match": {
-                    "index": {'$gt': block_height}
-                }
-            },
-            {
-                "$match": {
-                    "transactions": {"$elemMatch": {"relationship": {"$ne": ""}}},
-                    "transactions.dh_public_key": '',
-                    "transactions.rid": ''
-                }
-            },
-            {"$unwind": "$transactions"},
-            {
-                "$project": {
-                    "_id": 0,
-                    "txn": "$transactions",
-                    "height": "$index"
-                }
-            },
-            {
-                "$match": {
-                    "txn.relationship": {"$ne": ""},
-                    "txn.dh_public_key": '',
-                    "txn.rid": ''
-                }
-            },
-            {
-                "$sort": {"height": 1}
-            }
-        ])
+        transactions = self.config.BU.find_transactions({
+            "height": {'$gt': block_height},
+            "relationship": {"$ne": ""},
+            "dh_public_key": '',
+            "rid": ''
+        })
 
         fastgraph_transactions = self.mongo.db.fastgraph_transactions.find({
             "txn.relationship": {"$ne": ""},
@@ -458,16 +396,15 @@ class GraphUtils(object):
                 friends.append(friend['relationship']['their_bulletin_secret'])
         friends = list(set(friends))
         had_txns = False
+        cache_writer = CacheWriter()
 
         if friends:
             mutual_bulletin_secrets.extend(friends)
+            cached_ids = self.get_cached_ids('comments_cache', rids, transactions)
             for i, x in enumerate(transactions):
-                res = self.mongo.db.comments_cache.find_one({
-                    'rid': {'$in': rids},
-                    'id': x['txn']['id']
-                })
-                if res:
+                if x['txn']['id'] in cached_ids:
                     continue
+                cached_ids.add(x['txn']['id'])
                 for bs in mutual_bulletin_secrets:
                     try:
                         crypt = Crypt(bs)
@@ -482,7 +419,7 @@ class GraphUtils(object):
                             had_txns = True
                             self.app_log.debug('caching comments at height: {}'.format(x.get('height', 0)))
                             for rid in rids:
-                                self.mongo.db.comments_cache.update({
+                                cache_writer.replace('comments_cache', {
                                     'rid': rid,
                                     'height': x.get('height', 0),
                                     'id': x['txn']['id'],
@@ -491,16 +428,16 @@ class GraphUtils(object):
                                 {
                                     'rid': rid,
                                     'height': x.get('height', 0),
+                                    'block_hash': x.get('block_hash'),
                                     'id': x['txn']['id'],
                                     'txn': x['txn'],
                                     'bulletin_secret': bs,
                                     'success': True,
                                     'cache_time': time()
-                                },
-                                upsert=True)
+                                })
                     except:
                         for rid in rids:
-                            self.mongo.db.comments_cache.update({
+                            cache_writer.replace('comments_cache', {
                                 'rid': rid,
                                 'height': x.get('height', 0),
                                 'id': x['txn']['id'],
@@ -509,21 +446,24 @@ class GraphUtils(object):
                             {
                                 'rid': rid,
                                 'height': x.get('height', 0),
+                                'block_hash': x.get('block_hash'),
                                 'id': x['txn']['id'],
                                 'txn': x['txn'],
                                 'bulletin_secret': bs,
                                 'success': False,
                                 'cache_time': time()
-                            },
-                            upsert=True)
+                            })
+                cache_writer.flush_if_due()
         if not had_txns:
             for rid in rids:
-                self.mongo.db.comments_cache.insert({
+                cache_writer.insert('comments_cache', {
                     'rid': rid,
                     'height': latest_block['index'],
+                    'block_hash': latest_block['hash'],
                     'success': False,
                     'cache_time': time()
                 })
+        cache_writer.flush()
 
         for x in self.mongo.db.comments_cache.find({'txn.relationship.id': {'$in': ids}, 'success': True}):
             if 'txn' in x and 'id' in x['txn']['relationship']:
@@ -569,33 +509,31 @@ class GraphUtils(object):
             
                     
         def txn_gen():
-            res = self.mongo.db.blocks.find(
-                {"transactions": {"$elemMatch": {"relationship": {"$ne": ""}, "rid": {"$in": selectors}}}})
+            res = self.config.BU.find_transactions({"relationship": {"$ne": ""}, "rid": {"$in": selectors}})
             for x in res:
-                yield x
+                yield x['txn']
         
             res = self.mongo.db.fastgraph_transactions.find(
                 {"txn": {"$elemMatch": {"relationship": {"$ne": ""}, "rid": {"$in": selectors}}}})
             for x in res:
-                yield x
+                yield x['txn']
         cipher = None
-        for block in txn_gen():
-            for transaction in block.get('transactions'):
-                if theirs and public_key == transaction['public_key']:
-                    continue
-                if my and public_key != transaction['public_key']:
+        for transaction in txn_gen():
+            if theirs and public_key == transaction['public_key']:
+                continue
+            if my and public_key != transaction['public_key']:
+                continue
+            if not raw:
+                try:
+                    if not cipher:
+                        cipher = Crypt(wif)
+                    decrypted = cipher.decrypt(transaction['relationship'])
+                    relationship = json.loads(decrypted.decode('latin1'))
+                    transaction['relationship'] = relationship
+                except:
                     continue
-                if not raw:
-                    try:
-                        if not cipher:
-                            cipher = Crypt(wif)
-                        decrypted = cipher.decrypt(transaction['relationship'])
-                        relationship = json.loads(decrypted.decode('latin1'))
-                        transaction['relationship'] = relationship
-                    except:
-                        continue
-                if 'rid' in transaction and transaction['rid'] in selectors:
-                    return transaction
+            if 'rid' in transaction and transaction['rid'] in selectors:
+                return transaction
 
     def get_transactions_by_rid(self, selector, bulletin_secret, wif=None, rid=False, raw=False,
                                 returnheight=True, lt_block_height=None, requested_rid=False, inc_mempool=False, shared_decrypt=False):
@@ -696,109 +634,95 @@ class GraphUtils(object):
         latest_block = self.config.BU.get_latest_block()
 
         transactions = []
+        if requested_rid:
+            query = {
+                "$or": [
+                    {
+                        "rid": selector
+                    },
+                    {
+                        "requested_rid": selector
+                    }
+                ],
+                "relationship": {
+                    "$ne": ""
+                }
+            }
+        else:
+            query = {
+                "rid": selector,
+                "relationship": {
+                    "$ne": ""
+                }
+            }
         if lt_block_height:
-            query = {"transactions.rid": selector, "transactions": {"$elemMatch": {"relationship": {"$ne": ""}}},
-                 'index': {'$lte': lt_block_height}}
-            if requested_rid:
-                query["transactions.requested_rid"] = selector
-            blocks = self.mongo.db.blocks.find(query)
+            query['height'] = {'$lte': lt_block_height}
         else:
             if transactions_by_rid_cache.count():
                 transactions_by_rid_cache = transactions_by_rid_cache[0]
                 block_height = transactions_by_rid_cache['height']
             else:
                 block_height = 0
-                
-            query = {"transactions.rid": selector, "transactions": {"$elemMatch": {"relationship": {"$ne": ""}}},
-                 'index': {'$gt': block_height}}
-            if requested_rid:
-                query = {
-                    "$or": [
-                        {
-                            "transactions.rid": selector
-                        },
-                        {
-                            "transactions.requested_rid": selector
-                        }
-                    ],
-                    "transactions": {
-                        "$elemMatch": {
-                            "relationship": {
-                                "$ne": ""
-                            }
-                        }
-                    },
-                    'index': {
-                        '$gt': block_height
-                    }
-                }
-            else:
-                query = {
-                    "transactions.rid": selector,
-                    "transactions": {
-                        "$elemMatch": {
-                            "relationship": {
-                                "$ne": ""
-                            }
-                        }
-                    },
-                    'index': {
-                        '$gt': block_height
-                    }
-                }
-            blocks = self.mongo.db.blocks.find(query)
+            query['height'] = {'$gt': block_height}
+
+        records = self.config.BU.find_transactions(query)
+        if lt_block_height and requested_rid:
+            # As the blocks query this replaces: only blocks holding both a rid and a requested_rid match
+            records = list(records)
+            block_hashes = {x['block_hash'] for x in records if x['txn'].get('rid') == selector}
+            block_hashes &= {x['block_hash'] for x in records if x['txn'].get('requested_rid') == selector}
+            records = [x for x in records if x['block_hash'] in block_hashes]
 
         cipher = None
-        for block in blocks:
-            for transaction in block.get('transactions'):
-                if transaction.get('relationship') and (transaction.get('rid') == selector or transaction.get('requested_rid') == selector):
-                    if returnheight:
-                        transaction['height'] = block['index']
-                    if not raw:
-                        try:
-                            if not cipher:
-                                if wif and wif != self.config.wif:
-                                    cipher = Crypt(wif)
-                                else:
-                                    cipher = self.config.wif
-                            if shared_decrypt:
-                                decrypted = cipher.shared_decrypt(transaction['relationship'])
+        cache_writer = CacheWriter()
+        for x in records:
+            transaction = x['txn']
+            if transaction.get('relationship') and (transaction.get('rid') == selector or transaction.get('requested_rid') == selector):
+                if returnheight:
+                    transaction['height'] = x['height']
+                if not raw:
+                    try:
+                        if not cipher:
+                            if wif and wif != self.config.wif:
+                                cipher = Crypt(wif)
                             else:
-                                decrypted = cipher.decrypt(transaction['relationship'])
-                            relationship = json.loads(decrypted.decode('latin1'))
-                            transaction['relationship'] = relationship
-                        except:
-                            continue
-                    self.app_log.debug('caching transactions_by_rid at height: {}'.format(block['index']))
-                    self.mongo.db.transactions_by_rid_cache.insert(
-                        {
-                            'raw': raw,
-                            'rid': rid,
-                            'bulletin_secret': bulletin_secret,
-                            'returnheight': returnheight,
-                            'selector': selector,
-                            'txn': transaction,
-                            'height': block['index'],
-                            'block_hash': block['hash'],
-                            'requested_rid': requested_rid,
-                            'cache_time': time()
-                        }
-                    )
-                    transactions.append(transaction)
-        if not transactions:
-            self.mongo.db.transactions_by_rid_cache.insert(
-                {
+                                cipher = self.config.wif
+                        if shared_decrypt:
+                            decrypted = cipher.shared_decrypt(transaction['relationship'])
+                        else:
+                            decrypted = cipher.decrypt(transaction['relationship'])
+                        relationship = json.loads(decrypted.decode('latin1'))
+                        transaction['relationship'] = relationship
+                    except:
+                        continue
+                self.app_log.debug('caching transactions_by_rid at height: {}'.format(x['height']))
+                cache_writer.insert('transactions_by_rid_cache', {
                     'raw': raw,
                     'rid': rid,
                     'bulletin_secret': bulletin_secret,
                     'returnheight': returnheight,
                     'selector': selector,
-                    'height': latest_block['index'],
-                    'block_hash': latest_block['hash'],
+                    'txn': transaction,
+                    'height': x['height'],
+                    'block_hash': x['block_hash'],
                     'requested_rid': requested_rid,
                     'cache_time': time()
-                }
-            )
+                })
+                transactions.append(transaction)
+                cache_writer.flush_if_due()
+        if not transactions:
+            cache_writer.insert('transactions_by_rid_cache', {
+                'raw': raw,
+                'rid': rid,
+                'bulletin_secret': bulletin_secret,
+                'returnheight': returnheight,
+                'selector': selector,
+                'height': latest_block['index'],
+                'block_hash': latest_block['hash'],
+                'requested_rid': requested_rid,
+                'cache_time': time()
+            })
+        cache_writer.flush()
 
         for ftxn in self.mongo.db.fastgraph_transactions.find({'txn.rid': selector}):
             if 'txn' in ftxn:
@@ -821,13 +745,14 @@ class GraphUtils(object):
         if not isinstance(rids, list):
             rids = [rids, ]
         transactions = []
-        for block in self.mongo.db.blocks.find({'$and': [
-            {"transactions": {"$elemMatch": {"relationship": {"$ne": ""}}}},
-            {"index": {"$gt": start_height}}]
+        for x in self.config.BU.find_transactions({
+            "height": {"$gt": start_height},
+            "$or": [
+                {"requester_rid": {"$in": rids}},
+                {"requested_rid": {"$in": rids}}
+            ]
         }):
-            for transaction in block.get('transactions'):
-                if transaction.get('requester_rid') in rids or transaction.get('requested_rid') in rids:
-                    transactions.append(transaction)
+            transactions.append(x['txn'])
         return transactions
 
     def get_friend_requests(self, rids):
@@ -842,42 +767,17 @@ class GraphUtils(object):
             block_height = friend_requests_cache['height']
         else:
             block_height = 0
-        transactions = self.mongo.db.blocks.aggregate([
-            {
-                "$match": {
-                    "index": {'$gt': block_height}
-                }
-            },
-            {
-                "$match": {
-                    "transactions": {"$elemMatch": {"dh_public_key": {'$ne': ''}}},
-                    "transactions.requested_rid": {'$in': rids}
-                }
-            },
-            {"$unwind": "$transactions"},
-            {
-                "$project": {
-                    "_id": 0,
-                    "txn": "$transactions",
-                    "height": "$index",
-                    "block_hash": "$hash",
-                }
-            },
-            {
-                "$match": {
-                    "txn.dh_public_key": {'$ne': ''},
-                    "txn.requested_rid": {'$in': rids}
-                }
-            },
-            {
-                "$sort": {"height": 1}
-            }
-        ])
+        transactions = self.config.BU.find_transactions({
+            "height": {'$gt': block_height},
+            "dh_public_key": {'$ne': ''},
+            "requested_rid": {'$in': rids}
+        })
         had_txns = False
+        cache_writer = CacheWriter()
         for x in transactions:
             had_txns = True
             self.app_log.debug('caching friend requests at height: {}'.format(x['height']))
-            self.mongo.db.friend_requests_cache.update({
+            cache_writer.replace('friend_requests_cache', {
                 'requested_rid': x['txn']['requested_rid'],
                 'height': x['height'],
                 'id': x['txn']['id']
@@ -889,17 +789,18 @@ class GraphUtils(object):
                 'id': x['txn']['id'],
                 'txn': x['txn'],
                 'cache_time': time()
-            },
-            upsert=True)
+            })
+            cache_writer.flush_if_due()
 
         if not had_txns:
             for rid in rids:
-                self.mongo.db.friend_requests_cache.insert({
+                cache_writer.insert('friend_requests_cache', {
                     'height': latest_block['index'],
                     'block_hash': latest_block['hash'],
                     'requested_rid': rid,
                     'cache_time': time()
                 })
+        cache_writer.flush()
 
         for x in self.mongo.db.fastgraph_transactions.find({
             'txn.dh_public_key': {'$ne': ''},
@@ -926,41 +827,16 @@ class GraphUtils(object):
         else:
             block_height = 0
 
-        transactions = self.mongo.db.blocks.aggregate([
-            {
-                "$match": {
-                    "index": {'$gt': block_height}
-                }
-            },
-            {
-                "$match": {
-                    "transactions": {"$elemMatch": {"dh_public_key": {'$ne': ''}}},
-                    "transactions.requester_rid": {'$in': rids}
-                }
-            },
-            {"$unwind": "$transactions"},
-            {
-                "$project": {
-                    "_id": 0,
-                    "txn": "$transactions",
-                    "height": "$index",
-                    "block_hash": "$hash"
-                }
-            },
-            {
-                "$match": {
-                    "txn.dh_public_key": {'$ne': ''},
-                    "txn.requester_rid": {'$in': rids}
-                }
-            },
-            {
-                "$sort": {"height": 1}
-            }
-        ])
+        transactions = self.config.BU.find_transactions({
+            "height": {'$gt': block_height},
+            "dh_public_key": {'$ne': ''},
+            "requester_rid": {'$in': rids}
+        })
 
+        cache_writer = CacheWriter()
         for x in transactions:
             self.app_log.debug('caching sent friend requests at height: {}'.format(x['height']))
-            self.mongo.db.sent_friend_requests_cache.update({
+            cache_writer.replace('sent_friend_requests_cache', {
                 'requester_rid': x['txn']['requester_rid'],
                 'height': x['height'],
                 'id': x['txn']['id']
@@ -972,8 +848,9 @@ class GraphUtils(object):
                 'id': x['txn']['id'],
                 'txn': x['txn'],
                 'cache_time': time()
-            },
-            upsert=True)
+            })
+            cache_writer.flush_if_due()
+        cache_writer.flush()
 
         for x in self.mongo.db.fastgraph_transactions.find({
             'txn.dh_public_key': {'$ne': ''},
@@ -997,43 +874,17 @@ class GraphUtils(object):
         else:
             block_height = 0
 
-        transactions = self.mongo.db.blocks.aggregate([
-            {
-                "$match": {
-                    "index": {'$gt': block_height}
-                }
-            },
-            {
-                "$match": {
-                    "transactions": {"$elemMatch": {"relationship": {"$ne": ""}}},
-                    "transactions.dh_public_key": '',
-                    "transactions.rid": {'$in': rids}
-                }
-            },
-            {"$unwind": "$transactions"},
-            {
-                "$project": {
-                    "_id": 0,
-                    "txn": "$transactions",
-                    "height": "$index",
-                    "block_hash": "$hash"
-                }
-            },
-            {
-                "$match": {
-                    "txn.relationship": {"$ne": ""},
-                    "txn.dh_public_key": '',
-                    "txn.rid": {'$in': rids}
-                }
-            },
-            {
-                "$sort": {"height": 1}
-            }
-        ])
+        transactions = self.config.BU.find_transactions({
+            "height": {'$gt': block_height},
+            "relationship": {"$ne": ""},
+            "dh_public_key": '',
+            "rid": {'$in': rids}
+        })
 
+        cache_writer = CacheWriter()
         for x in transactions:
             self.app_log.debug('caching messages at height: {}'.format(x['height']))
-            self.mongo.db.messages_cache.update({
+            cache_writer.replace('messages_cache', {
                 'rid': x['txn']['rid'],
                 'height': x['height'],
                 'id': x['txn']['id']
@@ -1045,8 +896,9 @@ class GraphUtils(object):
                 'id': x['txn']['id'],
                 'txn': x['txn'],
                 'cache_time': time()
-            },
-            upsert=True)
+            })
+            cache_writer.flush_if_due()
+        cache_writer.flush()
 
         i = 1
         for x in self.mongo.db.fastgraph_transactions.find({
@@ -1120,13 +972,19 @@ class GraphUtils(object):
                 txn = Transaction.from_dict(self.config.BU.get_latest_block()['index'], txn)
                 txn.verify()
             cipher = None
-            for shared_secret in list(set(shared_secrets)):
-                res = self.mongo.db.verify_message_cache.find_one({
+            shared_secrets = list(set(shared_secrets))
+            cached = {
+                x['shared_secret']: x
+                for x in self.mongo.db.verify_message_cache.find({
                     'rid': rid,
-                    'shared_secret': shared_secret.hex(),
+                    'shared_secret': {'$in': [shared_secret.hex() for shared_secret in shared_secrets]},
                     'message': message,
                     'id': txn.transaction_signature
                 })
+            }
+            cache_writer = CacheWriter()
+            for shared_secret in shared_secrets:
+                res = cached.get(shared_secret.hex())
                 try:
                     if res and res['success']:
                         signin = res['message']
@@ -1137,7 +995,7 @@ class GraphUtils(object):
                         try:
                             decrypted = cipher.shared_decrypt(txn.relationship)
                             signin = json.loads(decrypted.decode('utf-8'))
-                            self.mongo.db.verify_message_cache.update({
+                            cache_writer.replace('verify_message_cache', {
                                 'rid': rid,
                                 'shared_secret': shared_secret.hex(),
                                 'id': txn.transaction_signature
@@ -1149,8 +1007,7 @@ class GraphUtils(object):
                                 'message': signin,
                                 'success': True,
                                 'cache_time': time()
-                            }
-                            , upsert=True)
+                            })
                         except:
                             continue
                     if u'signIn' in signin and message == signin['signIn']:
@@ -1159,7 +1016,7 @@ class GraphUtils(object):
                         else:
                             sent = True
                 except:
-                    self.mongo.db.verify_message_cache.update({
+                    cache_writer.replace('verify_message_cache', {
                         'rid': rid,
                         'shared_secret': shared_secret.hex(),
                         'id': txn.transaction_signature
@@ -1171,6 +1028,6 @@ class GraphUtils(object):
                         'message': '',
                         'success': False,
                         'cache_time': time()
-                    }
-                    , upsert=True)
+                    })
+            cache_writer.flush()
         return sent, received
@@ -0,0 +1,126 @@
+"""
+In-memory copy of the most recent block headers.
+
+Retargeting only needs a handful of header fields from the last few thousand blocks,
+this keeps them at hand instead of querying and deserializing full blocks every time.
+Kept in sync through the config.on_new_block and config.on_blocks_removed events,
+anything older than what is held falls back to the blocks collection.
+"""
+
+from collections import deque, namedtuple
+from logging import getLogger
+
+from yadacoin.config import get_config
+
+
+HeaderRecord = namedtuple('HeaderRecord', ['index', 'hash', 'prev_hash', 'time', 'target', 'special_min'])
+
+
+class HeaderCache(object):
+    # Enough for the longest retarget window (CHAIN.RETARGET_PERIOD) plus reorg margin
+    SIZE = 4096
+    PROJECTION = {'_id': 0, 'index': 1, 'hash': 1, 'prevHash': 1, 'time': 1, 'target': 1, 'special_min': 1}
+
+    def __init__(self, size=None):
+        self.config = get_config()
+        self.mongo = self.config.mongo
+        self.app_log = getLogger('tornado.application')
+        self.size = size or self.SIZE
+        self.headers = deque(maxlen=self.size)
+
+    @staticmethod
+    def from_dict(block: dict) -> HeaderRecord:
+        return HeaderRecord(
+            block['index'],
+            block.get('hash'),
+            block.get('prevHash'),
+            int(block.get('time')),
+            int(block.get('target'), 16),
+            block.get('special_min')
+        )
+
+    @staticmethod
+    def from_block(block) -> HeaderRecord:
+        return HeaderRecord(
+            block.index,
+            block.hash,
+            block.prev_hash,
+            int(block.time),
+            block.target,
+            block.special_min
+        )
+
+    @property
+    def tip(self):
+        return self.headers[-1] if self.headers else None
+
+    async def load(self):
+        """Fills the cache with the latest blocks. Called once at startup."""
+        self.headers.clear()
+        blocks = self.mongo.async_db.blocks.find({}, self.PROJECTION).sort([('index', -1)]).limit(self.size)
+        headers = [self.from_dict(block) async for block in blocks]
+        for header in reversed(headers):
+            self.append(header)
+        if self.headers:
+            self.app_log.info('Header cache loaded from {} to {}'.format(self.headers[0].index, self.tip.index))
+
+    def append(self, header: HeaderRecord):
+        tip = self.tip
+        if tip and header.index <= tip.index:
+            self.truncate(header.index)
+            tip = self.tip
+        if tip and header.index != tip.index + 1:
+            # Gap, we can't tell what's in between. Start over from there, older ones come from db.
+            self.headers.clear()
+        self.headers.append(header)
+
+    def truncate(self, index):
+        """Drops every header >= index"""
+        while self.headers and self.headers[-1].index >= index:
+            self.headers.pop()
+
+    async def on_new_block(self, block):
+        """Called by config.on_new_block once the block is stored in the blocks collection"""
+        self.append(self.from_block(block))
+
+    async def on_blocks_removed(self, index):
+        """Called by config.on_blocks_removed once every block >= index was deleted from the blocks collection"""
+        self.truncate(index)
+
+    def get(self, index):
+        """Header at index if we hold it, None otherwise"""
+        if not self.headers:
+            return None
+        position = index - self.headers[0].index
+        if position < 0 or position >= len(self.headers):
+            return None
+        return self.headers[position]
+
+    async def get_header(self, index):
+        """Header at index, from the blocks collection if we don't hold it. None if there is no such block."""
+        header = self.get(index)
+        if header:
+            return header
+        block = await self.mongo.async_db.blocks.find_one({'index': index}, self.PROJECTION)
+        if not block:
+            return None
+        return self.from_dict(block)
+
+    async def get_last_regular(self, index, max_target):
+        """Latest header <= index that is neither special_min nor at max_target"""
+        lowest = index + 1
+        if self.get(index):
+            lowest = self.headers[0].index
+            for i in range(index, lowest - 1, -1):
+                header = self.get(i)
+                # special_min is False, not just falsy, same as the db query below
+                if header.special_min is False and header.target != max_target:
+                    return header
+        block = await self.mongo.async_db.blocks.find_one({
+            'index': {'$lte': lowest - 1},
+            'special_min': False,
+            'target': {'$ne': hex(max_target)[2:].rjust(64, '0')}
+        }, self.PROJECTION, sort=[('index', -1)])
+        if not block:
+            return None
+        return self.from_dict(block)
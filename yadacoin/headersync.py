@@ -0,0 +1,241 @@
+"""
+Headers-first sync.
+
+request_blocks pulls 100 full blocks at a time from a single peer, one request after the other,
+so a node far behind spends most of its time waiting on that peer.
+HeaderSync first fetches the header fields of the missing blocks, /get-headers, from the peer with
+the highest chain and checks them without any body. Each header goes through Blockchain.check_link
+against the one before it, our tip for the first: the retarget is computed from a copy of our
+RetargetEngine extended with the headers checked so far, and the header hash has to be below it.
+The block hash is then recomputed from the header, RandomX included, versions, heights and prev
+hashes have to follow. Everything that needs the transactions is left to integration.
+The bodies of the checked headers are then fetched from every peer that has them, one
+MAX_BLOCKS_PER_MESSAGE range per request, PARALLEL requests at a time. A body has to carry the hash
+of its checked header, a range that fails is asked again from the next peer. Ranges are integrated in
+height order as they arrive, through insert_consensus_block and import_block as request_blocks does.
+"""
+
+import json
+from asyncio import ensure_future, gather, Semaphore
+from logging import getLogger
+from time import time
+
+from tornado.httpclient import HTTPRequest
+from tornado.httputil import HTTPHeaders
+
+from yadacoin.block import Block, BlockFactory, BlockHeader
+from yadacoin.blockchain import Blockchain
+from yadacoin.chain import CHAIN
+from yadacoin.config import get_config
+from yadacoin.headercache import HeaderCache
+from yadacoin.retarget import RetargetEngine
+from yadacoin.peers import Peer
+
+
+class HeaderSync(object):
+    # Block fields served by /get-headers
+    PROJECTION = dict(HeaderCache.PROJECTION, version=1, public_key=1, nonce=1, merkleRoot=1)
+    # Concurrent body requests
+    PARALLEL = 4
+    # Headers per hash check task, tasks run in parallel on the verify executor threads
+    HASH_CHUNK = 100
+
+    def __init__(self):
+        self.config = get_config()
+        self.mongo = self.config.mongo
+        self.app_log = getLogger('tornado.application')
+        self.consensus = self.config.consensus
+
+    async def fetch(self, peer_string, path):
+        """Decoded json answer of a peer, None on any error"""
+        try:
+            request = HTTPRequest(
+                'http://{}{}'.format(peer_string, path),
+                headers=HTTPHeaders({"Connection": "close"}),
+                connect_timeout=3,
+                request_timeout=10
+            )
+            response = await self.config.http_client.fetch(request)
+            if response.code != 200:
+                return None
+            return json.loads(response.body.decode('utf-8'))
+        except Exception as e:
+            self.app_log.warning('Error requesting {} from {}: {}'.format(path, peer_string, e))
+            return None
+
+    async def get_heights(self, peers) -> dict:
+        """Chain height of each peer that answered"""
+        answers = await gather(*[self.fetch(peer_string, '/get-height') for peer_string in peers])
+        return {
+            peer_string: answer['height']
+            for peer_string, answer in zip(peers, answers)
+            if isinstance(answer, dict) and isinstance(answer.get('height'), int)
+        }
+
+    def check_headers(self, headers, last_header):
+        """Hash, PoW and linkage of headers chained to last_header, returns the first failing height or None"""
+        for header in headers:
+            if header.index != last_header.index + 1 or header.prev_hash != last_header.hash:
+                return header.index
+            if int(header.version) != int(CHAIN.get_version_for_height(header.index)):
+                return header.index
+            if header.time > time() + CHAIN.TIME_TOLERANCE:
+                return header.index
+            if header.hash != BlockFactory.generate_hash_from_header(header.index, BlockFactory.generate_header(header), str(header.nonce)):
+                return header.index
+            # A zero target is computed at load time, see Block.init_async, integration checks it
+            if header.target and int(header.hash, 16) > header.target and not header.special_min:
+                return header.index
+            last_header = header
+        return None
+
+    async def check_headers_async(self, headers, last_header):
+        if self.config.verify_executor:
+            return await self.config.verify_executor.run(self.check_headers, headers, last_header)
+        return self.check_headers(headers, last_header)
+
+    def get_retarget_view(self) -> RetargetEngine:
+        """Copy of the node's HeaderCache and RetargetEngine, for headers that are not stored yet"""
+        header_cache = self.config.header_cache
+        headers = HeaderCache(size=header_cache.size)
+        headers.headers.extend(header_cache.headers)
+        view = RetargetEngine(headers=headers, size=self.config.retarget_engine.entries.maxlen)
+        view.entries.extend(self.config.retarget_engine.entries)
+        return view
+
+    async def check_retarget(self, headers, last_header) -> int:
+        """Blockchain.check_link of each header against the one before it, in order, the retarget
+        from the checked ones. Returns how many headers passed, heights are consecutive up to there."""
+        view = self.get_retarget_view()
+        for position, header in enumerate(headers):
+            message = await Blockchain.check_link(header, last_header, view)
+            if message:
+                self.app_log.info('Header {} does not link: {}'.format(header.index, message))
+                return position
+            record = HeaderCache.from_block(header)
+            view.headers.append(record)
+            view.append(record)
+            last_header = header
+        return len(headers)
+
+    async def get_headers(self, peer_string, last_header, end_index) -> list:
+        """Checked headers after last_header from one peer, up to end_index.
+        Stops before the first one that does not check."""
+        start_index = last_header.index + 1
+        end_index = min(end_index, start_index + CHAIN.MAX_HEADERS_PER_MESSAGE - 1)
+        answer = await self.fetch(peer_string, '/get-headers?start_index={}&end_index={}'.format(start_index, end_index))
+        if not isinstance(answer, list) or not answer:
+            return []
+        try:
+            headers = [BlockHeader.from_dict(header) for header in answer]
+        except Exception as e:
+            self.app_log.warning('Bad headers from {}: {}'.format(peer_string, e))
+            return []
+        passed = await self.check_retarget(headers, last_header)
+        if not passed:
+            self.app_log.info('Headers from {} do not extend our tip'.format(peer_string))
+            return []
+        if passed < len(headers):
+            self.app_log.warning('Header {} from {} does not pass its retarget'.format(start_index + passed, peer_string))
+            headers = headers[:passed]
+        # Each chunk is chained to the last header of the previous one, any break is caught by one of them
+        chunks = [headers[i:i + self.HASH_CHUNK] for i in range(0, len(headers), self.HASH_CHUNK)]
+        failed = [
+            bad for bad in await gather(*[
+                self.check_headers_async(chunk, headers[i * self.HASH_CHUNK - 1] if i else last_header)
+                for i, chunk in enumerate(chunks)
+            ])
+            if bad is not None
+        ]
+        if failed:
+            bad = min(failed)
+            self.app_log.warning('Header {} from {} does not check'.format(bad, peer_string))
+            headers = headers[:bad - start_index]
+        return headers
+
+    async def get_bodies(self, headers, peers, semaphore) -> list:
+        """Block dicts matching a run of checked headers, tried on each peer in turn, None if none has them"""
+        start_index, end_index = headers[0].index, headers[-1].index
+        for peer_string in peers:
+            async with semaphore:
+                blocks = await self.fetch(peer_string, '/get-blocks?start_index={}&end_index={}'.format(start_index, end_index))
+            if (
+                isinstance(blocks, list) and len(blocks) == len(headers) and
+                all(block.get('index') == header.index and block.get('hash') == header.hash for block, header in zip(blocks, headers))
+            ):
+                return blocks
+            self.app_log.info('Blocks {}-{} from {} do not match their headers'.format(start_index, end_index, peer_string))
+        return None
+
+    async def sync(self, peers) -> bool:
+        """Headers-first sync from peers. Returns True if it inserted blocks, False when it did not apply,
+        peers not far enough ahead or not serving headers, so the caller falls back to request_blocks."""
+        peers = [peer_string for peer_string in peers if '0.0.0.0' not in peer_string]
+        latest = await self.config.BU.get_latest_block_async()
+        last_header = BlockHeader.from_dict(latest)
+        heights = await self.get_heights(peers)
+        if not heights:
+            return False
+        source = max(heights, key=heights.get)
+        top = heights[source]
+        # Closer than one body request, request_blocks does as well
+        if top - last_header.index <= CHAIN.MAX_BLOCKS_PER_MESSAGE:
+            return False
+        self.app_log.info('Headers-first sync from {} to {}, {} peers'.format(last_header.index + 1, top, len(heights)))
+        inserted = False
+        semaphore = Semaphore(self.PARALLEL)
+        while last_header.index < top:
+            headers = await self.get_headers(source, last_header, top)
+            if not headers:
+                break
+            end_index = headers[-1].index
+            # Peers that have the whole batch, source first, the next ones in turn for each range
+            holders = [peer_string for peer_string, height in heights.items() if height >= end_index and peer_string != source]
+            holders.insert(0, source)
+            runs = [headers[i:i + CHAIN.MAX_BLOCKS_PER_MESSAGE] for i in range(0, len(headers), CHAIN.MAX_BLOCKS_PER_MESSAGE)]
+            tasks = [
+                self.get_bodies(run, holders[i % len(holders):] + holders[:i % len(holders)], semaphore)
+                for i, run in enumerate(runs)
+            ]
+            # Started together, integrated in order as they complete
+            futures = [ensure_future(task) for task in tasks]
+            stopped = False
+            try:
+                for run, future in zip(runs, futures):
+                    blocks = await future
+                    if not blocks:
+                        self.app_log.warning('No peer served blocks {}-{}'.format(run[0].index, run[-1].index))
+                        stopped = True
+                        break
+                    result = await self.integrate(blocks, source)
+                    inserted = inserted or result
+                    if not result:
+                        stopped = True
+                        break
+            finally:
+                for future in futures:
+                    future.cancel()
+            if stopped:
+                # What was inserted so far is still announced below
+                break
+            last_header = headers[-1]
+        if inserted:
+            await self.consensus.trigger_update_event()
+        return inserted
+
+    async def integrate(self, blocks, peer_string) -> bool:
+        """Inserts a range of block dicts in order, as request_blocks does. False if one was not inserted."""
+        peer = Peer.from_string(peer_string)
+        for block_dict in blocks:
+            block = await Block.from_dict(block_dict)
+            latest_block = await self.config.BU.get_latest_block_async()
+            if block.index != latest_block['index'] + 1:
+                return False
+            await self.consensus.insert_consensus_block(block, peer)
+            if not await self.consensus.import_block({'peer': peer_string, 'block': block.to_dict(), 'extra_blocks': blocks}, trigger_event=False):
+                # Bad block, or a retrace moved the tip, either way this sync is over
+                self.consensus.latest_block = await Block.from_dict(await self.config.BU.get_latest_block_async())
+                self.app_log.debug('Block {} from {} not inserted'.format(block.index, peer_string))
+                return False
+            self.consensus.latest_block = block
+        return True
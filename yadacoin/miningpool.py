@@ -7,8 +7,9 @@ from threading import Thread
 
 from yadacoin.chain import CHAIN
 from yadacoin.config import get_config
-from yadacoin.block import Block, BlockFactory
+from yadacoin.block import Block, BlockFactory, BlockHeader
 from yadacoin.blockchain import Blockchain
+from yadacoin.rxhasher import RandomXHasher
 from yadacoin.transaction import (
     Transaction,
     MissingInputTransactionException, 
@@ -240,19 +241,20 @@ class MiningPool(object):
                 backup_block = None
             self.last_refresh = int(time())
             if block is None:
-                block = self.config.BU.get_latest_block()
+                block = await self.config.BU.get_latest_block_async()
             if block:
-                block = await Block.from_dict(block)
+                # Only its header is needed, to retarget the next one
+                block = BlockHeader.from_dict(block)
             else:
                 genesis_block = await BlockFactory.get_genesis_block()
                 await genesis_block.save()
-                self.mongo.db.consensus.insert({
+                await self.mongo.async_db.consensus.insert_one({
                     'block': genesis_block.to_dict(),
                     'peer': 'me',
                     'id': genesis_block.signature,
                     'index': 0
                     })
-                block = await Block.from_dict(self.config.BU.get_latest_block())
+                block = BlockHeader.from_dict(await self.config.BU.get_latest_block_async())
             self.index = block.index + 1
             self.last_block_time = int(block.time)
         except Exception as e:
@@ -318,7 +320,7 @@ class MiningPool(object):
             'header': self.block_factory.block.header,
             'version': self.block_factory.block.version,
             'height': self.block_factory.block.index,  # This is the height of the one we are mining
-            'previous_time': self.config.BU.get_latest_block()['time'],  # needed for miner to recompute the real diff
+            'previous_time': (await self.config.BU.get_latest_block_async())['time'],  # needed for miner to recompute the real diff
         }
         return res
 
@@ -329,14 +331,14 @@ class MiningPool(object):
             await self.refresh()
 
         difficulty = int(self.max_target / self.block_factory.block.target)
-        seed_hash = '4181a493b397a733b083639334bc32b407915b9a82b7917ac361816f0a1f5d4d' #sha256(yadacoin65000)
+        seed_hash = RandomXHasher.SEED_HASH
         res = {
             'difficulty': difficulty, 
             'target': hex(int(self.block_factory.block.target))[2:].rjust(64, '0')[:16],
             'blocktemplate_blob': self.block_factory.block.header.replace('{nonce}', '{000000}'),
             'blockhashing_blob': self.block_factory.block.header.replace('{nonce}', '{000000}'),
             'seed_hash': seed_hash,
-            'height': self.config.BU.get_latest_block()['index'],  # This is the height of the one we are mining
+            'height': (await self.config.BU.get_latest_block_async())['index'],  # This is the height of the one we are mining
         }
         return res
 
@@ -398,21 +400,30 @@ class MiningPool(object):
     async def get_pending_transactions(self):
         transaction_objs = []
         used_sigs = []
-        for txn in sorted([x for x in self.mongo.db.miner_transactions.find()], key=lambda i: int(i['fee']), reverse=True)[:1000]:
+        pending = sorted(await self.mongo.async_db.miner_transactions.find().to_list(None), key=lambda i: int(i['fee']), reverse=True)[:1000]
+        latest_index = (await self.config.BU.get_latest_block_async())['index']
+        spent_inputs = await self.config.BU.are_inputs_spent_async([
+            (x['id'], txn['public_key']) for txn in pending for x in txn.get('inputs', [])
+        ])
+        input_txns = await self.config.BU.get_transactions_by_ids_async([
+            x['id'] for txn in pending for x in txn.get('inputs', [])
+        ])
+        for txn in pending:
             try:
                 if isinstance(txn, FastGraph) and hasattr(txn, 'signatures'):
                     transaction_obj = txn
                 elif isinstance(txn, Transaction):
                     transaction_obj = txn
                 elif isinstance(txn, dict) and 'signatures' in txn:
-                    transaction_obj = FastGraph.from_dict(self.config.BU.get_latest_block()['index'], txn)
+                    transaction_obj = FastGraph.from_dict(latest_index, txn)
                 elif isinstance(txn, dict):
-                    transaction_obj = Transaction.from_dict(self.config.BU.get_latest_block()['index'], txn)
+                    transaction_obj = Transaction.from_dict(latest_index, txn)
                 else:
                     print('transaction unrecognizable, skipping')
                     continue
                 
-                transaction_obj.verify()
+                transaction_obj.input_txns = input_txns
+                await transaction_obj.verify_async()
                 
                 if transaction_obj.transaction_signature in used_sigs:
                     print('duplicate transaction found and removed')
@@ -421,8 +432,8 @@ class MiningPool(object):
 
                 if not isinstance(transaction_obj, FastGraph) and transaction_obj.rid:
                     for input_id in transaction_obj.inputs:
-                        input_block = self.config.BU.get_transaction_by_id(input_id.id, give_block=True)
-                        if input_block and input_block['index'] > (self.config.BU.get_latest_block()['index'] - 2016):
+                        input_block = await self.config.BU.get_transaction_by_id_async(input_id.id, give_block=True)
+                        if input_block and input_block['index'] > (latest_index - 2016):
                             continue
 
                 failed1 = False
@@ -430,43 +441,43 @@ class MiningPool(object):
                 used_ids_in_this_txn = []
 
                 for x in transaction_obj.inputs:
-                    if self.config.BU.is_input_spent(x.id, transaction_obj.public_key):
+                    if (x.id, transaction_obj.public_key) in spent_inputs:
                         failed1 = True
                     if x.id in used_ids_in_this_txn:
                         failed2 = True
                     used_ids_in_this_txn.append(x.id)
                 if failed1:
-                    self.mongo.db.miner_transactions.remove({'id': transaction_obj.transaction_signature})
+                    await self.mongo.async_db.miner_transactions.delete_many({'id': transaction_obj.transaction_signature})
                     print('transaction removed: input presumably spent already, not in unspent outputs', transaction_obj.transaction_signature)
-                    self.mongo.db.failed_transactions.insert({'reason': 'input presumably spent already', 'txn': transaction_obj.to_dict()})
+                    await self.mongo.async_db.failed_transactions.insert_one({'reason': 'input presumably spent already', 'txn': transaction_obj.to_dict()})
                 elif failed2:
-                    self.mongo.db.miner_transactions.remove({'id': transaction_obj.transaction_signature})
+                    await self.mongo.async_db.miner_transactions.delete_many({'id': transaction_obj.transaction_signature})
                     print('transaction removed: using an input used by another transaction in this block', transaction_obj.transaction_signature)
-                    self.mongo.db.failed_transactions.insert({'reason': 'using an input used by another transaction in this block', 'txn': transaction_obj.to_dict()})
+                    await self.mongo.async_db.failed_transactions.insert_one({'reason': 'using an input used by another transaction in this block', 'txn': transaction_obj.to_dict()})
                 else:
                     transaction_objs.append(transaction_obj)
             except MissingInputTransactionException as e:
-                self.mongo.db.miner_transactions.remove({'id': transaction_obj.transaction_signature})
-                self.mongo.db.failed_transactions.insert({'reason': 'MissingInputTransactionException', 'txn': transaction_obj.to_dict()})
+                await self.mongo.async_db.miner_transactions.delete_many({'id': transaction_obj.transaction_signature})
+                await self.mongo.async_db.failed_transactions.insert_one({'reason': 'MissingInputTransactionException', 'txn': transaction_obj.to_dict()})
                 print('MissingInputTransactionException: transaction removed')
-                self.mongo.db.miner_transactions.remove({'id': transaction_obj.transaction_signature})
-                self.mongo.db.failed_transactions.insert({'reason': 'MissingInputTransactionException', 'txn': transaction_obj.to_dict()})
+                await self.mongo.async_db.miner_transactions.delete_many({'id': transaction_obj.transaction_signature})
+                await self.mongo.async_db.failed_transactions.insert_one({'reason': 'MissingInputTransactionException', 'txn': transaction_obj.to_dict()})
             except InvalidTransactionSignatureException as e:
                 print('InvalidTransactionSignatureException: transaction removed')
-                self.mongo.db.miner_transactions.remove({'id': transaction_obj.transaction_signature})
-                self.mongo.db.failed_transactions.insert({'reason': 'InvalidTransactionSignatureException', 'txn': transaction_obj.to_dict()})
+                await self.mongo.async_db.miner_transactions.delete_many({'id': transaction_obj.transaction_signature})
+                await self.mongo.async_db.failed_transactions.insert_one({'reason': 'InvalidTransactionSignatureException', 'txn': transaction_obj.to_dict()})
             except InvalidTransactionException as e:
                 print('InvalidTransactionException: transaction removed')
-                self.mongo.db.miner_transactions.remove({'id': transaction_obj.transaction_signature})
-                self.mongo.db.failed_transactions.insert({'reason': 'InvalidTransactionException', 'txn': transaction_obj.to_dict()})
+                await self.mongo.async_db.miner_transactions.delete_many({'id': transaction_obj.transaction_signature})
+                await self.mongo.async_db.failed_transactions.insert_one({'reason': 'InvalidTransactionException', 'txn': transaction_obj.to_dict()})
             except TransactionInputOutputMismatchException as e:
                 print('TransactionInputOutputMismatchException: transaction removed')
-                self.mongo.db.miner_transactions.remove({'id': transaction_obj.transaction_signature})
-                self.mongo.db.failed_transactions.insert({'reason': 'TransactionInputOutputMismatchException', 'txn': transaction_obj.to_dict()})
+                await self.mongo.async_db.miner_transactions.delete_many({'id': transaction_obj.transaction_signature})
+                await self.mongo.async_db.failed_transactions.insert_one({'reason': 'TransactionInputOutputMismatchException', 'txn': transaction_obj.to_dict()})
             except TotalValueMismatchException as e:
                 print('TotalValueMismatchException: transaction removed')
-                self.mongo.db.miner_transactions.remove({'id': transaction_obj.transaction_signature})
-                self.mongo.db.failed_transactions.insert({'reason': 'TotalValueMismatchException', 'txn': transaction_obj.to_dict()})
+                await self.mongo.async_db.miner_transactions.delete_many({'id': transaction_obj.transaction_signature})
+                await self.mongo.async_db.failed_transactions.insert_one({'reason': 'TotalValueMismatchException', 'txn': transaction_obj.to_dict()})
             except Exception as e:
                 print(e)
                 #print 'rejected transaction', txn['id']
@@ -475,7 +486,7 @@ class MiningPool(object):
 
     @classmethod
     def pool_mine(cls, pool_peer, mining_cores, address, height, header, target, nonces, special_min, special_target):
-        Block.cores = mining_cores
+        RandomXHasher.get().threads = mining_cores
         nonce, lhash = BlockFactory.mine(height, header, target, nonces, special_min, special_target)
         if nonce and lhash:
             try:
@@ -519,7 +530,7 @@ class MiningPool(object):
                     print("Error ", e)
         # TODO: why do we only insert to consensus? Why not try to insert right away?
         # TODO: this is needed until bottom-up syncing is deprecated
-        self.mongo.db.consensus.insert_one({'peer': 'me', 'index': block_data['index'],
-                                            'id': block_data['id'], 'block': block_data})
+        await self.mongo.async_db.consensus.insert_one({'peer': 'me', 'index': block_data['index'],
+                                                        'id': block_data['id'], 'block': block_data})
         await self.config.consensus.import_block({'peer': self.config.peers.my_peer, 'block': block_data})
 
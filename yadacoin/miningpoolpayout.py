@@ -4,7 +4,7 @@ from socketIO_client import SocketIO, BaseNamespace
 from yadacoin.chain import CHAIN
 from yadacoin.config import get_config
 from yadacoin.peers import Peers
-from yadacoin.block import Block
+from yadacoin.block import Block, BlockHeader
 # from yadacoin.blockchainutils import BU
 from yadacoin.transaction import Transaction, TransactionFactory, Input, Output, NotEnoughMoneyException
 from yadacoin.transactionutils import TU
@@ -61,7 +61,7 @@ class PoolPayer(object):
         # first check which blocks we won.
         # then determine if we have already paid out
         # they must be 6 blocks deep
-        latest_block = await Block.from_dict(await self.config.BU.get_latest_block_async())
+        latest_block = BlockHeader.from_dict(await self.config.BU.get_latest_block_async())
         already_paid_height = await self.config.mongo.async_db.share_payout.find_one({}, sort=[('index', -1)])
         won_blocks = self.config.mongo.async_db.blocks.find({'transactions.outputs.to': self.config.address, 'index': {'$gt': already_paid_height.get('index', 0)}}).sort([('index', 1)])
         async for won_block in won_blocks:
@@ -72,7 +72,7 @@ class PoolPayer(object):
                 await self.do_payout_for_block(won_block)
     
     async def already_used(self, txn):
-        return await self.config.mongo.async_db.blocks.find_one({'transactions.inputs.id': txn.transaction_signature})
+        return await self.config.mongo.async_db.spent_outpoints.find_one({'id': txn.transaction_signature})
 
     async def do_payout_for_block(self, block):
         # check if we already paid out
@@ -91,6 +91,7 @@ class PoolPayer(object):
                 latest_block = await self.config.BU.get_latest_block_async()
                 transaction = Transaction.from_dict(latest_block['index'], existing['txn'])
                 await self.config.mongo.async_db.miner_transactions.insert_one(transaction.to_dict())
+                await self.config.on_mempool_transaction(transaction)
                 await self.broadcast_transaction(transaction)
                 return
         try:
@@ -145,6 +146,7 @@ class PoolPayer(object):
         txn = transaction.transaction
         if self.config.peers.peers:
             await self.config.mongo.async_db.miner_transactions.insert_one(txn.to_dict())
+            await self.config.on_mempool_transaction(txn)
             await self.config.mongo.async_db.share_payout.insert_one({'index': block.index, 'txn': txn.to_dict()})
             await self.broadcast_transaction(txn)
         
@@ -2,6 +2,7 @@ import os
 from pymongo import MongoClient, IndexModel, ASCENDING, DESCENDING
 from motor.motor_tornado import MotorClient
 
+from yadacoin.cacheinvalidator import CacheInvalidator
 from yadacoin.config import get_config
 
 
@@ -61,6 +62,63 @@ class Mongo(object):
         except:
             pass
 
+        __id_index_address = IndexModel([("id", ASCENDING), ("index", ASCENDING), ("address", ASCENDING)], name="__id_index_address", unique=True)
+        __address_spent_height = IndexModel([("address", ASCENDING), ("spent_height", ASCENDING)], name="__address_spent_height")
+        __height = IndexModel([("height", ASCENDING)], name="__height")
+        __spent_height = IndexModel([("spent_height", ASCENDING)], name="__spent_height")
+        try:
+            self.db.utxos.create_indexes([__id_index_address, __address_spent_height, __height, __spent_height])
+        except:
+            pass
+
+        __id_public_key_txn_id = IndexModel([("id", ASCENDING), ("public_key", ASCENDING), ("txn_id", ASCENDING)], name="__id_public_key_txn_id", unique=True)
+        __height = IndexModel([("height", ASCENDING)], name="__height")
+        try:
+            self.db.spent_outpoints.create_indexes([__id_public_key_txn_id, __height])
+        except:
+            pass
+
+        __id = IndexModel([("id", ASCENDING)], name="__id")
+        __hash = IndexModel([("hash", ASCENDING)], name="__hash")
+        __rid = IndexModel([("rid", ASCENDING)], name="__rid")
+        __requester_rid = IndexModel([("requester_rid", ASCENDING)], name="__requester_rid")
+        __requested_rid = IndexModel([("requested_rid", ASCENDING)], name="__requested_rid")
+        __public_key = IndexModel([("public_key", ASCENDING)], name="__public_key")
+        __outputs_to = IndexModel([("outputs.to", ASCENDING)], name="__outputs_to")
+        __inputs_id = IndexModel([("inputs.id", ASCENDING)], name="__inputs_id")
+        __height = IndexModel([("height", ASCENDING)], name="__height")
+        try:
+            self.db.transactions.create_indexes([__id, __hash, __rid, __requester_rid, __requested_rid, __public_key,
+                                                 __outputs_to, __inputs_id, __height])
+        except:
+            pass
+
+        __address = IndexModel([("address", ASCENDING)], name="__address", unique=True)
+        try:
+            self.db.address_keys.create_indexes([__address])
+        except:
+            pass
+
+        __address = IndexModel([("address", ASCENDING)], name="__address", unique=True)
+        try:
+            self.db.balances.create_indexes([__address])
+        except:
+            pass
+
+        # CacheInvalidator drops entries by height
+        __height = IndexModel([("height", ASCENDING)], name="__height")
+        for cache_collection in CacheInvalidator.COLLECTIONS:
+            try:
+                self.db[cache_collection].create_indexes([__height])
+            except:
+                pass
+
+        __id = IndexModel([("id", ASCENDING)], name="__id")
+        try:
+            self.db.miner_transactions_cache.create_indexes([__id])
+        except:
+            pass
+
         # TODO: add indexes for peers
 
         # See https://motor.readthedocs.io/en/stable/tutorial-tornado.html
@@ -10,6 +10,7 @@ from yadacoin.basehandlers import BaseHandler
 from yadacoin.blockchainutils import BU
 from yadacoin.common import ts_to_utc
 from yadacoin.chain import CHAIN
+from yadacoin.headersync import HeaderSync
 
 
 class GetLatestBlockHandler(BaseHandler):
@@ -18,7 +19,7 @@ class GetLatestBlockHandler(BaseHandler):
         """
         :return:
         """
-        block = BU().get_latest_block()
+        block = await BU().get_latest_block_async()
         # Note: I'd rather use an extra field "time_human" or time_utc than having different formats for a same field name.
         block['time_utc'] = ts_to_utc(block['time'])
         self.render_as_json(block)
@@ -33,7 +34,7 @@ class GetBlocksHandler(BaseHandler):
         end_index = min(int(self.get_argument("end_index", 0)), start_index + CHAIN.MAX_BLOCKS_PER_MESSAGE)
         # global chain object with cache of current block height,
         # so we can instantly answer to pulling requests without any db request
-        if start_index > self.config.BU.get_latest_block()['index']:
+        if start_index > (await self.config.BU.get_latest_block_async())['index']:
             # early exit without request
             self.render_as_json([])
         else:
@@ -51,6 +52,21 @@ class GetBlocksHandler(BaseHandler):
             self.render_as_json(await blocks.to_list(length=CHAIN.MAX_BLOCKS_PER_MESSAGE))
 
 
+class GetHeadersHandler(BaseHandler):
+
+    async def get(self):
+        """Header fields only of start_index to end_index, enough to check hash, PoW and linkage"""
+        start_index = int(self.get_argument("start_index", 0))
+        end_index = min(int(self.get_argument("end_index", 0)), start_index + CHAIN.MAX_HEADERS_PER_MESSAGE - 1)
+        if start_index > (await self.config.BU.get_latest_block_async())['index']:
+            self.render_as_json([])
+        else:
+            headers = self.mongo.async_db.blocks.find({
+                'index': {'$gte': start_index, '$lte': end_index}
+            }, HeaderSync.PROJECTION).sort([('index', 1)])
+            self.render_as_json(await headers.to_list(length=CHAIN.MAX_HEADERS_PER_MESSAGE))
+
+
 class GetBlockHandler(BaseHandler):
 
     async def get(self):
@@ -72,7 +88,7 @@ class GetBlockHandler(BaseHandler):
 class GetBlockHeightHandler(BaseHandler):
 
     async def get(self):
-        block = self.config.BU.get_latest_block()
+        block = await self.config.BU.get_latest_block_async()
         self.render_as_json({'height': block['index'], 'hash': block['hash']})
 
 
@@ -118,7 +134,7 @@ class NewBlockHandler(BaseHandler):
             # TODO: handle a dict here to store the consensus state
             if not self.peers.syncing:
                 self.app_log.debug("Trying to sync on latest block from {}".format(peer_string))
-                my_index = self.config.BU.get_latest_block()['index']
+                my_index = (await self.config.BU.get_latest_block_async())['index']
                 # This is mostly to keep in sync with fast moving blocks from whitelisted peers and pools.
                 # ignore if this does not fit.
                 if block_data['index'] == my_index + 1:
@@ -131,6 +147,9 @@ class NewBlockHandler(BaseHandler):
                 elif block_data['index'] > my_index + 1:
                     self.app_log.warning("Missing blocks between {} and {} , can't catch up from http route for {}"
                                          .format(my_index, block_data['index'], peer_string))
+                    if self.config.orphan_pool and peer_string:
+                        # Connected once the blocks before it come from another route
+                        self.config.orphan_pool.add(block_data, peer_string)
                     # data = {"start_index": my_index + 1, "end_index": my_index + 1 + CHAIN.MAX_BLOCKS_PER_MESSAGE}
                     # await self.emit('get_blocks', data=data, room=sid)
                 else:
@@ -173,6 +192,7 @@ class RebroadcastTransaction(BaseHandler):
 
 NODE_HANDLERS = [(r'/get-latest-block', GetLatestBlockHandler),
                  (r'/get-blocks', GetBlocksHandler),
+                 (r'/get-headers', GetHeadersHandler),
                  (r'/get-block', GetBlockHandler),
                  (r'/get-height|/getheight', GetBlockHeightHandler),
                  (r'/get-peers', GetPeersHandler),
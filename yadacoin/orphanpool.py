@@ -0,0 +1,125 @@
+"""
+Bounded in-memory pool of blocks received ahead of our tip.
+
+A block whose parent we do not have yet, from on_latest_block, NewBlockHandler or an on_blocks batch
+that does not start at our tip, is kept here by prev_hash instead of being dropped.
+Once its parent is inserted, the config.on_new_block event schedules connect, which imports the
+buffered descendants one height after the other, so they are not downloaded again.
+The pool holds at most MAX_COUNT blocks and MAX_BYTES of block json, the oldest go first,
+and nothing older than EXPIRY seconds.
+"""
+
+import json
+from collections import OrderedDict
+from logging import getLogger
+from time import time
+
+from tornado.ioloop import IOLoop
+
+from yadacoin.block import Block
+from yadacoin.config import get_config
+from yadacoin.peers import Peer
+
+
+class OrphanPool(object):
+    MAX_COUNT = 1000
+    MAX_BYTES = 64 * 1024 * 1024
+    # Seconds an orphan is kept
+    EXPIRY = 3600
+
+    def __init__(self, max_count=None, max_bytes=None):
+        self.config = get_config()
+        self.mongo = self.config.mongo
+        self.app_log = getLogger('tornado.application')
+        self.max_count = max_count or self.MAX_COUNT
+        self.max_bytes = max_bytes or self.MAX_BYTES
+        # hash: (block dict, peer string, size, time), oldest first
+        self.blocks = OrderedDict()
+        # prev_hash: set of hashes
+        self.children = {}
+        self.size = 0
+
+    def add(self, block: dict, peer_string) -> bool:
+        """Buffers a block dict received from peer_string, False if it is already there or can not be held"""
+        block_hash = block.get('hash')
+        if not block_hash or not block.get('prevHash') or block_hash in self.blocks:
+            return False
+        size = len(json.dumps(block))
+        if size > self.max_bytes:
+            return False
+        self.expire()
+        while self.blocks and (len(self.blocks) >= self.max_count or self.size + size > self.max_bytes):
+            self.remove(next(iter(self.blocks)))
+        self.blocks[block_hash] = (block, peer_string, size, time())
+        self.children.setdefault(block['prevHash'], set()).add(block_hash)
+        self.size += size
+        self.app_log.debug('Orphan block {} {} buffered, {} in pool'.format(block.get('index'), block_hash, len(self.blocks)))
+        return True
+
+    def remove(self, block_hash):
+        block, peer_string, size, added = self.blocks.pop(block_hash)
+        siblings = self.children.get(block['prevHash'])
+        if siblings is not None:
+            siblings.discard(block_hash)
+            if not siblings:
+                del self.children[block['prevHash']]
+        self.size -= size
+
+    def expire(self):
+        limit = time() - self.EXPIRY
+        while self.blocks:
+            block_hash, (block, peer_string, size, added) = next(iter(self.blocks.items()))
+            if added >= limit:
+                break
+            self.remove(block_hash)
+
+    def pop_children(self, block_hash) -> list:
+        """(block dict, peer string) of the buffered blocks whose parent is block_hash, removed from the pool"""
+        self.expire()
+        children = []
+        for child_hash in list(self.children.get(block_hash, ())):
+            block, peer_string, size, added = self.blocks[child_hash]
+            children.append((block, peer_string))
+            self.remove(child_hash)
+        return children
+
+    async def on_new_block(self, block):
+        """Called by config.on_new_block once a block was inserted. Connects its buffered descendants."""
+        if block.hash in self.blocks:
+            self.remove(block.hash)
+        if block.hash in self.children:
+            # Not from within the insert that triggered the event
+            IOLoop.current().spawn_callback(self.connect)
+
+    async def connect(self):
+        """Imports the buffered descendants of our tip, as long as there are some"""
+        if self.config.peers.syncing:
+            # Whoever syncs calls us again once done
+            return
+        self.config.peers.syncing = True
+        consensus = self.config.consensus
+        inserted = False
+        try:
+            latest = await self.config.BU.get_latest_block_async()
+            while latest['hash'] in self.children:
+                # Competing children, lowest target first as sync_bottom_up does
+                for block_dict, peer_string in sorted(self.pop_children(latest['hash']), key=lambda x: int(x[0]['target'], 16)):
+                    block = await Block.from_dict(block_dict)
+                    if block.index != latest['index'] + 1 or block.in_the_future():
+                        continue
+                    await consensus.insert_consensus_block(block, Peer.from_string(peer_string))
+                    if await consensus.import_block({'peer': peer_string, 'block': block_dict}, trigger_event=False):
+                        consensus.latest_block = block
+                        inserted = True
+                        self.app_log.info('Connected orphan block {}'.format(block.index))
+                        break
+                latest = await self.config.BU.get_latest_block_async()
+        except Exception as e:
+            self.app_log.warning('Error connecting orphan blocks: {}'.format(e))
+        finally:
+            self.config.peers.syncing = False
+        if inserted:
+            await consensus.trigger_update_event()
+
+    def get_status(self):
+        return {'count': len(self.blocks), 'bytes': self.size}
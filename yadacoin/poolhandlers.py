@@ -85,10 +85,8 @@ class JSONRPC(BaseHandler):
                 'result': await self.config.mp.block_template()
             })
         elif body.get('method') == 'get_balance':
-            balance = 0
-            async for x in self.config.BU.get_wallet_balance(self.config.address):
-                balance = x
-                break
+            balances = await self.config.BU.get_wallet_balances([self.config.address])
+            balance = balances[self.config.address]
             self.render_as_json({
                 'id': body.get('id'),
                 'method': body.get('method'),
@@ -103,7 +101,7 @@ class JSONRPC(BaseHandler):
                 'id': body.get('id'),
                 'method': body.get('method'),
                 'jsonrpc': body.get('jsonrpc'),
-                'result': {'height': self.config.BU.get_latest_block()['index']}
+                'result': {'height': (await self.config.BU.get_latest_block_async())['index']}
             })
         elif body.get('method') == 'transfer':
             for x in body.get('params').get('destinations'):
@@ -0,0 +1,124 @@
+"""
+Incremental state for the difficulty retarget, on top of the HeaderCache.
+
+For every recent header we keep the cumulative sum of targets and the last headers
+the get_target walk backs would stop at. Appending a block is O(1), a rollback pops
+the removed entries, and the window sums get_target_10min needs are a subtraction.
+Sums are exact integers, so results are bit-identical to summing the window.
+No timestamp sums are kept: the retarget only uses the elapsed time of a window, the time of the
+block minus the time of the header retarget_period ago, and the block time deltas of the window add
+up to that difference. It is one HeaderCache lookup per window, which a prefix sum would not save.
+"""
+
+from collections import deque, namedtuple
+from logging import getLogger
+
+from yadacoin.chain import CHAIN
+from yadacoin.config import get_config
+from yadacoin.headercache import HeaderCache
+
+
+RetargetEntry = namedtuple('RetargetEntry', ['index', 'cumulative_target', 'last_regular', 'last_usable'])
+
+
+class RetargetEngine(object):
+    SIZE = HeaderCache.SIZE
+
+    def __init__(self, headers=None, size=None):
+        self.config = get_config()
+        self.app_log = getLogger('tornado.application')
+        self.headers = headers or self.config.header_cache
+        self.entries = deque(maxlen=size or self.SIZE)
+
+    @staticmethod
+    def is_regular(header) -> bool:
+        # What get_target looks for at a retarget height: special_min is False, not just falsy
+        return header.special_min is False and header.target != CHAIN.MAX_TARGET
+
+    @staticmethod
+    def is_usable(header) -> bool:
+        # What get_target walks back over between retarget heights
+        return not (header.special_min or header.target == CHAIN.MAX_TARGET or not header.target)
+
+    @property
+    def tip(self):
+        return self.entries[-1] if self.entries else None
+
+    async def load(self):
+        """Builds the entries from the HeaderCache content. Called once at startup, after HeaderCache.load"""
+        self.entries.clear()
+        for header in self.headers.headers:
+            self.append(header)
+
+    def append(self, header):
+        tip = self.tip
+        if tip and header.index <= tip.index:
+            self.truncate(header.index)
+            tip = self.tip
+        if tip and header.index != tip.index + 1:
+            self.entries.clear()
+            tip = None
+        if tip:
+            cumulative_target = tip.cumulative_target + header.target
+            last_regular = tip.last_regular
+            last_usable = tip.last_usable
+        else:
+            # Nothing known below, lookups falling there go through the headers
+            cumulative_target = header.target
+            last_regular = None
+            last_usable = None
+        if self.is_regular(header):
+            last_regular = header
+        if self.is_usable(header):
+            last_usable = header
+        self.entries.append(RetargetEntry(header.index, cumulative_target, last_regular, last_usable))
+
+    def truncate(self, index):
+        """Drops every entry >= index"""
+        while self.entries and self.entries[-1].index >= index:
+            self.entries.pop()
+
+    async def on_new_block(self, block):
+        """Called by config.on_new_block once the block is stored in the blocks collection"""
+        self.append(HeaderCache.from_block(block))
+
+    async def on_blocks_removed(self, index):
+        """Called by config.on_blocks_removed once every block >= index was deleted from the blocks collection"""
+        self.truncate(index)
+
+    def get(self, index):
+        if not self.entries:
+            return None
+        position = index - self.entries[0].index
+        if position < 0 or position >= len(self.entries):
+            return None
+        return self.entries[position]
+
+    async def get_target_sum(self, index, count):
+        """Sum of the targets of the count blocks up to index included"""
+        end = self.get(index)
+        start = self.get(index - count)
+        if end and start:
+            return end.cumulative_target - start.cumulative_target
+        target_sum = 0
+        for i in range(index, index - count, -1):
+            target_sum += (await self.headers.get_header(i)).target
+        return target_sum
+
+    async def get_last_regular(self, index):
+        """Latest regular header <= index, see is_regular"""
+        entry = self.get(index)
+        if entry and entry.last_regular:
+            return entry.last_regular
+        return await self.headers.get_last_regular(index, CHAIN.MAX_TARGET)
+
+    async def get_last_usable(self, index):
+        """Latest usable header <= index, see is_usable. Like the original walk back, stops at header 1."""
+        entry = self.get(index)
+        if entry and entry.last_usable and entry.last_usable.index > 1:
+            return entry.last_usable
+        for i in range(index, 1, -1):
+            header = await self.headers.get_header(i)
+            if self.is_usable(header):
+                return header
+        return await self.headers.get_header(1)
@@ -0,0 +1,89 @@
+"""
+RandomX hashing service.
+
+Holds a pool of initialized pyrx VMs shared by block verification, the verify executor threads,
+the mining pool and consensus. A call checks a VM out for the duration of one hash, so concurrent
+callers never share one, and waits when all of them are busy.
+Pool size, the thread count handed to RandomX and light or fast mode come from config.
+Fast mode needs about 2GB of memory per dataset but hashes several times faster.
+Keeps the hash count and a hashes-per-second rate for the status.
+"""
+
+import binascii
+import os
+from logging import getLogger
+from queue import Queue
+from threading import Lock
+from time import time
+
+import pyrx
+
+from yadacoin.config import get_config
+
+
+class RandomXHasher(object):
+    # sha256(yadacoin65000), the only seed used so far
+    SEED_HASH = '4181a493b397a733b083639334bc32b407915b9a82b7917ac361816f0a1f5d4d'
+    MODES = ('light', 'fast')
+    # Seconds the hash rate is measured over
+    RATE_WINDOW = 60
+
+    def __init__(self, vms=None, threads=None, mode=None):
+        self.config = get_config()
+        self.app_log = getLogger('tornado.application')
+        self.vms = vms or getattr(self.config, 'randomx_vms', 0) or 1
+        self.threads = threads or getattr(self.config, 'randomx_threads', 0) or os.cpu_count() or 1
+        self.mode = mode or getattr(self.config, 'randomx_mode', '') or 'light'
+        if self.mode not in self.MODES:
+            raise ValueError('randomx_mode must be one of {}'.format(', '.join(self.MODES)))
+        if self.mode == 'fast':
+            # Read by the RandomX wrapper when it allocates the dataset
+            os.environ['MONERO_RANDOMX_FULL_MEM'] = '1'
+        self.seed_hash = binascii.unhexlify(self.SEED_HASH)
+        self.pool = Queue()
+        for _ in range(self.vms):
+            self.pool.put(pyrx.PyRX())
+        self.lock = Lock()
+        self.hashes = 0
+        self.window_start = time()
+        self.window_hashes = 0
+        self.hash_rate = 0.0
+
+    @classmethod
+    def get(cls):
+        """The node wide hasher, created on first use where tnode did not set one (worker processes, tools)"""
+        config = get_config()
+        if not getattr(config, 'rx_hasher', None):
+            config.rx_hasher = cls()
+        return config.rx_hasher
+
+    def hash(self, header: str, height: int) -> bytes:
+        vm = self.pool.get()
+        try:
+            result = vm.get_rx_hash(header, self.seed_hash, height, self.threads)
+        finally:
+            self.pool.put(vm)
+        self.count()
+        return result
+
+    def count(self):
+        with self.lock:
+            self.hashes += 1
+            self.window_hashes += 1
+            elapsed = time() - self.window_start
+            if elapsed >= self.RATE_WINDOW:
+                self.hash_rate = self.window_hashes / elapsed
+                self.window_start = time()
+                self.window_hashes = 0
+
+    def get_status(self):
+        with self.lock:
+            elapsed = time() - self.window_start
+            hash_rate = self.hash_rate if elapsed < self.RATE_WINDOW else self.window_hashes / elapsed
+        return {
+            'mode': self.mode,
+            'vms': self.vms,
+            'threads': self.threads,
+            'hashes': self.hashes,
+            'hash_rate': round(hash_rate, 2)
+        }
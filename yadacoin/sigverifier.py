@@ -0,0 +1,143 @@
+"""
+Batched signature verification in a process pool.
+
+The block, transaction and external input signatures of a block, or of a window of blocks,
+do not depend on each other. They are collected as (signature, message, public_key, fallback_message)
+tuples and checked by worker processes, one chunk per task, instead of one by one on the event loop.
+Each check is the very same as the serial one in Block.verify and Transaction.verify: coincurve first,
+then VerifyMessage against the address of the public key, with the same message object.
+Objects whose signature passed are flagged and their verify() skips that check only.
+Anything that failed is left unflagged, so verify() runs the serial check and raises as before.
+"""
+
+import base64
+import os
+from asyncio import gather, get_event_loop
+from concurrent.futures import ProcessPoolExecutor
+from logging import getLogger
+from multiprocessing import get_context
+from time import time
+
+from bitcoin.signmessage import BitcoinMessage, VerifyMessage
+from bitcoin.wallet import P2PKHBitcoinAddress
+from coincurve.utils import verify_signature
+
+from yadacoin.config import get_config
+from yadacoin.transaction import ExternalInput
+
+
+def check_signature(signature, message, public_key, fallback_message) -> bool:
+    """Same outcome as the try/except pairs of the serial verify methods"""
+    try:
+        if verify_signature(base64.b64decode(signature), message, bytes.fromhex(public_key)):
+            return True
+    except Exception:
+        pass
+    try:
+        address = P2PKHBitcoinAddress.from_pubkey(bytes.fromhex(public_key))
+        return bool(VerifyMessage(address, BitcoinMessage(fallback_message, magic=''), signature))
+    except Exception:
+        return False
+
+
+def check_signatures(items) -> list:
+    """Worker side, one chunk of tuples"""
+    return [check_signature(*item) for item in items]
+
+
+class SignatureVerifier(object):
+    # Tuples per worker task
+    CHUNK = 256
+    # Smaller batches are checked in process, the pool round trip would cost more than it saves
+    MIN_BATCH = 64
+
+    def __init__(self, workers=None):
+        self.config = get_config()
+        self.mongo = self.config.mongo
+        self.app_log = getLogger('tornado.application')
+        self.workers = workers or getattr(self.config, 'sig_workers', 0) or os.cpu_count() or 1
+        # Started on first use, spawn so workers do not inherit the mongo client threads
+        self.pool = None
+        # count, failed, seconds and rate of the latest batch
+        self.last_batch = {}
+
+    def get_pool(self):
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=get_context('spawn'))
+        return self.pool
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+            self.pool = None
+
+    async def collect(self, block):
+        """Signatures to check for a block, as a list of (owner, tuple)"""
+        hash_bytes = block.hash.encode('utf-8')
+        items = [(block, (block.signature, hash_bytes, block.public_key, hash_bytes))]
+        # Signed by the recipient of the input transaction, one query for all of them
+        input_txns = await self.config.BU.get_transactions_by_ids_async([
+            x.id for txn in block.transactions for x in txn.inputs if isinstance(x, ExternalInput)
+        ])
+        for txn in block.transactions:
+            hash_bytes = txn.hash.encode('utf-8')
+            items.append((txn, (txn.transaction_signature, hash_bytes, txn.public_key, hash_bytes)))
+            for txn_input in txn.inputs:
+                if not isinstance(txn_input, ExternalInput):
+                    continue
+                input_txn = input_txns.get(txn_input.id)
+                if not input_txn or not input_txn.get('public_key'):
+                    continue
+                items.append((
+                    (txn_input, input_txn['public_key']),
+                    (txn_input.signature, txn_input.id.encode('utf-8'), input_txn['public_key'], txn_input.id)
+                ))
+        return items
+
+    async def verify_batch(self, items) -> list:
+        """Checks a list of tuples, returns one bool per tuple"""
+        if not items:
+            return []
+        start = time()
+        if len(items) < self.MIN_BATCH:
+            results = check_signatures(items)
+        else:
+            loop = get_event_loop()
+            try:
+                pool = self.get_pool()
+                chunks = await gather(*[
+                    loop.run_in_executor(pool, check_signatures, items[i:i + self.CHUNK])
+                    for i in range(0, len(items), self.CHUNK)
+                ])
+                results = [result for chunk in chunks for result in chunk]
+            except Exception as e:
+                # A broken pool must not reject valid blocks, start a new one next time
+                self.app_log.warning('Signature pool error, checking in process: {}'.format(e))
+                self.shutdown()
+                results = check_signatures(items)
+        seconds = time() - start
+        self.last_batch = {
+            'count': len(items),
+            'failed': results.count(False),
+            'seconds': seconds,
+            'rate': len(items) / seconds if seconds else 0
+        }
+        self.app_log.info('Verified {count} signatures, {failed} failed, in {seconds:.3f}s, {rate:.0f}/s'.format(**self.last_batch))
+        return results
+
+    async def verify_blocks(self, blocks) -> bool:
+        """Checks every signature of the blocks in one batch and flags the ones that passed.
+        Returns True if all of them did."""
+        owned = []
+        for block in blocks:
+            owned.extend(await self.collect(block))
+        results = await self.verify_batch([item for owner, item in owned])
+        for (owner, item), result in zip(owned, results):
+            if not result:
+                continue
+            if isinstance(owner, tuple):
+                txn_input, public_key = owner
+                txn_input.verified_public_key = public_key
+            else:
+                owner.signature_verified = True
+        return all(results)
@@ -6,10 +6,10 @@ import time
 from logging import getLogger
 
 from bitcoin.signmessage import BitcoinMessage, VerifyMessage
-from bitcoin.wallet import P2PKHBitcoinAddress
 from coincurve import verify_signature
 from eccsnacks.curve25519 import scalarmult_base
 
+from yadacoin.addresscache import AddressCache
 from yadacoin.crypt import Crypt
 from yadacoin.transactionutils import TU
 # from yadacoin.blockchainutils import BU
@@ -132,10 +132,10 @@ class TransactionFactory(object):
         outputs_and_fee_total = sum([x.value for x in self.outputs])+self.fee
         if outputs_and_fee_total == 0:
             return
-        my_address = str(P2PKHBitcoinAddress.from_pubkey(bytes.fromhex(self.public_key)))
-        miner_transactions = self.mongo.db.miner_transactions.find()
+        my_address = AddressCache.address(self.public_key)
+        miner_transactions = self.mongo.async_db.miner_transactions.find()
         mtxn_ids = []
-        for mtxn in miner_transactions:
+        async for mtxn in miner_transactions:
             for mtxninput in mtxn['inputs']:
                 mtxn_ids.append(mtxninput['id'])
         
@@ -160,13 +160,13 @@ class TransactionFactory(object):
                 needed_inputs = []
                 done = False
                 for y in inputs:
-                    txn = self.config.BU.get_transaction_by_id(y.id, instance=True)
+                    txn = await self.config.BU.get_transaction_by_id_async(y.id, instance=True)
                     if not txn:
                         raise MissingInputTransactionException()
                         
                     if isinstance(y, ExternalInput):
                         y.verify()
-                        address = str(P2PKHBitcoinAddress.from_pubkey(bytes.fromhex(txn.public_key)))
+                        address = AddressCache.address(txn.public_key)
                     else:
                         address = my_address
                     for txn_output in txn.outputs:
@@ -313,6 +313,10 @@ class Transaction(object):
         self.hash = txn_hash
         self.outputs = []
         self.extra_blocks = extra_blocks
+        # Set by SignatureVerifier once transaction_signature passed a batch check
+        self.signature_verified = False
+        # {id: txn dict} of the input transactions, set by BU.prefetch_inputs_async
+        self.input_txns = None
         for x in outputs:
             self.outputs.append(Output.from_dict(x))
         self.inputs = []
@@ -352,28 +356,28 @@ class Transaction(object):
         return int(self.time) > time.time() + CHAIN.TIME_TOLERANCE
 
     def verify(self):
-        from yadacoin.fastgraph import FastGraph
         verify_hash = self.generate_hash()
-        address = P2PKHBitcoinAddress.from_pubkey(bytes.fromhex(self.public_key))
+        address = AddressCache.address(self.public_key)
 
         if verify_hash != self.hash:
             raise InvalidTransactionException("transaction is invalid")
 
-        try:
-            result = verify_signature(base64.b64decode(self.transaction_signature), self.hash.encode('utf-8'),
-                                      bytes.fromhex(self.public_key))
-            if not result:
-                print("t verify1")
-                raise Exception()
-        except:
+        if not self.signature_verified:
             try:
-                result = VerifyMessage(address, BitcoinMessage(self.hash.encode('utf-8'), magic=''), self.transaction_signature)
+                result = verify_signature(base64.b64decode(self.transaction_signature), self.hash.encode('utf-8'),
+                                          bytes.fromhex(self.public_key))
                 if not result:
-                    print("t verify2")
-                    raise
+                    print("t verify1")
+                    raise Exception()
             except:
-                print("t verify3")
-                raise InvalidTransactionSignatureException("transaction signature did not verify")
+                try:
+                    result = VerifyMessage(address, BitcoinMessage(self.hash.encode('utf-8'), magic=''), self.transaction_signature)
+                    if not result:
+                        print("t verify2")
+                        raise
+                except:
+                    print("t verify3")
+                    raise InvalidTransactionSignatureException("transaction signature did not verify")
 
         if len(self.relationship) > 20480:
             raise MaxRelationshipSizeExceeded('Relationship field cannot be greater than 2048 bytes')
@@ -381,8 +385,7 @@ class Transaction(object):
         # verify spend
         total_input = 0
         for txn in self.inputs:
-            # TODO: move to async
-            input_txn = self.config.BU.get_transaction_by_id(txn.id, include_fastgraph=isinstance(self, FastGraph))
+            input_txn = self.get_input_txn(txn.id)
             if not input_txn:
                 raise InvalidTransactionException("Input not found on blockchain.")
             txn_input = Transaction.from_dict(self.block_height, input_txn)
@@ -390,22 +393,23 @@ class Transaction(object):
             found = False
             for output in txn_input.outputs:
                 if isinstance(txn, ExternalInput):
-                    ext_address = P2PKHBitcoinAddress.from_pubkey(bytes.fromhex(txn_input.public_key))
-                    int_address = P2PKHBitcoinAddress.from_pubkey(bytes.fromhex(txn.public_key))
+                    ext_address = AddressCache.address(txn_input.public_key)
+                    int_address = AddressCache.address(txn.public_key)
                     if str(output.to) == str(ext_address) and str(int_address) == str(txn.address):
-                        try:
-                            result = verify_signature(base64.b64decode(txn.signature), txn.id.encode('utf-8'), bytes.fromhex(txn_input.public_key))
-                            if not result:
-                                print("t verify4")
-                                raise Exception()
-                        except:
+                        if txn.verified_public_key != txn_input.public_key:
                             try:
-                                result = VerifyMessage(ext_address, BitcoinMessage(txn.id, magic=''), txn.signature)
+                                result = verify_signature(base64.b64decode(txn.signature), txn.id.encode('utf-8'), bytes.fromhex(txn_input.public_key))
                                 if not result:
-                                    print("t verify5")
-                                    raise
+                                    print("t verify4")
+                                    raise Exception()
                             except:
-                                raise InvalidTransactionSignatureException("external input transaction signature did not verify")
+                                try:
+                                    result = VerifyMessage(ext_address, BitcoinMessage(txn.id, magic=''), txn.signature)
+                                    if not result:
+                                        print("t verify5")
+                                        raise
+                                except:
+                                    raise InvalidTransactionSignatureException("external input transaction signature did not verify")
                         
                         found = True
                         total_input += float(output.value)
@@ -429,6 +433,12 @@ class Transaction(object):
         if "{0:.8f}".format(total_input) != "{0:.8f}".format(total):
             raise TotalValueMismatchException("inputs and outputs sum must match %s, %s, %s, %s" % (total_input, float(total_output), float(self.fee), total))
 
+    async def verify_async(self):
+        """Runs verify in the VerifyExecutor when there is one, so the IOLoop is not held"""
+        if self.config.verify_executor:
+            return await self.config.verify_executor.run(self.verify)
+        return self.verify()
+
     def generate_hash(self):
         inputs_concat = self.get_input_hashes()
         outputs_concat = self.get_output_hashes()
@@ -458,13 +468,20 @@ class Transaction(object):
             ).digest().hex()
         return hashout
 
-    def get_input_hashes(self):
+    def get_input_txn(self, input_id):
+        """Input transaction as a dict, from input_txns once prefetched, else from the db"""
         from yadacoin.fastgraph import FastGraph
+        if self.input_txns is not None:
+            return self.input_txns.get(input_id)
+        # TODO: move to async
+        return self.config.BU.get_transaction_by_id(input_id, include_fastgraph=isinstance(self, FastGraph))
+
+    def get_input_hashes(self):
         input_hashes = []
         for x in self.inputs:
-            txn = self.config.BU.get_transaction_by_id(x.id, instance=True, include_fastgraph=isinstance(self, FastGraph))
+            txn = self.get_input_txn(x.id)
             if txn:
-                input_hashes.append(str(txn.transaction_signature))
+                input_hashes.append(str(txn['id']))
             else:
                 found = False
                 if self.extra_blocks:
@@ -486,17 +503,10 @@ class Transaction(object):
         return ''.join([x['to'] + "{0:.8f}".format(x['value']) for x in outputs_sorted])
     
     def used_as_input(self, input_id):
-        block = self.config.mongo.db.blocks.find_one({ # we need to look ahead in the chain
-            'transactions.inputs.id': input_id
-        })
-        output_txn = None
-        if not block:
-            return output_txn
-        for txn in block['transactions']:
-            for inp in txn['inputs']:
-                if inp['id'] == input_id:
-                    output_txn = txn
-                    return output_txn
+        for x in self.config.BU.find_transactions({ # we need to look ahead in the chain
+            'inputs.id': input_id
+        }):
+            return x['txn']
 
     def to_dict(self):
         relationship = self.relationship
@@ -552,6 +562,8 @@ class ExternalInput(Input):
         self.id = txn_id
         self.signature = signature
         self.address = address
+        # Public key of the input transaction this signature passed a batch check against, see SignatureVerifier
+        self.verified_public_key = None
 
     def verify(self):
         txn = self.config.BU.get_transaction_by_id(self.id, instance=True)
@@ -96,6 +96,7 @@ class TU(object):  # Transaction Utilities
             return {"error": "invalid transaction"}
 
         await config.mongo.async_db.miner_transactions.insert_one(transaction.transaction.to_dict())
+        await config.on_mempool_transaction(transaction.transaction)
         txn_b = TxnBroadcaster(config)
         await txn_b.txn_broadcast_job(transaction.transaction)
 
@@ -0,0 +1,43 @@
+"""
+Dedicated executor for block and transaction verification.
+
+Block.verify and Transaction.verify hash, run RandomX and check signatures, all CPU bound and sync.
+Called inline from a coroutine they hold the IOLoop for the whole block, and websocket peers and
+miners stall. Block.verify_async and Transaction.verify_async hand them to this executor instead
+and await the result.
+At most MAX_PENDING verifications are queued or running, further callers wait for a slot,
+so a flood of incoming transactions can not pile up unbounded work.
+verify() only uses the sync mongo client, which is thread safe.
+"""
+
+from asyncio import Semaphore, get_event_loop
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+
+from yadacoin.config import get_config
+
+
+class VerifyExecutor(object):
+    MAX_PENDING = 32
+
+    def __init__(self, workers=None, max_pending=None):
+        self.config = get_config()
+        self.app_log = getLogger('tornado.application')
+        # One thread by default, more only help with as many RandomX vms, see RandomXHasher
+        self.workers = workers or getattr(self.config, 'verify_workers', 0) or 1
+        self.max_pending = max_pending or self.MAX_PENDING
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='verify')
+        self.slots = Semaphore(self.max_pending)
+        self.pending = 0
+
+    async def run(self, func, *args):
+        """Runs func(*args) in the executor once a slot is free, returns or raises its outcome"""
+        async with self.slots:
+            self.pending += 1
+            try:
+                return await get_event_loop().run_in_executor(self.executor, func, *args)
+            finally:
+                self.pending -= 1
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -10,7 +10,8 @@ import datetime
 import jwt
 import time
 from bip32utils import BIP32Key
-from bitcoin.wallet import CBitcoinSecret, P2PKHBitcoinAddress
+from bitcoin.wallet import CBitcoinSecret
+from yadacoin.addresscache import AddressCache
 from yadacoin.basehandlers import BaseHandler
 from yadacoin.blockchainutils import BU
 from yadacoin.transaction import Transaction, TransactionFactory, NotEnoughMoneyException
@@ -48,7 +49,7 @@ class GenerateChildWalletHandler(BaseHandler):
         key = exkey.ChildKey(inc)
         child_key = BIP32Key.fromExtendedKey(key.ExtendedKey())
         public_key = child_key.PublicKey().hex()
-        address = str(P2PKHBitcoinAddress.from_pubkey(bytes.fromhex(public_key)))
+        address = AddressCache.address(public_key)
         private_key = child_key.PrivateKey().hex()
         wif = self.to_wif(private_key)
 
@@ -93,11 +94,39 @@ class GetBalanceSum(BaseHandler):
         if not addresses:
             self.render_as_json({})
             return
-        balance = 0.0
-        for address in addresses:
-            balance += await BU().get_wallet_balance(address)
+        balances = await BU().get_wallet_balances(addresses)
         return self.render_as_json({
-            'balance': "{0:.8f}".format(balance)
+            'balance': "{0:.8f}".format(sum(balances.values()))
+        })
+
+
+class GetBalancesHandler(BaseHandler):
+    # Upper bound on addresses per request
+    MAX_ADDRESSES = 1000
+
+    async def get(self):
+        addresses = [x for x in self.get_argument("addresses", "").split(',') if x]
+        return await self.render_balances(addresses)
+
+    async def post(self):
+        args = json.loads(self.request.body.decode())
+        return await self.render_balances(args.get("addresses", []))
+
+    async def render_balances(self, addresses):
+        if not addresses:
+            return self.render_as_json({})
+        if len(addresses) > self.MAX_ADDRESSES:
+            self.set_status(400)
+            return self.render_as_json({'error': 'too many addresses, max {}'.format(self.MAX_ADDRESSES)})
+        balances = await BU().get_wallet_balances(addresses)
+        pending = await BU().get_pending_balances(addresses)
+        return self.render_as_json({
+            'balances': {
+                address: {
+                    'balance': "{0:.8f}".format(balances[address]),
+                    'pending': "{0:.8f}".format(pending[address])
+                } for address in balances
+            }
         })
 
 
@@ -125,7 +154,7 @@ class CreateTransactionView(BaseHandler):
             inputs.extend([x async for x in BU().get_wallet_unspent_transactions(from_address)])
 
         txn = await TransactionFactory.construct(
-            block_height=BU().get_latest_block()['index'],
+            block_height=(await BU().get_latest_block_async())['index'],
             private_key=config.private_key,
             public_key=config.public_key,
             fee=float(fee),
@@ -156,10 +185,10 @@ class CreateRawTransactionView(BaseHandler):
 
         inputs = []
         for from_address in from_addresses:
-            inputs.extend([x async for x in await BU().get_wallet_unspent_transactions(from_address)])
+            inputs.extend([x async for x in BU().get_wallet_unspent_transactions(from_address)])
 
         txn = await TransactionFactory.construct(
-            block_height=BU().get_latest_block()['index'],
+            block_height=(await BU().get_latest_block_async())['index'],
             public_key=config.public_key,
             fee=float(fee),
             inputs=inputs,
@@ -276,6 +305,7 @@ WALLET_HANDLERS = [
     (r'/create-transaction', CreateTransactionView),
     (r'/create-raw-transaction', CreateRawTransactionView),
     (r'/get-balance-sum', GetBalanceSum),
+    (r'/get-balances', GetBalancesHandler),
     (r'/send-transaction', SendTransactionView),
     (r'/unlocked', UnlockedHandler),
     (r'/unlock', UnlockHandler),
@@ -221,11 +221,11 @@ class HashrateAPIHandler(BaseHandler):
     async def get(self):
         max_target = 0xffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff
         config = self.config
-        blocks = config.BU.get_blocks()
+        blocks = await config.BU.get_blocks_async()
         total_nonce = 0
         periods = []
         last_time = None
-        for block in blocks:
+        async for block in blocks:
             difficulty = max_target / int(block.get('target'), 16)
             if block.get('index') == 0:
                 start_timestamp = block.get('time')
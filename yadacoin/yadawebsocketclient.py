@@ -60,12 +60,9 @@ class ClientChatNamespace(AsyncClientNamespace):
     async def on_blocks(self, data):
         """Peer sent us its latest block, store it and consider it a valid peer."""
         self.app_log.debug("ws client got {} blocks from {}:{}".format(len(data), self.ip, self.port))
-        if self.config.peers.syncing:
-            self.app_log.debug("Ignoring, already syncing")
-            return
         if not len(data):
             return
-        # TODO: if index match and enough blocks, Set syncing and do it
+        # The BlockImporter queues it if it follows the batch being imported
         await self.client.manager.on_blocks(data)
 
     async def on_newtransaction(self, data):
@@ -77,7 +74,7 @@ class ClientChatNamespace(AsyncClientNamespace):
         if self.config.debug:
             self.app_log.info('WS newtransaction: {}'.format(json.dumps(data)))
         try:
-            incoming_txn = Transaction.from_dict(BU().get_latest_block()['index'], data)
+            incoming_txn = Transaction.from_dict((await BU().get_latest_block_async())['index'], data)
             if incoming_txn.in_the_future():
                 # Most important
                 raise ValueError('In the future {}'.format(incoming_txn.transaction_signature))
@@ -99,6 +96,7 @@ class ClientChatNamespace(AsyncClientNamespace):
                     self.app_log.debug('found duplicate tx for rid set {}'.format(incoming_txn.transaction_signature))
                     return
             await get_config().mongo.async_db.miner_transactions.insert_one(incoming_txn.to_dict())
+            await self.config.on_mempool_transaction(incoming_txn)
 
             tb = TxnBroadcaster(self.config)
             await tb.txn_broadcast_job(incoming_txn, ["{}:{}".format(self.ip, self.port)])
@@ -119,7 +117,7 @@ class ClientChatNamespace(AsyncClientNamespace):
             end_index = min(int(data.get("end_index", 0)), start_index + CHAIN.MAX_BLOCKS_PER_MESSAGE)
             # global chain object with cache of current block height,
             # so we can instantly answer to pulling requests without any db request
-            if start_index > self.config.BU.get_latest_block()['index']:
+            if start_index > (await self.config.BU.get_latest_block_async())['index']:
                 # early exit without request
                 await self.emit('blocks', data=[], namespace="/chat")
             else:
@@ -196,7 +194,7 @@ class YadaWebSocketClient(object):
         self.latest_peer_block = await Block.from_dict(data)
         if not self.peers.syncing:
             self.app_log.debug("Trying to sync on latest block from {}".format(self.peer.to_string()))
-            my_index = self.config.BU.get_latest_block()['index']
+            my_index = (await self.config.BU.get_latest_block_async())['index']
             if data['index'] == my_index + 1:
                 self.app_log.debug("Next index, trying to merge from {}".format(self.peer.to_string()))
                 if await self.config.consensus.process_next_block(data, self.peer):
@@ -205,49 +203,30 @@ class YadaWebSocketClient(object):
                     # await self.peers.on_block_insert(data)
             elif data['index'] > my_index + 1:
                 self.app_log.debug("Missing blocks between {} and {} , asking more to {}".format(my_index, data['index'], self.peer.to_string()))
-                data = {"start_index": my_index + 1, "end_index": my_index + 1 + CHAIN.MAX_BLOCKS_PER_MESSAGE}
+                end_index = my_index + 1 + CHAIN.MAX_BLOCKS_PER_MESSAGE
+                if self.config.orphan_pool and self.config.orphan_pool.add(data, self.peer.to_string()):
+                    # Buffered, only ask for what leads to it
+                    end_index = min(end_index, data['index'] - 1)
+                data = {"start_index": my_index + 1, "end_index": end_index}
                 await self.client.emit('get_blocks', data=data, namespace="/chat")
             elif data['index'] == my_index:
                 self.app_log.debug("Same index, ignoring {} from {}".format(data['index'], self.peer.to_string()))
             else:
                 # We have better
                 self.app_log.debug("We have higher index, sending {} to ws {}".format(data['index'], self.peer.to_string()))
-                block = self.config.BU.get_latest_block()
+                block = await self.config.BU.get_latest_block_async()
                 block['time_utc'] = ts_to_utc(block['time'])
                 await self.client.emit('latest_block', data=block, namespace="/chat")
 
     async def on_blocks(self, data):
-        my_index = self.config.BU.get_latest_block()['index']
-        if data[0]['index'] != my_index + 1:
-            return
-        self.peers.syncing = True
         try:
-            inserted = False
-            block = None  # Avoid linter warning
-            for block in data:
-                if block['index'] == my_index + 1:
-                    if await self.consensus.process_next_block(block, self.peer, trigger_event=False):
-                        inserted = True
-                        my_index = block['index']
-                    else:
-                        break
-                else:
-                    # As soon as a block fails, abort
-                    break
-            if inserted:
-                # If import was successful, inform out peers once the batch is processed
-                # then ask for the potential next batch
-                data = {"start_index": my_index + 1, "end_index": my_index + 1 + CHAIN.MAX_BLOCKS_PER_MESSAGE}
-                await self.client.emit('get_blocks', data=data, namespace="/chat")
-            else:
-               self.app_log.debug("Import aborted block: {}".format(my_index))
-               return
+            async def request_next(start_index, end_index):
+                await self.client.emit('get_blocks', data={"start_index": start_index, "end_index": end_index}, namespace="/chat")
+
+            await self.config.block_importer.on_blocks(data, self.peer, request_next)
         except Exception as e:
             import sys, os
             self.app_log.warning("Exception {} on_blocks".format(e))
             exc_type, exc_obj, exc_tb = sys.exc_info()
             fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
             print(exc_type, fname, exc_tb.tb_lineno)
-
-        finally:
-            self.peers.syncing = False
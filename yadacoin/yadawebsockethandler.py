@@ -68,7 +68,7 @@ class ChatNamespace(AsyncNamespace):
         if self.config.debug:
             self.app_log.info('WS newtransaction: {} {}'.format(sid, json.dumps(data)))
         try:
-            incoming_txn = Transaction.from_dict(BU().get_latest_block()['index'], data)
+            incoming_txn = Transaction.from_dict((await BU().get_latest_block_async())['index'], data)
             if incoming_txn.in_the_future():
                 # Most important
                 raise ValueError('In the future {}'.format(incoming_txn.transaction_signature))
@@ -90,6 +90,7 @@ class ChatNamespace(AsyncNamespace):
                     self.app_log.debug('found duplicate tx for rid set {}'.format(incoming_txn.transaction_signature))
                     return
             await get_config().mongo.async_db.miner_transactions.insert_one(incoming_txn.to_dict())
+            await self.config.on_mempool_transaction(incoming_txn)
         
             tb = TxnBroadcaster(self.config, self)
             await tb.txn_broadcast_job(incoming_txn)
@@ -102,7 +103,7 @@ class ChatNamespace(AsyncNamespace):
             self.app_log.info('WS newns: {} {}'.format(sid, json.dumps(data)))
         try:
             peer = Peer(data['host'], data['port'])
-            incoming_txn = Transaction.from_dict(BU().get_latest_block()['index'], data)
+            incoming_txn = Transaction.from_dict((await BU().get_latest_block_async())['index'], data)
             if incoming_txn.in_the_future():
                 # Most important
                 raise ValueError('In the future {}'.format(incoming_txn.transaction_signature))
@@ -177,7 +178,7 @@ class ChatNamespace(AsyncNamespace):
     async def on_get_latest_block(self, sid, data):
         """peer ask for our latest block"""
         self.app_log.info('WS get-latest-block: {} {}'.format(sid, json.dumps(data)))
-        block = self.config.BU.get_latest_block()
+        block = await self.config.BU.get_latest_block_async()
         block['time_utc'] = ts_to_utc(block['time'])
         await self.emit('latest_block', data=block, room=sid)
 
@@ -190,7 +191,7 @@ class ChatNamespace(AsyncNamespace):
         end_index = min(int(data.get("end_index", 0)), start_index + CHAIN.MAX_BLOCKS_PER_MESSAGE)
         # global chain object with cache of current block height,
         # so we can instantly answer to pulling requests without any db request
-        if start_index > self.config.BU.get_latest_block()['index']:
+        if start_index > (await self.config.BU.get_latest_block_async())['index']:
             # early exit without request
             await self.emit('blocks', data=[], room=sid)
         else:
@@ -216,7 +217,7 @@ class ChatNamespace(AsyncNamespace):
             async with self.session(sid) as session:
                 peer = Peer(session['ip'], session['port'])
             self.app_log.debug("Trying to sync on latest block from {}".format(peer.to_string()))
-            my_index = self.config.BU.get_latest_block()['index']
+            my_index = (await self.config.BU.get_latest_block_async())['index']
             if data['index'] == my_index + 1:
                 self.app_log.debug("Next index, trying to merge from {}".format(peer.to_string()))
                 if await self.consensus.process_next_block(data, peer):
@@ -227,7 +228,11 @@ class ChatNamespace(AsyncNamespace):
                 self.app_log.debug(
                     "Missing blocks between {} and {} , asking more to {}".format(my_index, data['index'],
                                                                                   peer.to_string()))
-                data = {"start_index": my_index + 1, "end_index": my_index + 1 + CHAIN.MAX_BLOCKS_PER_MESSAGE}
+                end_index = my_index + 1 + CHAIN.MAX_BLOCKS_PER_MESSAGE
+                if self.config.orphan_pool and self.config.orphan_pool.add(data, peer.to_string()):
+                    # Buffered, only ask for what leads to it
+                    end_index = min(end_index, data['index'] - 1)
+                data = {"start_index": my_index + 1, "end_index": end_index}
                 await self.emit('get_blocks', data=data, room=sid)
             else:
                 # Remove later on
@@ -238,41 +243,20 @@ class ChatNamespace(AsyncNamespace):
         self.app_log.info('WS blocks: {} {}'.format(sid, json.dumps(data)))
         if not len(data):
             return
-        my_index = self.config.BU.get_latest_block()['index']
-        if data[0]['index'] != my_index + 1:
-            return
-        self.peers.syncing = True
         try:
             async with self.session(sid) as session:
                 peer = Peer(session['ip'], session['port'])
-            inserted = False
-            block = None  # Avoid linter warning
-            for block in data:
-                if block['index'] == my_index + 1:
-                    if await self.consensus.process_next_block(block, peer, trigger_event=False):
-                        inserted = True
-                        my_index = block['index']
-                    else:
-                        break
-                else:
-                    # As soon as a block fails, abort
-                    break
-            if inserted:
-                # If import was successful, inform out peers once the batch is processed
-                # then ask for the potential next batch
-                data = {"start_index": my_index + 1, "end_index": my_index + 1 + CHAIN.MAX_BLOCKS_PER_MESSAGE}
-                await self.emit('get_blocks', data=data, room=sid)
-            else:
-               self.app_log.debug("Import aborted block: {}".format(my_index))
-               return
+
+            async def request_next(start_index, end_index):
+                await self.emit('get_blocks', data={"start_index": start_index, "end_index": end_index}, room=sid)
+
+            await self.config.block_importer.on_blocks(data, peer, request_next)
         except Exception as e:
             import sys, os
             self.app_log.warning("Exception {} on_blocks".format(e))
             exc_type, exc_obj, exc_tb = sys.exc_info()
             fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
             print(exc_type, fname, exc_tb.tb_lineno)
-        finally:
-            self.peers.syncing = False
 
 
 